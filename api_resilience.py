@@ -0,0 +1,262 @@
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+import openai
+
+# Устойчивый вызов OpenAI API: повторы с экспоненциальной задержкой и случайным разбросом
+# (с учётом заголовка Retry-After), автоматический выключатель (circuit breaker), который
+# прекращает запросы при серии ошибок, и адаптивное ограничение параллельности (AIMD):
+# при ответах 429 число одновременных запросов уменьшается вдвое, при успешных - растёт на единицу.
+
+MAX_RETRIES = 6  # Количество повторов одного запроса
+BASE_DELAY = 1.0  # Начальная задержка перед повтором, в секундах
+MAX_DELAY = 60.0  # Максимальная задержка перед повтором, в секундах
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+BREAKER_FAILURE_THRESHOLD = 5  # Сколько неудачных запросов подряд (после всех повторов) размыкают выключатель
+BREAKER_RESET_TIMEOUT = 30.0  # Через сколько секунд разрешается пробный запрос
+
+MIN_CONCURRENCY = 1  # Нижняя граница адаптивной параллельности
+CONCURRENCY_DECREASE_FACTOR = 0.5  # Во сколько раз уменьшается параллельность при 429
+DECREASE_COOLDOWN = 2.0  # Не уменьшать параллельность чаще одного раза за этот интервал, в секундах
+
+logger = logging.getLogger("APIResilience")
+
+class TransientAPIError(Exception):
+    # Запрос не выполнен из-за временной ошибки API после всех повторов; письмо нужно обработать позже
+    pass
+
+class CircuitOpenError(TransientAPIError):
+    # Выключатель разомкнут: запрос не отправлялся
+    pass
+
+def is_retryable(error):
+    # Временные ошибки: превышение лимитов, ошибки сервера, таймауты и обрывы соединения
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+def is_rate_limit(error):
+    return isinstance(error, openai.APIStatusError) and error.status_code == 429
+
+def retry_after_seconds(error):
+    # Задержка из заголовков Retry-After-Ms / Retry-After (секунды или HTTP-дата) или None
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, retry_after=None, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+    # Экспоненциальная задержка со случайным разбросом ("full jitter"); Retry-After - нижняя граница
+    delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, max_delay))
+    return delay
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель запросов к API.
+
+    После failure_threshold запросов подряд, не выполненных из-за временных ошибок, новые запросы
+    не отправляются reset_timeout секунд, затем пропускается один пробный запрос:
+    успех замыкает выключатель, ошибка снова размыкает.
+    """
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        # Можно ли отправить запрос: состояние, в котором запрос пропущен ("closed" или "half_open" -
+        # пробный запрос), или None
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return state
+            if state == "half_open" and not self.trial_in_progress:
+                self.trial_in_progress = True
+                return state
+            return None
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("Выключатель замкнут: API снова отвечает.")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def end_trial(self):
+        # Пробный запрос завершился без record_success/record_failure (например, ошибкой 400):
+        # выключатель остаётся полуоткрытым и пропускает следующий пробный запрос
+        with self.lock:
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_in_progress or (self.opened_at is None and self.failures >= self.failure_threshold):
+                logger.warning(f"Выключатель разомкнут после {self.failures} ошибок подряд на {self.reset_timeout} с.")
+                self.opened_at = time.monotonic()
+                self.trial_in_progress = False
+
+class AdaptiveConcurrency:
+    """
+    Адаптивное ограничение количества одновременных запросов (AIMD).
+
+    Параметры:
+        max_limit (int): Максимальное количество одновременных запросов.
+        min_limit (int): Минимальное количество одновременных запросов.
+    """
+    def __init__(self, max_limit, min_limit=MIN_CONCURRENCY):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        # Аддитивное увеличение: примерно +1 после limit успешных запросов
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_throttle(self):
+        # Мультипликативное уменьшение, не чаще одного раза за DECREASE_COOLDOWN
+        now = time.monotonic()
+        if now - self.last_decrease < DECREASE_COOLDOWN:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * CONCURRENCY_DECREASE_FACTOR)
+        logger.warning(f"Превышен лимит API: параллельность снижена до {int(self.limit)}.")
+
+_default_breaker = None
+
+def get_default_breaker():
+    # Общий выключатель для всех запросов процесса
+    global _default_breaker
+    if _default_breaker is None:
+        _default_breaker = CircuitBreaker()
+    return _default_breaker
+
+def _check_breaker(breaker):
+    # Возвращает True, если запрос пропущен как пробный (выключатель полуоткрыт)
+    state = breaker.allow()
+    if not state:
+        raise CircuitOpenError("Выключатель разомкнут: запросы к OpenAI API временно приостановлены.")
+    return state == "half_open"
+
+def call_with_retry(request, breaker=None, max_retries=MAX_RETRIES):
+    """
+    Функция для вызова API с повторами при временных ошибках.
+
+    Параметры:
+        request: Функция без аргументов, выполняющая запрос.
+        breaker (CircuitBreaker): Выключатель (по умолчанию общий).
+        max_retries (int): Количество повторов.
+
+    Возвращает:
+        Результат request(). При исчерпании повторов вызывает TransientAPIError,
+        остальные ошибки API передаются без изменений.
+    """
+    breaker = breaker or get_default_breaker()
+    trial = _check_breaker(breaker)  # Повторы уже начатого запроса выключатель не прерывает
+    try:
+        for attempt in range(max_retries + 1):
+            try:
+                result = request()
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                if attempt == max_retries:
+                    breaker.record_failure()
+                    raise TransientAPIError(f"Временная ошибка API после {max_retries} повторов: {e}") from e
+                delay = backoff_delay(attempt, retry_after_seconds(e))
+                logger.warning(f"Временная ошибка API ({e}). Повтор {attempt + 1} из {max_retries} через {delay:.1f} с.")
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            return result
+    finally:
+        if trial:
+            breaker.end_trial()  # Флаг пробного запроса снимается при любом исходе
+
+async def async_call_with_retry(request, breaker=None, limiter=None, max_retries=MAX_RETRIES, stats=None):
+    """
+    Асинхронная версия call_with_retry.
+
+    Параметры:
+        request: Функция без аргументов, возвращающая корутину запроса.
+        limiter (AdaptiveConcurrency): Ограничение параллельности или None.
+        stats (dict): Счётчики 'retries' и 'throttled' или None.
+    """
+    breaker = breaker or get_default_breaker()
+    trial = _check_breaker(breaker)  # Повторы уже начатого запроса выключатель не прерывает
+    try:
+        for attempt in range(max_retries + 1):
+            if limiter:
+                await limiter.acquire()
+            try:
+                result = await request()
+            except Exception as e:
+                if limiter:
+                    await limiter.release()
+                if not is_retryable(e):
+                    raise
+                if is_rate_limit(e):
+                    if limiter:
+                        limiter.on_throttle()
+                    if stats is not None:
+                        stats['throttled'] = stats.get('throttled', 0) + 1
+                if attempt == max_retries:
+                    breaker.record_failure()
+                    raise TransientAPIError(f"Временная ошибка API после {max_retries} повторов: {e}") from e
+                if stats is not None:
+                    stats['retries'] = stats.get('retries', 0) + 1
+                delay = backoff_delay(attempt, retry_after_seconds(e))
+                logger.warning(f"Временная ошибка API ({e}). Повтор {attempt + 1} из {max_retries} через {delay:.1f} с.")
+                await asyncio.sleep(delay)
+                continue
+            if limiter:
+                limiter.on_success()
+                await limiter.release()
+            breaker.record_success()
+            return result
+    finally:
+        if trial:
+            breaker.end_trial()  # Флаг пробного запроса снимается при любом исходе
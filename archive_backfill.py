@@ -0,0 +1,239 @@
+import argparse
+import html
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from outlook_connection import get_outlook_messages
+from email_body_splitter import EmailBodySplitter
+from database_connection import setup_database, insert_email
+from database_writer import DatabaseWriter
+from mail_classifier import load_classifier, get_message_headers
+from fast_extractor import get_default_fast_extractor
+from email_processor import setup_logging, select_body_to_analyze, update_email_with_extraction
+
+# Загрузка архива писем из Outlook. Разбор писем (HTML в текст, отделение истории переписки,
+# refers_to_thread, предварительный фильтр и извлечение по правилам) - работа процессора на чистом
+# Python, поэтому она выполняется пачками в пуле процессов. Чтение из Outlook (COM) остаётся в основном
+# потоке, запись в SQLite выполняет поток DatabaseWriter пачками транзакций. Письма, которые не удалось разобрать по правилам, сохраняются
+# с processed = 0 и обрабатываются моделью обычным образом (email_processor, async_extractor, batch_processor).
+
+BACKFILL_CHUNK_SIZE = 200  # Писем в одной пачке для процесса-обработчика
+BACKFILL_WORKERS = os.cpu_count() or 1  # Количество процессов-обработчиков
+MAX_PENDING_CHUNKS_PER_WORKER = 2  # Сколько пачек может ждать обработки на один процесс (ограничение памяти)
+
+HTML_DROP_PATTERN = re.compile(r"(?is)<(script|style|head)\b.*?</\1\s*>|<!--.*?-->")
+HTML_BREAK_PATTERN = re.compile(r"(?i)<br\s*/?>|</(p|div|tr|li|h\d|table|blockquote)\s*>")
+HTML_TAG_PATTERN = re.compile(r"<[^>]+>")
+SPACES_PATTERN = re.compile(r"[ \t\u00a0]+")
+
+logger = logging.getLogger("ArchiveBackfill")
+
+def html_to_text(html_body):
+    # Преобразование HTML-письма в текст: строки и абзацы сохраняются, теги и стили удаляются
+    text = HTML_DROP_PATTERN.sub("", html_body or "")
+    text = HTML_BREAK_PATTERN.sub("\n", text)
+    text = html.unescape(HTML_TAG_PATTERN.sub("", text))
+    text = SPACES_PATTERN.sub(" ", text)
+    return re.sub(r"\n\s*\n\s*\n+", "\n\n", text).strip()
+
+# Объекты процесса-обработчика (создаются один раз в init_worker)
+_splitter = None
+_classifier = None
+
+def init_worker(classifier_path=None):
+    # Инициализация процесса-обработчика: разделитель, классификатор, правила извлечения
+    global _splitter, _classifier
+    _splitter = EmailBodySplitter(logger=logger)
+    _classifier = load_classifier(classifier_path) if classifier_path else load_classifier()
+
+def parse_email(raw):
+    """
+    Функция для разбора одного письма в процессе-обработчике.
+
+    Параметры:
+        raw (dict): Данные письма из Outlook (entry_id, subject, sender, sender_address, received_time, body,
+            html_body, headers, conversation_id).
+
+    Возвращает:
+        dict: raw с полями body (текст письма), decision (relevant, confidence, reason)
+        и transportation_info (результат извлечения по правилам или None).
+    """
+    body = raw.get("body") or html_to_text(raw.get("html_body"))
+    decision = _classifier.classify(raw.get("subject"), raw.get("sender"), body, raw.get("headers"),
+                                    raw.get("sender_address"))
+    transportation_info = None
+    if decision.relevant:
+        body_to_analyze = select_body_to_analyze(_splitter, body)
+        transportation_info = get_default_fast_extractor().extract(body_to_analyze)
+    result = dict(raw, body=body, decision=tuple(decision), transportation_info=transportation_info)
+    result.pop("html_body", None)
+    return result
+
+def parse_chunk(chunk):
+    # Разбор пачки писем (выполняется в процессе-обработчике); ошибка одного письма не отменяет
+    # разбор остальных: письмо возвращается с полем error и сохраняется для обработки моделью
+    parsed = []
+    for raw in chunk:
+        try:
+            parsed.append(parse_email(raw))
+        except Exception as e:
+            logger.error(f"Ошибка при разборе письма {raw.get('entry_id')}: {e}")
+            result = dict(raw, body=raw.get("body") or "", decision=(True, 0.0, "ошибка разбора"),
+                          transportation_info=None, error=str(e))
+            result.pop("html_body", None)
+            parsed.append(result)
+    return parsed
+
+def outlook_raw_messages(messages, existing_entry_ids, limit=None):
+    """
+    Генератор данных писем из Outlook для разбора в процессах-обработчиках.
+    Обращения к COM выполняются только здесь, в основном процессе.
+
+    Параметры:
+        messages: Коллекция писем Outlook (Items).
+        existing_entry_ids (set): EntryID писем, которые уже есть в базе.
+        limit (int): Максимальное количество писем или None.
+    """
+    count = 0
+    message = messages.GetFirst()
+    while message and (limit is None or count < limit):
+        try:
+            if message.Class == 43 and message.EntryID not in existing_entry_ids:
+                body = message.Body
+                headers = get_message_headers(message)
+                yield {
+                    "entry_id": message.EntryID,
+                    "subject": message.Subject,
+                    "sender": message.SenderName,
+                    "sender_address": getattr(message, "SenderEmailAddress", "") or message.SenderName,
+                    "received_time": message.ReceivedTime.strftime("%Y-%m-%d %H:%M:%S"),
+                    "body": body,
+                    "html_body": "" if body else (getattr(message, "HTMLBody", "") or ""),
+                    "headers": headers,
+                    "conversation_id": getattr(message, "ConversationID", None),
+                }
+                count += 1
+        except Exception as e:
+            logger.error(f"Ошибка при чтении письма из Outlook: {e}")
+        message = messages.GetNext()
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def save_parsed_email(cursor, parsed):
+    """
+    Функция для записи разобранного письма в базу данных (в основном процессе).
+
+    Возвращает:
+        str: 'filtered' - отброшено фильтром, 'extracted' - обработано по правилам,
+        'pending' - сохранено для обработки моделью, 'errors' - не разобрано и сохранено для обработки моделью,
+        'exists' - уже было в базе.
+    """
+    relevant, confidence, _ = parsed["decision"]
+    email_data = {key: parsed[key] for key in ("entry_id", "subject", "sender", "received_time", "body")}
+    email_data["conversation_id"] = parsed.get("conversation_id")
+    if not relevant:
+        email_data.update(processed=1, prefilter_score=confidence, prefilter_skipped=1)
+        return "filtered" if insert_email(cursor, email_data, commit=False) else "exists"
+    email_id = insert_email(cursor, email_data, commit=False)
+    if email_id is None:
+        return "exists"
+    if parsed.get("error"):
+        return "errors"  # processed = 0: письмо обработает модель
+    info = parsed["transportation_info"]
+    if info is not None and update_email_with_extraction(cursor, email_id, info):
+        return "extracted"
+    return "pending"
+
+def run_backfill(raw_messages, writer, workers=BACKFILL_WORKERS, chunk_size=BACKFILL_CHUNK_SIZE, classifier_path=None):
+    """
+    Функция для параллельного разбора и сохранения писем.
+
+    Параметры:
+        raw_messages: Итератор словарей с данными писем (см. outlook_raw_messages).
+        writer (DatabaseWriter): Поток-писатель базы данных.
+        workers (int): Количество процессов-обработчиков.
+        chunk_size (int): Писем в одной пачке.
+        classifier_path (str): Файл модели классификатора (по умолчанию MODEL_PATH).
+
+    Возвращает:
+        dict: Количество писем по результатам, время и скорость обработки (писем в секунду).
+    """
+    stats = {"emails": 0, "filtered": 0, "extracted": 0, "pending": 0, "exists": 0, "errors": 0}
+    stats_lock = threading.Lock()  # stats обновляют поток-писатель (count) и основной поток (write_oldest)
+    started = time.perf_counter()
+    max_pending = max(1, workers * MAX_PENDING_CHUNKS_PER_WORKER)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(classifier_path,)) as executor:
+        futures = []
+        chunks = chunked(raw_messages, chunk_size)
+
+        def count(result):
+            # Выполняется в потоке-писателе после фиксации транзакции
+            outcome = "errors" if result.exception() else result.result()
+            with stats_lock:
+                stats["emails"] += 1
+                stats[outcome] += 1
+
+        def write_oldest():
+            # Результаты записываются в порядке поступления писем; разбор следующих пачек продолжается
+            future, chunk = futures.pop(0)
+            try:
+                parsed_chunk = future.result()
+            except Exception as e:
+                # Пачка не разобрана целиком (например, завершился процесс-обработчик)
+                logger.error(f"Ошибка при разборе пачки из {len(chunk)} писем: {e}")
+                with stats_lock:
+                    stats["emails"] += len(chunk)
+                    stats["errors"] += len(chunk)
+                return
+            for parsed in parsed_chunk:
+                writer.submit(save_parsed_email, parsed).add_done_callback(count)
+
+        for chunk in chunks:
+            futures.append((executor.submit(parse_chunk, chunk), chunk))
+            if len(futures) >= max_pending:
+                write_oldest()
+                logger.info(f"Загружено писем: {stats['emails']}")
+        while futures:
+            write_oldest()
+    writer.flush()
+
+    elapsed = time.perf_counter() - started
+    stats.update(workers=workers, seconds=elapsed, emails_per_second=stats["emails"] / elapsed if elapsed else 0.0)
+    logger.info(f"Загрузка архива завершена: {stats}")
+    return stats
+
+def backfill_from_outlook(workers=BACKFILL_WORKERS, chunk_size=BACKFILL_CHUNK_SIZE, limit=None):
+    # Загрузка всех писем из папки "Входящие", которых ещё нет в базе данных
+    conn, cursor = setup_database()
+    existing_entry_ids = {row[0] for row in cursor.execute("SELECT entry_id FROM emails")}
+    conn.close()
+    messages = get_outlook_messages()
+    if not messages:
+        logger.error("Не удалось получить сообщения из Outlook.")
+        return None
+    messages.Sort("[ReceivedTime]", False)  # От старых к новым
+    writer = DatabaseWriter()
+    try:
+        return run_backfill(outlook_raw_messages(messages, existing_entry_ids, limit), writer, workers, chunk_size)
+    finally:
+        writer.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Загрузка архива писем Outlook с параллельным разбором")
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS, help="Количество процессов-обработчиков")
+    parser.add_argument("--chunk-size", type=int, default=BACKFILL_CHUNK_SIZE, help="Писем в одной пачке")
+    parser.add_argument("--limit", type=int, default=None, help="Максимальное количество писем")
+    args = parser.parse_args()
+    setup_logging()
+    backfill_from_outlook(args.workers, args.chunk_size, args.limit)
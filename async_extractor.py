@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import time
+from openai_connection import get_async_openai_client
+from email_body_splitter import EmailBodySplitter
+from email_processor import (
+    setup_logging, pending_emails_for_extraction, build_extraction_prompt, parse_extraction_answer,
+    ingest_extraction, extraction_request_options, EXTRACTION_MODEL, EXTRACTION_TEMPERATURE, EXTRACTION_MAX_TOKENS, SYSTEM_PROMPT
+)
+import mig_data
+from llm_cache import make_cache_key, get_default_cache
+from mail_classifier import load_classifier
+from extraction_schema import response_text
+from body_trimmer import count_tokens
+from api_resilience import AdaptiveConcurrency, async_call_with_retry
+from retry_queue import enqueue_retry, clear_retry
+from database_connection import setup_database
+
+# Асинхронный движок извлечения: одновременно выполняет несколько запросов к OpenAI
+# и передаёт результаты в SQLite по мере их готовности, независимо от порядка писем.
+# Число одновременных запросов подстраивается под ответы API (уменьшается при 429).
+
+# Параметры по умолчанию (должны соответствовать лимитам аккаунта OpenAI)
+CONCURRENCY = 8  # Максимальное количество одновременных запросов
+REQUESTS_PER_MINUTE = 500  # Лимит запросов в минуту
+TOKENS_PER_MINUTE = 200000  # Лимит токенов в минуту
+
+logger = logging.getLogger("AsyncExtractor")
+
+class TokenBucket:
+    """
+    Ведро токенов: ёмкость пополняется равномерно со скоростью rate_per_minute единиц в минуту.
+    Используется одновременно для лимита запросов и лимита токенов.
+    """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0  # Скорость пополнения в секунду
+        self.capacity = capacity or rate_per_minute  # Максимальный запас
+        self.tokens = self.capacity  # Текущий запас
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        # Пополняем запас пропорционально прошедшему времени
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        # Ожидаем, пока в ведре не накопится нужное количество единиц
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, delta):
+        # Корректируем запас по фактическому расходу (delta > 0 - израсходовано больше оценки)
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+class AsyncExtractionEngine:
+    """
+    Движок параллельного извлечения информации из писем с помощью AsyncOpenAI.
+
+    Параметры:
+        client (AsyncOpenAI): Асинхронный клиент OpenAI.
+        concurrency (int): Максимальное количество одновременных запросов (фактическое подстраивается под ответы 429).
+        requests_per_minute (int): Лимит запросов в минуту.
+        tokens_per_minute (int): Лимит токенов в минуту.
+        cache (LLMCache): Кэш ответов модели (по умолчанию общий кэш).
+        options (dict): Дополнительные параметры запроса (схема структурированного ответа).
+    """
+    def __init__(self, client, concurrency=CONCURRENCY, requests_per_minute=REQUESTS_PER_MINUTE,
+                 tokens_per_minute=TOKENS_PER_MINUTE, model=EXTRACTION_MODEL,
+                 temperature=EXTRACTION_TEMPERATURE, max_tokens=EXTRACTION_MAX_TOKENS,
+                 system_prompt=SYSTEM_PROMPT, cache=None, options=None):
+        self.client = client
+        self.options = extraction_request_options() if options is None else options
+        self.cache = cache or get_default_cache()
+        self.concurrency = concurrency
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.system_prompt = system_prompt
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.limiter = AdaptiveConcurrency(concurrency)
+        self.stats = {'completed': 0, 'failed': 0, 'cache_hits': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+                      'retries': 0, 'throttled': 0}
+
+    def estimate_tokens(self, prompt):
+        # Токены запроса по локальному токенизатору плюс максимальная длина ответа
+        return count_tokens(self.system_prompt) + count_tokens(prompt) + self.max_tokens
+
+    async def complete(self, prompt):
+        # Выполняет один запрос с соблюдением лимитов, возвращает (ответ, usage)
+        key = make_cache_key(self.model, self.temperature, self.system_prompt, prompt, self.options)
+        cached = self.cache.get(key)
+        if cached is not None:
+            # Ответ из кэша не расходует лимиты
+            self.stats['cache_hits'] += 1
+            return cached
+
+        estimate = self.estimate_tokens(prompt)
+        await self.request_bucket.acquire(1)
+        await self.token_bucket.acquire(estimate)
+
+        response = await async_call_with_retry(lambda: self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            **self.options
+        ), limiter=self.limiter, stats=self.stats)
+        usage = response.usage
+        if usage:
+            self.token_bucket.adjust(usage.total_tokens - estimate)
+            self.stats['prompt_tokens'] += usage.prompt_tokens
+            self.stats['completion_tokens'] += usage.completion_tokens
+        answer = response_text(response.choices[0].message)
+        self.cache.put(key, self.model, answer, usage)
+        return answer, usage
+
+    async def run(self, items, build_prompt, parse_answer, on_result, on_error=None):
+        """
+        Обрабатывает элементы (key, text) пулом из concurrency обработчиков.
+
+        Параметры:
+            items: Итерируемый набор пар (идентификатор, текст).
+            build_prompt: Функция text -> prompt.
+            parse_answer: Функция (answer, key) -> dict или None.
+            on_result: Функция (key, data), вызывается по мере готовности результатов.
+            on_error: Функция (key, exception) для писем, запрос по которым не выполнен, или None.
+
+        Возвращает:
+            dict: Статистика обработки.
+        """
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)  # Ограниченная очередь для обратного давления
+
+        async def producer():
+            for item in items:
+                await queue.put(item)
+            for _ in range(self.concurrency):
+                await queue.put(None)  # Сигнал завершения для каждого обработчика
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                key, text = item
+                try:
+                    answer, _ = await self.complete(build_prompt(text))
+                    data = parse_answer(answer, key)
+                except Exception as e:
+                    self.stats['failed'] += 1
+                    logger.error(f"Письмо ID {key}: Ошибка при обращении к OpenAI API: {e}")
+                    if on_error:
+                        on_error(key, e)
+                    continue
+                self.stats['completed'] += 1
+                try:
+                    on_result(key, data)
+                except Exception as e:
+                    logger.error(f"Письмо ID {key}: Ошибка при сохранении результата: {e}")
+                    logger.exception("Трассировка ошибки:")
+
+        started = time.monotonic()
+        await asyncio.gather(producer(), *(worker() for _ in range(self.concurrency)))
+        self.stats['elapsed'] = time.monotonic() - started
+        self.stats['concurrency'] = int(self.limiter.limit)
+        logger.info(f"Асинхронное извлечение завершено: {self.stats}")
+        return self.stats
+
+async def extract_pending_emails(db_path="emails.db", **engine_options):
+    # Асинхронно обрабатывает письма из базы данных с processed = 0
+    client = get_async_openai_client()
+    if not client:
+        logger.error("Не удалось получить асинхронный клиент OpenAI.")
+        return None
+
+    conn, cursor = setup_database(db_path)
+    splitter = EmailBodySplitter(logger=logger)
+    pending = pending_emails_for_extraction(conn, splitter, load_classifier())
+
+    def on_result(email_id, transportation_info):
+        # Результаты приходят в порядке готовности; запись выполняется в потоке цикла событий
+        if ingest_extraction(cursor, email_id, transportation_info):
+            logger.info(f"Письмо из базы данных с ID {email_id} обработано и обновлено.")
+        else:
+            logger.info(f"Письмо из базы данных с ID {email_id} не содержит котировку или запрос на перевозку.")
+        conn.commit()
+
+    def on_error(email_id, error):
+        # Письмо не помечается обработанным, а ставится в очередь повторов
+        enqueue_retry(cursor, "extract", email_id, error)
+        conn.commit()
+
+    engine = AsyncExtractionEngine(client, **engine_options)
+    try:
+        return await engine.run(pending, build_extraction_prompt,
+                                lambda answer, email_id: parse_extraction_answer(answer), on_result, on_error)
+    finally:
+        conn.close()
+        await client.close()
+
+async def migrate_pending_emails(db_path="emails.db", **engine_options):
+    # Асинхронная версия mig_data.analyze_and_migrate
+    client = get_async_openai_client()
+    if not client:
+        logger.error("Не удалось получить асинхронный клиент OpenAI.")
+        return None
+
+    conn, cursor = setup_database(db_path)
+    mig_data.create_tables_if_not_exists(cursor)
+    conn.commit()
+    rows = mig_data.migrate_locally(conn, mig_data.pending_migration_rows(cursor))
+    logger.info(f"Найдено писем для миграции: {len(rows)}")
+    rows_by_id = {row[0]: row for row in rows}
+
+    def on_result(email_id, analyzed_data):
+        _, request_type, origin, destination, cargo_details, price, additional_info, transport_type = rows_by_id.pop(email_id)
+        try:
+            conn.execute('BEGIN')
+            if analyzed_data:
+                mig_data.save_structured_data(cursor, email_id, analyzed_data,
+                                              origin, destination, cargo_details, price, transport_type)
+            cursor.execute("UPDATE emails SET migration_processed = 1 WHERE id = ?", (email_id,))
+            clear_retry(cursor, "migrate", email_id)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def on_error(email_id, error):
+        # Письмо не помечается обработанным, а ставится в очередь повторов
+        enqueue_retry(cursor, "migrate", email_id, error)
+        conn.commit()
+
+    engine = AsyncExtractionEngine(client, model=mig_data.MIGRATION_MODEL,
+                                   temperature=mig_data.MIGRATION_TEMPERATURE,
+                                   max_tokens=mig_data.MIGRATION_MAX_TOKENS,
+                                   options=mig_data.migration_request_options(), **engine_options)
+    items = ((row[0], mig_data.build_combined_data(*row[1:])) for row in rows)
+    try:
+        return await engine.run(items, mig_data.build_migration_prompt, mig_data.parse_migration_answer,
+                                on_result, on_error)
+    finally:
+        conn.close()
+        await client.close()
+
+if __name__ == "__main__":
+    setup_logging()
+    asyncio.run(extract_pending_emails())
+    asyncio.run(migrate_pending_emails())
@@ -0,0 +1,216 @@
+import json
+import logging
+import sys
+import time
+from openai_connection import get_openai_client
+from email_body_splitter import EmailBodySplitter
+from email_processor import (
+    setup_logging, pending_emails_for_extraction, build_extraction_prompt, parse_extraction_answer,
+    ingest_extraction, extraction_request_options, EXTRACTION_MODEL, EXTRACTION_TEMPERATURE, EXTRACTION_MAX_TOKENS, SYSTEM_PROMPT
+)
+import mig_data
+from mail_classifier import load_classifier
+from extraction_schema import response_text_from_json
+from api_resilience import call_with_retry
+from database_connection import setup_database
+
+# Пакетный режим (OpenAI Batch API) для этапов извлечения и миграции:
+# все необработанные письма сериализуются в JSONL-файл, файл отправляется одним пакетом,
+# а результаты загружаются в базу данных одной транзакцией.
+
+BATCH_INPUT_PATH = "requests.jsonl"  # Файл с запросами пакета
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+POLL_INTERVAL = 60  # Интервал опроса статуса пакета, в секундах
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+logger = logging.getLogger("BatchProcessor")
+
+def build_batch_request(email_id, prompt, model, temperature, max_tokens, options=None):
+    # Формирует одну строку пакета; custom_id - идентификатор письма
+    request = {
+        "custom_id": str(email_id),
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        },
+    }
+    request["body"].update(options or {})
+    return request
+
+def write_batch_file(requests, path=BATCH_INPUT_PATH):
+    """
+    Функция для записи запросов пакета в JSONL-файл.
+
+    Параметры:
+        requests: Итерируемый набор словарей запросов.
+        path (str): Путь к файлу.
+
+    Возвращает:
+        int: Количество записанных запросов.
+    """
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for request in requests:
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+            count += 1
+    logger.info(f"В файл '{path}' записано запросов: {count}")
+    return count
+
+def pending_extraction_requests(conn):
+    # Запросы этапа извлечения: письма с processed = 0, прошедшие предварительный фильтр
+    splitter = EmailBodySplitter(logger=logger)
+    for email_id, body in pending_emails_for_extraction(conn, splitter, load_classifier()):
+        yield build_batch_request(email_id, build_extraction_prompt(body), EXTRACTION_MODEL, EXTRACTION_TEMPERATURE,
+                                  EXTRACTION_MAX_TOKENS, extraction_request_options())
+
+def pending_migration_requests(rows):
+    # Запросы этапа миграции
+    for row in rows:
+        prompt = mig_data.build_migration_prompt(mig_data.build_combined_data(*row[1:]))
+        yield build_batch_request(row[0], prompt, mig_data.MIGRATION_MODEL,
+                                  mig_data.MIGRATION_TEMPERATURE, mig_data.MIGRATION_MAX_TOKENS,
+                                  mig_data.migration_request_options())
+
+def submit_batch(client, path=BATCH_INPUT_PATH):
+    # Загружает файл пакета и создаёт задание Batch API
+    def upload():
+        with open(path, "rb") as f:
+            return client.files.create(file=f, purpose="batch")
+
+    input_file = call_with_retry(upload)
+    batch = call_with_retry(lambda: client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW,
+    ))
+    logger.info(f"Пакет {batch.id} отправлен (файл {input_file.id}).")
+    return batch
+
+def wait_for_batch(client, batch_id, poll_interval=POLL_INTERVAL):
+    # Опрашивает статус пакета до его завершения
+    while True:
+        batch = call_with_retry(lambda: client.batches.retrieve(batch_id))
+        logger.info(f"Пакет {batch_id}: статус {batch.status}.")
+        if batch.status in FINAL_STATUSES:
+            return batch
+        time.sleep(poll_interval)
+
+def download_results(client, batch):
+    """
+    Функция для загрузки результатов пакета.
+
+    Возвращает:
+        dict: Словарь {id письма: (ответ модели, usage)} только для успешных запросов.
+    """
+    results = {}
+    if not batch.output_file_id:
+        logger.error(f"Пакет {batch.id}: файл результатов отсутствует (статус {batch.status}).")
+        return results
+
+    content = call_with_retry(lambda: client.files.content(batch.output_file_id)).text
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            logger.error(f"Письмо ID {record.get('custom_id')}: Ошибка в пакете: {record.get('error')}")
+            continue
+        body = response["body"]
+        answer = response_text_from_json(body["choices"][0]["message"])
+        results[int(record["custom_id"])] = (answer, body.get("usage") or {})
+    logger.info(f"Пакет {batch.id}: получено результатов: {len(results)}")
+    return results
+
+def ingest_extraction_results(conn, results):
+    # Загружает результаты этапа извлечения одной транзакцией
+    cursor = conn.cursor()
+    updated = 0
+    try:
+        conn.execute("BEGIN")
+        for email_id, (answer, _) in results.items():
+            # Письма без котировки или запроса (rel=false) помечаются обработанными
+            if ingest_extraction(cursor, email_id, parse_extraction_answer(answer)):
+                updated += 1
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    logger.info(f"Этап извлечения: обновлено писем {updated} из {len(results)}.")
+    return updated
+
+def ingest_migration_results(conn, results, rows):
+    # Загружает результаты этапа миграции одной транзакцией
+    cursor = conn.cursor()
+    rows_by_id = {row[0]: row for row in rows}
+    try:
+        conn.execute("BEGIN")
+        for email_id, (answer, _) in results.items():
+            row = rows_by_id.get(email_id)
+            if row is None:
+                continue
+            _, request_type, origin, destination, cargo_details, price, additional_info, transport_type = row
+            analyzed_data = mig_data.parse_migration_answer(answer, email_id)
+            if analyzed_data:
+                mig_data.save_structured_data(cursor, email_id, analyzed_data,
+                                              origin, destination, cargo_details, price, transport_type)
+            cursor.execute("UPDATE emails SET migration_processed = 1 WHERE id = ?", (email_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    logger.info(f"Этап миграции: обработано писем {len(results)}.")
+    return len(results)
+
+def run_batch(stage, db_path="emails.db", path=BATCH_INPUT_PATH, client=None, poll_interval=POLL_INTERVAL):
+    """
+    Функция для выполнения этапа в пакетном режиме.
+
+    Параметры:
+        stage (str): 'extract' или 'migrate'.
+        db_path (str): Путь к базе данных.
+        path (str): Путь к файлу пакета.
+        client (OpenAI): Клиент OpenAI (например, настроенный на локальный сервер-заглушку через base_url).
+    """
+    client = client or get_openai_client()
+    if not client:
+        logger.error("Не удалось получить клиент OpenAI.")
+        return None
+
+    conn, cursor = setup_database(db_path)  # Этап извлечения использует столбцы последних миграций (body_id)
+    try:
+        if stage == "extract":
+            count = write_batch_file(pending_extraction_requests(conn), path)
+        elif stage == "migrate":
+            mig_data.create_tables_if_not_exists(cursor)
+            conn.commit()
+            rows = mig_data.migrate_locally(conn, mig_data.pending_migration_rows(cursor))
+            count = write_batch_file(pending_migration_requests(rows), path)
+        else:
+            raise ValueError(f"Неизвестный этап: {stage}")
+
+        if not count:
+            logger.info("Нет необработанных писем для пакетной обработки.")
+            return 0
+
+        batch = submit_batch(client, path)
+        batch = wait_for_batch(client, batch.id, poll_interval)
+        results = download_results(client, batch)
+
+        if stage == "extract":
+            return ingest_extraction_results(conn, results)
+        return ingest_migration_results(conn, results, rows)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    setup_logging()
+    run_batch(sys.argv[1] if len(sys.argv) > 1 else "extract")
@@ -0,0 +1,181 @@
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Локальный сервер-заглушка, имитирующий эндпоинты files и batches OpenAI API.
+# Позволяет проверить пакетный режим без обращения к OpenAI:
+#     python batch_stub_server.py 8765
+#     client = OpenAI(api_key="stub", base_url="http://127.0.0.1:8765/v1")
+#     batch_processor.run_batch("extract", client=client, poll_interval=1)
+
+DEFAULT_ANSWER = "Нет информации о перевозке"
+
+logger = logging.getLogger("BatchStubServer")
+
+def default_answer(body):
+    # Ответ модели по умолчанию для каждого запроса пакета
+    return DEFAULT_ANSWER
+
+class BatchStubState:
+    # Хранилище файлов и пакетов заглушки
+    def __init__(self, answer=default_answer, polls_until_complete=1):
+        self.answer = answer  # Функция body запроса -> текст ответа
+        self.polls_until_complete = polls_until_complete  # Сколько опросов пакет остаётся "in_progress"
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def add_file(self, content, filename, purpose):
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        self.files[file_id] = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+            "content": content,
+        }
+        return self.files[file_id]
+
+    def run_batch(self, input_file_id):
+        # Формирует файл результатов так же, как Batch API
+        lines = []
+        for line in self.files[input_file_id]["content"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            answer = self.answer(request["body"])
+            if request["body"].get("tools"):
+                # Структурированный ответ: текст ответа передаётся как аргументы вызова функции
+                function_name = request["body"]["tools"][0]["function"]["name"]
+                message = {"role": "assistant", "content": None, "tool_calls": [{
+                    "id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+                    "function": {"name": function_name, "arguments": answer}}]}
+            else:
+                message = {"role": "assistant", "content": answer}
+            lines.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "request_id": uuid.uuid4().hex,
+                    "body": {
+                        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": request["body"]["model"],
+                        "choices": [{"index": 0, "finish_reason": "stop", "message": message}],
+                        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+                    },
+                },
+                "error": None,
+            }, ensure_ascii=False))
+        output = self.add_file(("\n".join(lines) + "\n").encode("utf-8"), "batch_output.jsonl", "batch_output")
+        return output["id"], len(lines)
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, payload, status=200):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def do_POST(self):
+            with state.lock:
+                if self.path == "/v1/files":
+                    # multipart/form-data с полями file и purpose
+                    raw = b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + self._read_body()
+                    message = BytesParser(policy=default_policy).parsebytes(raw)
+                    fields = {}
+                    for part in message.iter_parts():
+                        name = part.get_param("name", header="content-disposition")
+                        fields[name] = (part.get_filename(), part.get_payload(decode=True))
+                    filename, content = fields["file"]
+                    purpose = fields.get("purpose", (None, b"batch"))[1].decode()
+                    file = state.add_file(content, filename or "upload.jsonl", purpose)
+                    return self._send_json({k: v for k, v in file.items() if k != "content"})
+
+                if self.path == "/v1/batches":
+                    request = json.loads(self._read_body())
+                    batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+                    state.batches[batch_id] = {
+                        "id": batch_id,
+                        "object": "batch",
+                        "endpoint": request["endpoint"],
+                        "input_file_id": request["input_file_id"],
+                        "completion_window": request["completion_window"],
+                        "status": "in_progress",
+                        "output_file_id": None,
+                        "error_file_id": None,
+                        "created_at": int(time.time()),
+                        "request_counts": {"total": 0, "completed": 0, "failed": 0},
+                        "_polls": 0,
+                    }
+                    return self._send_json(self._public(state.batches[batch_id]))
+
+            self._send_json({"error": {"message": "not found"}}, 404)
+
+        def do_GET(self):
+            with state.lock:
+                parts = self.path.strip("/").split("/")
+                if parts[:2] == ["v1", "batches"] and len(parts) == 3 and parts[2] in state.batches:
+                    batch = state.batches[parts[2]]
+                    batch["_polls"] += 1
+                    if batch["status"] == "in_progress" and batch["_polls"] >= state.polls_until_complete:
+                        output_file_id, total = state.run_batch(batch["input_file_id"])
+                        batch.update(status="completed", output_file_id=output_file_id,
+                                     completed_at=int(time.time()),
+                                     request_counts={"total": total, "completed": total, "failed": 0})
+                    return self._send_json(self._public(batch))
+
+                if parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content" and parts[2] in state.files:
+                    content = state.files[parts[2]]["content"]
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                    return
+
+            self._send_json({"error": {"message": "not found"}}, 404)
+
+        @staticmethod
+        def _public(batch):
+            return {k: v for k, v in batch.items() if not k.startswith("_")}
+
+    return Handler
+
+def start_stub_server(port=0, state=None):
+    # Запускает сервер в фоновом потоке и возвращает (server, base_url)
+    state = state or BatchStubState()
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    logger.info(f"Сервер-заглушка Batch API запущен: {base_url}")
+    return server, base_url
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    server, base_url = start_stub_server(int(sys.argv[1]) if len(sys.argv) > 1 else 8765)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
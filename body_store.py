@@ -0,0 +1,190 @@
+import argparse
+import hashlib
+import logging
+import os
+import time
+import zlib
+from database_writer import connect
+
+# Хранилище текстов писем. Тексты (полное письмо, история переписки, HTML) записываются в таблицу
+# email_bodies сжатыми zlib и с ключом по хэшу содержимого: одинаковые тексты (повторяющаяся история
+# переписки, рассылки, пересылки) хранятся один раз. В таблицах писем остаётся только ссылка body_id,
+# поэтому выборки по письмам читают одни метаданные, а текст загружается только когда он нужен.
+
+COMPRESSION_LEVEL = 6  # Уровень сжатия zlib (1 - быстрее, 9 - плотнее)
+MIN_COMPRESS_SIZE = 128  # Более короткие тексты хранятся без сжатия
+MOVE_BATCH_SIZE = 1000  # Писем в одной пачке при переносе текстов из таблицы писем
+CODEC_ZLIB = "zlib"
+CODEC_RAW = "raw"
+
+logger = logging.getLogger("BodyStore")
+
+def create_body_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_bodies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            hash BLOB NOT NULL UNIQUE,
+            codec TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        )
+    ''')
+
+def body_hash(text):
+    # Ключ текста: SHA-256 от UTF-8
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+def compress_body(text):
+    """
+    Функция для сжатия текста письма.
+
+    Возвращает:
+        tuple: (кодек, данные); текст хранится без сжатия, если он короткий или сжатие не уменьшает его.
+    """
+    raw = text.encode("utf-8")
+    if len(raw) >= MIN_COMPRESS_SIZE:
+        compressed = zlib.compress(raw, COMPRESSION_LEVEL)
+        if len(compressed) < len(raw):
+            return CODEC_ZLIB, compressed
+    return CODEC_RAW, raw
+
+def decompress_body(codec, data):
+    raw = zlib.decompress(data) if codec == CODEC_ZLIB else bytes(data)
+    return raw.decode("utf-8")
+
+def store_body(cursor, text):
+    """
+    Функция для сохранения текста письма. Транзакцией управляет вызывающий код.
+
+    Параметры:
+        cursor: Курсор базы данных.
+        text (str): Текст письма.
+
+    Возвращает:
+        int: ID текста в email_bodies (существующего, если такой текст уже сохранён) или None для пустого текста.
+    """
+    if not text:
+        return None
+    digest = body_hash(text)
+    row = cursor.execute("SELECT id FROM email_bodies WHERE hash = ?", (digest,)).fetchone()
+    if row:
+        return row[0]
+    codec, data = compress_body(text)
+    cursor.execute(
+        "INSERT INTO email_bodies (hash, codec, size, data) VALUES (?, ?, ?, ?)",
+        (digest, codec, len(text), data)
+    )
+    return cursor.lastrowid
+
+def load_body(cursor, body_id):
+    # Текст письма по ID; пустая строка, если текста нет
+    if body_id is None:
+        return ""
+    row = cursor.execute("SELECT codec, data FROM email_bodies WHERE id = ?", (body_id,)).fetchone()
+    return decompress_body(*row) if row else ""
+
+def load_email_body(cursor, email_id, column="body_id", table="emails"):
+    # Текст письма по ID письма (column - столбец ссылки на текст)
+    row = cursor.execute(f"SELECT {column} FROM {table} WHERE id = ?", (email_id,)).fetchone()
+    return load_body(cursor, row[0]) if row else ""
+
+def move_inline_bodies(cursor, table, columns, batch_size=MOVE_BATCH_SIZE):
+    """
+    Функция для переноса текстов, хранящихся в самой таблице писем, в email_bodies.
+    Текстовый столбец очищается (NULL), ссылка записывается в столбец body_id. Транзакцией управляет вызывающий код.
+
+    Параметры:
+        cursor: Курсор базы данных.
+        table (str): Таблица писем.
+        columns (dict): Текстовый столбец -> столбец ссылки на текст, например {"body": "body_id"}.
+
+    Возвращает:
+        int: Количество перенесённых текстов.
+    """
+    moved = 0
+    for text_column, id_column in columns.items():
+        column_moved = 0
+        while True:
+            rows = cursor.execute(
+                f"SELECT id, {text_column} FROM {table} WHERE {text_column} IS NOT NULL LIMIT ?", (batch_size,)
+            ).fetchall()
+            if not rows:
+                break
+            cursor.executemany(
+                f"UPDATE {table} SET {id_column} = ?, {text_column} = NULL WHERE id = ?",
+                [(store_body(cursor, text), row_id) for row_id, text in rows]
+            )
+            column_moved += len(rows)
+        if column_moved:
+            logger.info(f"Тексты {table}.{text_column} перенесены в email_bodies: {column_moved}")
+        moved += column_moved
+    return moved
+
+def delete_unreferenced_bodies(cursor, references):
+    """
+    Функция для удаления текстов, на которые не ссылается ни одно письмо.
+
+    Параметры:
+        references (list): Пары (таблица, столбец ссылки), например [("emails", "body_id")].
+
+    Возвращает:
+        int: Количество удалённых текстов.
+    """
+    used = " UNION ".join(f"SELECT {column} FROM {table} WHERE {column} IS NOT NULL" for table, column in references)
+    cursor.execute(f"DELETE FROM email_bodies WHERE id NOT IN ({used})")
+    return cursor.rowcount
+
+def storage_stats(conn, path, scan_sql="SELECT * FROM emails"):
+    """
+    Функция для оценки размера базы и времени полного просмотра таблицы писем.
+
+    Возвращает:
+        dict: Размер файла, количество и размер текстов в email_bodies, время выполнения scan_sql.
+    """
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")  # Размер файла без несохранённого журнала WAL
+    started = time.perf_counter()
+    rows = len(conn.execute(scan_sql).fetchall())
+    stats = {
+        'file_mb': round(os.path.getsize(path) / 2 ** 20, 2),
+        'scan_rows': rows,
+        'scan_seconds': round(time.perf_counter() - started, 4),
+    }
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'email_bodies'").fetchone():
+        count, size, stored = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(data)), 0) FROM email_bodies"
+        ).fetchone()
+        stats.update(bodies=count, bodies_chars=size, bodies_stored_bytes=stored)
+    return stats
+
+def compare_storage(path, migrate):
+    """
+    Функция для переноса текстов писем в email_bodies с отчётом о размере базы и времени просмотра писем
+    до и после. База сжимается VACUUM (освобождённые страницы возвращаются файловой системе).
+
+    Параметры:
+        path (str): Файл базы данных.
+        migrate: Функция migrate(conn), переносящая тексты (schema_migrations.migrate или DatabaseManager).
+
+    Возвращает:
+        dict: Показатели 'before' и 'after'.
+    """
+    conn = connect(path)
+    before = storage_stats(conn, path)
+    migrate(conn)
+    conn.execute("VACUUM")
+    after = storage_stats(conn, path)
+    conn.close()
+    logger.info(f"Размер базы: {before['file_mb']} -> {after['file_mb']} МБ, "
+                f"просмотр писем: {before['scan_seconds']} -> {after['scan_seconds']} с")
+    return {'before': before, 'after': after}
+
+if __name__ == "__main__":
+    from schema_migrations import DB_PATH, migrate
+
+    parser = argparse.ArgumentParser(description="Перенос текстов писем в сжатое хранилище email_bodies")
+    parser.add_argument("--db", default=DB_PATH, help="Файл базы данных")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    report = compare_storage(args.db, migrate)
+    print(f"До: {report['before']}")
+    print(f"После: {report['after']}")
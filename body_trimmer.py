@@ -0,0 +1,147 @@
+import logging
+import re
+import tiktoken
+
+# Сокращение текста письма перед отправкой в модель с учётом бюджета токенов:
+# оставляем только последние сообщения из истории переписки, убираем повторяющиеся цитаты,
+# подписи и юридические оговорки, а затем обрезаем текст до лимита токенов.
+
+TOKENIZER_MODEL = "gpt-3.5-turbo"  # Модель, по токенизатору которой считаются токены
+MAX_HISTORY_MESSAGES = 2  # Сколько последних сообщений из истории переписки оставлять
+MAX_EMAIL_TOKENS = 1500  # Максимальное количество токенов текста одного письма
+MAX_MESSAGES_TO_SPLIT = 20  # Ограничение на разбор очень длинных цепочек
+
+# Начало подписи: всё, что ниже, отбрасывается
+SIGNATURE_PATTERN = re.compile(
+    r"(?im)^\s*(--\s*|__+\s*|с уважением|с наилучшими пожеланиями|best regards|kind regards|"
+    r"regards|sincerely|thanks and regards|mit freundlichen grüßen|cordialement|"
+    r"sent from my \w+|отправлено с \w+)[,.!]?\s*$"
+)
+# Абзацы с юридическими оговорками
+DISCLAIMER_PATTERN = re.compile(
+    r"(?i)(confidential|intended recipient|intended solely|disclaimer|privileged|"
+    r"this e-?mail and any attachments|конфиденциальн|предназначено исключительно|"
+    r"если вы не являетесь адресатом|не является публичной офертой)"
+)
+QUOTED_LINE_PATTERN = re.compile(r"(?m)^\s*>.*\n?")
+BLANK_LINES_PATTERN = re.compile(r"\n{3,}")
+
+logger = logging.getLogger("BodyTrimmer")
+
+_encoding = None
+
+def get_encoding():
+    # Токенизатор загружается один раз
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+    return _encoding
+
+def count_tokens(text):
+    # Количество токенов текста по токенизатору модели
+    return len(get_encoding().encode(text or "", disallowed_special=()))
+
+def truncate_to_tokens(text, max_tokens):
+    # Обрезает текст до max_tokens токенов
+    tokens = get_encoding().encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return get_encoding().decode(tokens[:max_tokens])
+
+def strip_signature(text):
+    # Отбрасывает подпись и всё, что следует за ней
+    match = SIGNATURE_PATTERN.search(text)
+    if match and match.start() > 0:
+        return text[:match.start()].rstrip()
+    return text
+
+def strip_disclaimers(text):
+    # Удаляет абзацы с юридическими оговорками
+    paragraphs = re.split(r"\n\s*\n", text)
+    kept = [paragraph for paragraph in paragraphs if not DISCLAIMER_PATTERN.search(paragraph)]
+    return "\n\n".join(kept)
+
+def clean_message(text):
+    # Очистка одного сообщения: цитаты ">", подпись, оговорки, лишние пустые строки
+    text = QUOTED_LINE_PATTERN.sub("", text)
+    text = strip_disclaimers(strip_signature(text))
+    return BLANK_LINES_PATTERN.sub("\n\n", text).strip()
+
+def split_history(splitter, history_body, limit=MAX_MESSAGES_TO_SPLIT):
+    # Разбивает историю переписки на пары (заголовки, текст сообщения), от новых к старым
+    messages = []
+    rest = history_body
+    while rest and len(messages) < limit:
+        # Блок заголовков цитаты (From/Sent/To/Subject) заканчивается первой пустой строкой
+        lines = rest.split("\n")
+        header_length = next((i for i, line in enumerate(lines[:10]) if not line.strip()), 0) + 1
+        head = "\n".join(lines[:header_length])
+        current, rest = splitter.split_body("\n".join(lines[header_length:]))
+        messages.append((head, current))
+    return messages
+
+class BodyTrimmer:
+    """
+    Подготовка текста письма к анализу в пределах бюджета токенов.
+
+    Параметры:
+        splitter (EmailBodySplitter): Разделитель письма и истории переписки.
+        max_history_messages (int): Сколько последних сообщений истории оставлять.
+        max_tokens (int): Лимит токенов на одно письмо.
+    """
+    def __init__(self, splitter, max_history_messages=MAX_HISTORY_MESSAGES, max_tokens=MAX_EMAIL_TOKENS):
+        self.splitter = splitter
+        self.max_history_messages = max_history_messages
+        self.max_tokens = max_tokens
+        self.stats = {'emails': 0, 'tokens_before': 0, 'tokens_after': 0, 'truncated': 0}
+
+    def trim(self, main_body, history_body=None):
+        """
+        Функция для сокращения текста письма.
+
+        Параметры:
+            main_body (str): Основное письмо.
+            history_body (str): История переписки или None, если её не нужно включать.
+
+        Возвращает:
+            str: Текст для отправки в модель.
+        """
+        original = main_body + ("\n" + history_body if history_body else "")
+        parts = [clean_message(main_body)]
+        seen = {self._fingerprint(parts[0])}
+
+        if history_body and self.max_history_messages:
+            for head, message in split_history(self.splitter, history_body):
+                cleaned = clean_message(message)
+                fingerprint = self._fingerprint(cleaned)
+                if not cleaned or fingerprint in seen:
+                    continue  # Повторяющийся блок цитаты
+                seen.add(fingerprint)
+                # Из заголовков цитаты оставляем только первую строку (обычно отправитель)
+                parts.append(head.split("\n", 1)[0].strip() + "\n" + cleaned)
+                if len(parts) > self.max_history_messages:
+                    break
+
+        text = "\n\n".join(part for part in parts if part)
+        tokens = count_tokens(text)
+        if tokens > self.max_tokens:
+            text = truncate_to_tokens(text, self.max_tokens)
+            self.stats['truncated'] += 1
+
+        self.stats['emails'] += 1
+        self.stats['tokens_before'] += count_tokens(original)
+        self.stats['tokens_after'] += min(tokens, self.max_tokens)
+        return text
+
+    @staticmethod
+    def _fingerprint(text):
+        # Нормализованный текст для поиска повторов
+        return re.sub(r"\W+", " ", text.lower()).strip()
+
+    def report(self):
+        # Сводка по сокращению токенов
+        before = self.stats['tokens_before']
+        after = self.stats['tokens_after']
+        report = dict(self.stats, reduction=1 - after / before if before else 0.0)
+        logger.info(f"Сокращение текста писем: {report}")
+        return report
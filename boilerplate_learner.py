@@ -0,0 +1,206 @@
+import hashlib
+import logging
+import re
+import time
+from body_trimmer import clean_message, count_tokens, BLANK_LINES_PATTERN
+from fast_extractor import PRICE_PATTERN, CONTAINER_PATTERN, TRUCK_PATTERN, WEIGHT_PATTERN, VOLUME_PATTERN, CITY_PATTERN
+
+# Обучение шаблонам отправителей. Письма экспедиторов содержат длинные многоязычные подписи,
+# реквизиты и оговорки, которые не распознаются общими правилами body_trimmer.
+# Для каждого отправителя подсчитывается, в скольких его письмах встречается каждая строка;
+# строки, которые повторяются в большинстве писем, считаются шаблоном и удаляются перед
+# отправкой в модель. Счётчики хранятся в базе писем и обновляются с каждым новым письмом.
+
+MIN_SENDER_MESSAGES = 3  # Сколько писем отправителя нужно, прежде чем удалять его шаблон
+BOILERPLATE_SHARE = 0.6  # Доля писем отправителя, в которых должна встречаться строка шаблона
+MIN_LINE_LENGTH = 4  # Более короткие строки не учитываются
+LINE_MAX_AGE_DAYS = 180  # Строки, встреченные один раз и не повторявшиеся дольше этого срока, удаляются
+
+# Строки с ценой, контейнером, типом кузова, весом, объёмом или городом не удаляются,
+# даже если повторяются (например, постоянный маршрут отправителя)
+PROTECTED_PATTERNS = [PRICE_PATTERN, CONTAINER_PATTERN, TRUCK_PATTERN, WEIGHT_PATTERN, VOLUME_PATTERN, CITY_PATTERN]
+
+logger = logging.getLogger("BoilerplateLearner")
+
+def line_fingerprint(line):
+    # Хэш нормализованной строки или None для коротких и пустых строк
+    normalized = re.sub(r"\s+", " ", line).strip().lower()
+    if len(normalized) < MIN_LINE_LENGTH:
+        return None
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+def is_protected(line):
+    return any(pattern.search(line) for pattern in PROTECTED_PATTERNS)
+
+def normalize_sender(sender):
+    return (sender or "").strip().lower()
+
+class BoilerplateLearner:
+    """
+    Шаблоны (подписи, реквизиты, оговорки) отправителей в базе писем.
+
+    Параметры:
+        conn (sqlite3.Connection): Соединение с базой данных emails.db.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.stats = {'emails': 0, 'stripped_emails': 0, 'chars_removed': 0, 'tokens_removed': 0}
+        self.create_tables()
+        self.evict()
+
+    def create_tables(self):
+        cursor = self.conn.cursor()
+        # Количество писем отправителя, по которым обучен шаблон, и сокращение текста
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sender_templates (
+                sender TEXT PRIMARY KEY,
+                messages INTEGER NOT NULL DEFAULT 0,
+                stripped_messages INTEGER NOT NULL DEFAULT 0,
+                chars_before INTEGER NOT NULL DEFAULT 0,
+                chars_removed INTEGER NOT NULL DEFAULT 0,
+                tokens_removed INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        # В скольких письмах отправителя встречается строка
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sender_template_lines (
+                sender TEXT NOT NULL,
+                line_hash TEXT NOT NULL,
+                messages INTEGER NOT NULL DEFAULT 0,
+                last_seen REAL NOT NULL,
+                PRIMARY KEY (sender, line_hash)
+            )
+        ''')
+        # Письма, уже учтённые в счётчиках (повторная обработка не искажает статистику)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sender_template_messages (
+                sender TEXT NOT NULL,
+                body_hash TEXT NOT NULL,
+                PRIMARY KEY (sender, body_hash)
+            )
+        ''')
+        self.conn.commit()
+
+    def evict(self):
+        # Удаляет строки, встреченные один раз и давно не повторявшиеся
+        cutoff = time.time() - LINE_MAX_AGE_DAYS * 86400
+        deleted = self.conn.execute(
+            "DELETE FROM sender_template_lines WHERE messages = 1 AND last_seen < ?", (cutoff,)
+        ).rowcount
+        self.conn.commit()
+        if deleted:
+            logger.info(f"Шаблоны отправителей: удалено устаревших строк {deleted}.")
+
+    def observe(self, sender, body):
+        """
+        Функция для учёта письма отправителя в счётчиках строк.
+
+        Возвращает:
+            bool: True, если письмо учтено впервые.
+        """
+        sender = normalize_sender(sender)
+        if not sender or not body:
+            return False
+        cursor = self.conn.cursor()
+        body_hash = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        cursor.execute("INSERT OR IGNORE INTO sender_template_messages (sender, body_hash) VALUES (?, ?)",
+                       (sender, body_hash))
+        if not cursor.rowcount:
+            return False
+        now = time.time()
+        hashes = {line_fingerprint(line) for line in body.splitlines()} - {None}
+        cursor.executemany('''
+            INSERT INTO sender_template_lines (sender, line_hash, messages, last_seen) VALUES (?, ?, 1, ?)
+            ON CONFLICT(sender, line_hash) DO UPDATE SET messages = messages + 1, last_seen = excluded.last_seen
+        ''', [(sender, value, now) for value in hashes])
+        cursor.execute('''
+            INSERT INTO sender_templates (sender, messages, updated_at) VALUES (?, 1, ?)
+            ON CONFLICT(sender) DO UPDATE SET messages = messages + 1, updated_at = excluded.updated_at
+        ''', (sender, now))
+        self.conn.commit()
+        return True
+
+    def template_lines(self, sender):
+        # Хэши строк, которые встречаются не менее чем в BOILERPLATE_SHARE писем отправителя
+        row = self.conn.execute("SELECT messages FROM sender_templates WHERE sender = ?", (sender,)).fetchone()
+        messages = row[0] if row else 0
+        if messages < MIN_SENDER_MESSAGES:
+            return set()
+        rows = self.conn.execute(
+            "SELECT line_hash FROM sender_template_lines WHERE sender = ? AND messages >= ?",
+            (sender, max(2, BOILERPLATE_SHARE * messages))
+        )
+        return {row[0] for row in rows}
+
+    def strip(self, sender, body):
+        """
+        Функция для удаления шаблона отправителя из текста письма.
+        Письмо сначала учитывается в счётчиках, поэтому шаблон обновляется с каждым новым письмом.
+
+        Параметры:
+            sender (str): Отправитель письма.
+            body (str): Основное письмо (без истории переписки).
+
+        Возвращает:
+            str: Текст без строк шаблона.
+        """
+        if not body:
+            return body
+        self.stats['emails'] += 1
+        sender = normalize_sender(sender)
+        first_time = self.observe(sender, body)
+        template = self.template_lines(sender) if sender else set()
+        if not template:
+            return body
+
+        kept = [line for line in body.splitlines()
+                if line_fingerprint(line) not in template or is_protected(line)]
+        stripped = BLANK_LINES_PATTERN.sub("\n\n", "\n".join(kept))
+
+        # Сокращение считается после общей очистки, чтобы не учитывать подписи, которые и так удаляются
+        before, after = clean_message(body), clean_message(stripped)
+        chars_removed = len(before) - len(after)
+        if chars_removed <= 0:
+            return body
+        if not first_time:
+            return stripped  # Повторная обработка письма не учитывается в статистике
+        tokens_removed = count_tokens(before) - count_tokens(after)
+        self.stats['stripped_emails'] += 1
+        self.stats['chars_removed'] += chars_removed
+        self.stats['tokens_removed'] += tokens_removed
+        self.conn.execute('''
+            UPDATE sender_templates SET
+                stripped_messages = stripped_messages + 1,
+                chars_before = chars_before + ?,
+                chars_removed = chars_removed + ?,
+                tokens_removed = tokens_removed + ?
+            WHERE sender = ?
+        ''', (len(before), chars_removed, tokens_removed, sender))
+        self.conn.commit()
+        return stripped
+
+    def sender_report(self, limit=20):
+        """
+        Функция для получения сокращения текста по отправителям.
+
+        Возвращает:
+            list: Словари с количеством писем, удалённых символов и токенов, от наибольшего сокращения.
+        """
+        rows = self.conn.execute('''
+            SELECT sender, messages, stripped_messages, chars_before, chars_removed, tokens_removed
+            FROM sender_templates WHERE stripped_messages > 0 ORDER BY tokens_removed DESC LIMIT ?
+        ''', (limit,)).fetchall()
+        return [{"sender": sender, "messages": messages, "stripped_messages": stripped_messages,
+                 "chars_removed": chars_removed, "tokens_removed": tokens_removed,
+                 "reduction": chars_removed / chars_before if chars_before else 0.0}
+                for sender, messages, stripped_messages, chars_before, chars_removed, tokens_removed in rows]
+
+    def report(self):
+        # Сводка по удалённым шаблонам за запуск и по отправителям
+        logger.info(f"Шаблоны отправителей: {self.stats}")
+        for row in self.sender_report():
+            logger.info(f"Шаблон отправителя {row['sender']}: писем {row['messages']}, "
+                        f"сокращено {row['stripped_messages']}, символов {row['chars_removed']} "
+                        f"({row['reduction']:.0%}), токенов {row['tokens_removed']}")
+        return dict(self.stats)
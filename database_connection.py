@@ -1,69 +1,30 @@
 import sqlite3
 import logging
+from database_writer import connect
+from schema_migrations import migrate
+from price_parser import save_price_components
+from body_store import store_body
 
-def setup_database():
-    conn = sqlite3.connect('emails.db')
-    cursor = conn.cursor()
+def setup_database(path='emails.db'):
+    conn = connect(path)  # WAL и synchronous = NORMAL (см. database_writer.PRAGMAS)
+    migrate(conn)  # Схема базы создаётся и обновляется миграциями (schema_migrations)
+    return conn, conn.cursor()
 
-    # Создание таблицы, если она не существует
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS emails (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            entry_id TEXT UNIQUE,
-            subject TEXT,
-            sender TEXT,
-            received_time TEXT,
-            body TEXT,
-            request_type TEXT,
-            origin TEXT,
-            destination TEXT,
-            cargo_details TEXT,
-            dates TEXT,
-            price TEXT,
-            additional_info TEXT,
-            processed INTEGER DEFAULT 0
-        )
-    ''')
-    conn.commit()
-
-    # Список ожидаемых столбцов (включая новые)
-    expected_columns = {
-        "query_type": "TEXT",  # Новый столбец
-        "transport_type": "TEXT",
-        "weight": "TEXT",
-        "volume": "TEXT"
-    }
-
-    # Проверка существующих столбцов в таблице
-    cursor.execute("PRAGMA table_info(emails)")
-    existing_columns = [column[1] for column in cursor.fetchall()]  # Список имен столбцов
-
-    # Добавление недостающих столбцов
-    for column_name, column_type in expected_columns.items():
-        if column_name not in existing_columns:
-            try:
-                cursor.execute(f'ALTER TABLE emails ADD COLUMN {column_name} {column_type}')
-                logging.info(f"Столбец {column_name} ({column_type}) добавлен в таблицу emails.")
-            except sqlite3.Error as e:
-                logging.error(f"Ошибка при добавлении столбца {column_name}: {e}")
-
-    conn.commit()
-    return conn, cursor
-
-def insert_email(cursor, email_data):
+def insert_email(cursor, email_data, commit=True):
+    # commit=False - письмо записывается в текущую транзакцию (например, потоком DatabaseWriter)
     try:
         logging.debug(f"Данные для вставки: {email_data}")
         cursor.execute('''
             INSERT OR IGNORE INTO emails (
-                entry_id, subject, sender, received_time, body, request_type, query_type,
-                origin, destination, cargo_details, transport_type, dates, price, additional_info, processed
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                entry_id, subject, sender, received_time, request_type, query_type,
+                origin, destination, cargo_details, transport_type, dates, price, additional_info, processed,
+                prefilter_score, prefilter_skipped, conversation_id, migration_processed
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             email_data['entry_id'],
             email_data['subject'],
             email_data['sender'],
             email_data['received_time'],
-            email_data['body'],
             email_data.get('request_type', ''),
             email_data.get('query_type', ''),
             email_data.get('origin', ''),
@@ -73,9 +34,26 @@ def insert_email(cursor, email_data):
             email_data.get('dates', ''),
             email_data.get('price', ''),
             email_data.get('additional_info', ''),
-            email_data.get('processed', 0)
+            email_data.get('processed', 0),
+            email_data.get('prefilter_score'),
+            email_data.get('prefilter_skipped', 0),
+            email_data.get('conversation_id'),
+            email_data.get('migration_processed', 0)
         ))
-        cursor.connection.commit()
+        # ID вставленной строки или None, если письмо уже было в базе
+        email_id = cursor.lastrowid if cursor.rowcount else None
+        if email_id:
+            # Текст - в сжатом хранилище email_bodies; сохраняется только для нового письма,
+            # иначе для уже существующего entry_id в email_bodies остался бы текст без ссылки на него
+            body_id = store_body(cursor, email_data['body'])
+            cursor.execute('UPDATE emails SET body_id = ? WHERE id = ?', (body_id, email_id))
+            # Числовая цена и составляющие цены (price_components)
+            save_price_components(cursor, email_id, email_data.get('price', ''), email_data.get('origin'),
+                                  email_data.get('destination'), email_data.get('cargo_details'),
+                                  email_data.get('transport_type'), email_data['received_time'])
+        if commit:
+            cursor.connection.commit()
+        return email_id
     except sqlite3.Error as e:
         logging.error(f"Ошибка при вставке данных в базу: {e}")
 
@@ -89,7 +67,12 @@ def email_exists_in_db(cursor, entry_id):
 
 def get_emails_from_db(cursor):
     try:
-        cursor.execute("SELECT * FROM emails WHERE processed = 0")
+        # Только метаданные: текст письма загружается по body_id (body_store.load_body), когда он нужен
+        cursor.execute('''
+            SELECT id, entry_id, subject, sender, received_time, body_id, query_type, origin, destination,
+                   cargo_details, transport_type, dates, price, additional_info, processed
+            FROM emails WHERE processed = 0
+        ''')
         return cursor.fetchall()
     except sqlite3.Error as e:
         logging.error(f"Ошибка при выборке данных из базы: {e}")
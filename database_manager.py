@@ -0,0 +1,183 @@
+import json
+import logging
+from database_writer import connect
+from body_store import create_body_table, store_body, load_email_body, move_inline_bodies
+from schema_migrations import table_columns, add_missing_columns
+
+# Хранилище писем пакета email_client (EmailReader): письма с метками в отдельной базе.
+# Письма и метки записываются пачками в одной транзакции на вызов, через одно долгоживущее
+# соединение; тексты запросов не меняются от вызова к вызову, поэтому sqlite3 повторно использует
+# подготовленные выражения из кэша соединения. Тексты писем (основное письмо, история переписки, HTML)
+# хранятся в сжатом хранилище email_bodies (body_store), в таблице emails - только ссылки на них.
+
+DB_PATH = "email_client.db"  # База писем email_client
+EMAIL_COLUMNS = ["entryid", "subject", "sender", "received_time", "body_id", "history_body_id", "html_body_id",
+                 "attachments", "transportation_info"]
+BODY_COLUMNS = {"body": "body_id", "history_body": "history_body_id", "html_body": "html_body_id"}  # Текст -> ссылка
+# Писем в одном INSERT: число параметров запроса не превышает 999 (ограничение старых версий SQLite)
+INSERT_CHUNK_SIZE = 999 // len(EMAIL_COLUMNS)
+
+logger = logging.getLogger("DatabaseManager")
+
+def _json_or_none(value):
+    # Результат стадии извлечения в JSON; None, если стадия не выполнялась или не дала результата
+    return json.dumps(value, ensure_ascii=False) if value is not None else None
+
+def _email_row(cursor, email_data):
+    # Значения столбцов EMAIL_COLUMNS для письма из EmailMessageProcessor; тексты записываются в email_bodies
+    return (
+        email_data['entryid'],
+        email_data.get('subject'),
+        email_data.get('sender'),
+        email_data.get('received_time'),
+        store_body(cursor, email_data.get('body')),
+        store_body(cursor, email_data.get('history_body')),
+        store_body(cursor, email_data.get('html_body')),
+        json.dumps(email_data.get('attachments') or [], ensure_ascii=False),
+        _json_or_none(email_data.get('transportation_info')),
+    )
+
+def _tag_rows(email_id, tags):
+    # Метки в виде строк (email_id, category, tag): словарь {категория: метка или список меток} или список меток
+    if isinstance(tags, dict):
+        for category, values in tags.items():
+            for tag in (values if isinstance(values, (list, tuple, set)) else [values]):
+                if tag:
+                    yield email_id, str(category), str(tag)
+    else:
+        for tag in tags or []:
+            if tag:
+                yield email_id, "", str(tag)
+
+class DatabaseManager:
+    """
+    Хранилище писем и меток для EmailReader.
+
+    Параметры:
+        db_path (str): Файл базы данных.
+    """
+    def __init__(self, db_path=DB_PATH):
+        self.conn = connect(db_path)
+        self.create_tables()
+
+    def create_tables(self):
+        cursor = self.conn.cursor()
+        create_body_table(cursor)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS emails (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                entryid TEXT NOT NULL UNIQUE,
+                subject TEXT,
+                sender TEXT,
+                received_time TEXT,
+                body_id INTEGER REFERENCES email_bodies(id),
+                history_body_id INTEGER REFERENCES email_bodies(id),
+                html_body_id INTEGER REFERENCES email_bodies(id),
+                attachments TEXT,
+                transportation_info TEXT
+            )
+        ''')
+        # Данные стадии извлечения (EmailReader.run_pipeline) в JSON
+        add_missing_columns(cursor, "emails", {"transportation_info": "TEXT"})
+        # Базы прежних версий хранили тексты в самой таблице emails: тексты переносятся в email_bodies
+        add_missing_columns(cursor, "emails", {column: "INTEGER REFERENCES email_bodies(id)"
+                                               for column in BODY_COLUMNS.values()})
+        columns = table_columns(cursor, "emails")
+        move_inline_bodies(cursor, "emails", {text: ref for text, ref in BODY_COLUMNS.items() if text in columns})
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS email_tags (
+                email_id INTEGER NOT NULL REFERENCES emails(id),
+                category TEXT NOT NULL DEFAULT '',
+                tag TEXT NOT NULL,
+                PRIMARY KEY (email_id, category, tag)
+            )
+        ''')
+        self.conn.commit()
+
+    def get_existing_entryids(self):
+        # Идентификаторы сохранённых писем; строки читаются курсором по мере построения множества
+        return {entryid for (entryid,) in self.conn.execute("SELECT entryid FROM emails")}
+
+    def save_emails(self, emails):
+        """
+        Функция для сохранения писем одной транзакцией.
+
+        Параметры:
+            emails (list): Словари писем (EmailMessageProcessor.process и entryid).
+
+        Возвращает:
+            list: ID сохранённых писем в порядке emails; None для писем, которые уже были в базе.
+        """
+        ids = {}
+        cursor = self.conn.cursor()
+        try:
+            # Письма, которые уже есть в базе (или повторяются в пачке), не записываются: иначе их тексты
+            # сохранялись бы в email_bodies без ссылок на них
+            seen = set()
+            for start in range(0, len(emails), INSERT_CHUNK_SIZE):
+                batch = emails[start:start + INSERT_CHUNK_SIZE]
+                existing = self._existing(cursor, [email_data['entryid'] for email_data in batch])
+                chunk = []
+                for email_data in batch:
+                    entryid = email_data['entryid']
+                    if entryid not in seen and entryid not in existing:
+                        chunk.append(email_data)
+                    seen.add(entryid)
+                if not chunk:
+                    continue
+                # executemany не возвращает строки RETURNING, поэтому пачка вставляется одним запросом
+                values = ", ".join([f"({', '.join('?' * len(EMAIL_COLUMNS))})"] * len(chunk))
+                params = [value for email_data in chunk for value in _email_row(cursor, email_data)]
+                rows = cursor.execute(
+                    f"INSERT INTO emails ({', '.join(EMAIL_COLUMNS)}) VALUES {values} "
+                    f"ON CONFLICT(entryid) DO NOTHING RETURNING id, entryid",
+                    params
+                ).fetchall()
+                ids.update((entryid, email_id) for email_id, entryid in rows)
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Ошибка при сохранении писем: {e}")
+            raise
+        logger.debug(f"Сохранено писем: {len(ids)} из {len(emails)}")
+        return [ids.get(email_data['entryid']) for email_data in emails]
+
+    def get_body(self, email_id, part="body"):
+        # Текст письма загружается отдельно от метаданных: part - body, history_body или html_body
+        return load_email_body(self.conn.cursor(), email_id, BODY_COLUMNS[part])
+
+    def _existing(self, cursor, entryids):
+        # Идентификаторы из entryids, которые уже есть в базе (один запрос на пачку)
+        placeholders = ", ".join("?" * len(entryids))
+        return {entryid for (entryid,) in cursor.execute(
+            f"SELECT entryid FROM emails WHERE entryid IN ({placeholders})", entryids
+        )}
+
+    def save_email(self, email_data):
+        # Сохранение одного письма; возвращает ID или None, если письмо уже было в базе
+        return self.save_emails([email_data])[0]
+
+    def save_tags(self, email_tags):
+        """
+        Функция для сохранения меток писем одной транзакцией.
+
+        Параметры:
+            email_tags: Пары (ID письма, метки); метки - словарь {категория: метка или список} или список.
+
+        Возвращает:
+            int: Количество добавленных меток.
+        """
+        rows = [row for email_id, tags in email_tags if email_id is not None for row in _tag_rows(email_id, tags)]
+        try:
+            cursor = self.conn.executemany(
+                "INSERT INTO email_tags (email_id, category, tag) VALUES (?, ?, ?) ON CONFLICT DO NOTHING", rows
+            )
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Ошибка при сохранении меток: {e}")
+            raise
+        return cursor.rowcount
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,166 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+# Запись в базу писем из одного потока. Операции записи ставятся в очередь и выполняются
+# потоком-писателем пачками: транзакция фиксируется, когда в ней набралось BATCH_MAX_OPERATIONS
+# операций или прошло BATCH_MAX_DELAY секунд с первой из них. Соединения открываются в режиме WAL
+# с synchronous = NORMAL: фиксация транзакции не ждёт записи на диск (fsync выполняется при
+# переносе журнала в базу), а чтение из других соединений не блокируется записью.
+
+DB_PATH = "emails.db"  # База писем
+BATCH_MAX_OPERATIONS = 500  # Максимальное количество операций в одной транзакции
+BATCH_MAX_DELAY = 0.5  # Максимальное время от первой операции до фиксации транзакции, в секундах
+WRITER_QUEUE_SIZE = 10000  # Операций в очереди писателя (при заполнении submit ждёт)
+BUSY_TIMEOUT = 30  # Сколько ждать освобождения базы другим соединением, в секундах
+CACHE_SIZE_KB = 64000  # Размер кэша страниц соединения, в килобайтах
+
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",  # Чтение не блокируется записью; запись не блокируется чтением
+    "PRAGMA synchronous = NORMAL",  # В режиме WAL база остаётся согласованной при сбое питания
+    f"PRAGMA cache_size = -{CACHE_SIZE_KB}",
+    "PRAGMA temp_store = MEMORY",
+]
+
+_STOP = object()  # Завершение потока-писателя
+_FLUSH = object()  # Фиксация текущей транзакции
+
+logger = logging.getLogger("DatabaseWriter")
+
+def connect(path=DB_PATH, check_same_thread=True):
+    """
+    Функция для открытия соединения с базой данных с настройками PRAGMAS.
+
+    Параметры:
+        path (str): Файл базы данных.
+        check_same_thread (bool): Запрещать использование соединения из других потоков.
+
+    Возвращает:
+        sqlite3.Connection: Соединение с базой данных.
+    """
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+class DatabaseWriter:
+    """
+    Поток-писатель базы данных с очередью операций и пачечной фиксацией транзакций.
+
+    Параметры:
+        path (str): Файл базы данных.
+        max_operations (int): Максимальное количество операций в одной транзакции.
+        max_delay (float): Максимальное время до фиксации транзакции, в секундах.
+        queue_size (int): Размер очереди операций.
+    """
+    def __init__(self, path=DB_PATH, max_operations=BATCH_MAX_OPERATIONS, max_delay=BATCH_MAX_DELAY,
+                 queue_size=WRITER_QUEUE_SIZE):
+        self.path = path
+        self.max_operations = max_operations
+        self.max_delay = max_delay
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = {'operations': 0, 'transactions': 0, 'errors': 0}
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self._run, name="DatabaseWriter", daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args):
+        """
+        Функция для постановки операции записи в очередь.
+
+        Параметры:
+            func: Функция func(cursor, *args); выполняется в потоке-писателе и не должна фиксировать транзакцию.
+
+        Возвращает:
+            Future: Результат func (после фиксации транзакции, в которую попала операция).
+        """
+        future = Future()
+        self.queue.put((func, args, future))
+        return future
+
+    def execute(self, sql, params=()):
+        # Одиночный запрос; результат - lastrowid
+        return self.submit(lambda cursor: cursor.execute(sql, params).lastrowid)
+
+    def executemany(self, sql, rows):
+        # Один запрос для многих строк; результат - количество изменённых строк
+        return self.submit(lambda cursor: cursor.executemany(sql, rows).rowcount)
+
+    def flush(self):
+        # Ожидание выполнения и фиксации всех поставленных операций
+        future = Future()
+        self.queue.put((_FLUSH, (), future))
+        future.result()
+
+    def close(self):
+        # Фиксация оставшихся операций и завершение потока-писателя
+        self.queue.put((_STOP, (), None))
+        self.thread.join()
+        elapsed = time.perf_counter() - self.started
+        report = dict(self.stats, operations_per_second=self.stats['operations'] / elapsed if elapsed else 0.0)
+        logger.info(f"Запись в базу данных: {report}")
+        return report
+
+    def _run(self):
+        conn = connect(self.path)
+        conn.isolation_level = None  # Транзакциями управляет поток-писатель
+        cursor = conn.cursor()
+        done = []  # Операции текущей транзакции и их результаты
+        batch_started = None
+        try:
+            while True:
+                timeout = None if batch_started is None else max(0.0, batch_started + self.max_delay - time.perf_counter())
+                try:
+                    func, args, future = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    batch_started = self._commit(conn, done)
+                    continue
+                if func is _STOP:
+                    break
+                if func is _FLUSH:
+                    batch_started = self._commit(conn, done)
+                    future.set_result(None)
+                    continue
+                if batch_started is None:
+                    conn.execute("BEGIN")
+                    batch_started = time.perf_counter()
+                # Точка сохранения: ошибка одной операции не отменяет остальные операции транзакции
+                conn.execute("SAVEPOINT operation")
+                try:
+                    result = func(cursor, *args)
+                    conn.execute("RELEASE operation")
+                    done.append((future, result, None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO operation")
+                    conn.execute("RELEASE operation")
+                    self.stats['errors'] += 1
+                    logger.error(f"Ошибка при записи в базу данных: {e}")
+                    done.append((future, None, e))
+                if len(done) >= self.max_operations:
+                    batch_started = self._commit(conn, done)
+        finally:
+            self._commit(conn, done)
+            conn.close()
+
+    def _commit(self, conn, done):
+        # Фиксация транзакции; результаты операций передаются после фиксации
+        if conn.in_transaction:
+            try:
+                conn.execute("COMMIT")
+                self.stats['transactions'] += 1
+            except sqlite3.Error as e:
+                conn.execute("ROLLBACK")
+                self.stats['errors'] += len(done)
+                logger.error(f"Ошибка при фиксации транзакции ({len(done)} операций отменено): {e}")
+                done[:] = [(future, None, e) for future, _, _ in done]
+        self.stats['operations'] += len(done)
+        for future, result, error in done:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        done.clear()
+        return None
@@ -1,49 +1,159 @@
 import re  # Для работы с регулярными выражениями
 import logging  # Для логирования
+from collections import namedtuple
+
+# Разделение письма на основное сообщение и историю переписки.
+# Шаблоны собираются и компилируются один раз при импорте модуля; split_offsets возвращает
+# границы частей письма без копирования строк, split_body - сами строки (как раньше).
+
+# Названия полей заголовка цитаты (Outlook, Gmail при пересылке) на разных языках
+HEADER_NAMES = list(dict.fromkeys([
+    "from", "sent", "date", "to", "cc", "subject",
+    "от", "отправлено", "отправитель", "дата", "кому", "копия", "тема",
+    "de", "envoyé", "à", "objet", "sujet",
+    "von", "gesendet", "an", "datum", "betreff",
+    "da", "inviato", "data", "oggetto",
+    "enviado", "fecha", "para", "asunto", "assunto",
+    "van", "verzonden", "aan", "onderwerp",
+    "fra", "sendt", "dato", "emne",
+    "від", "надіслано", "кому", "тема",
+    "od", "poslano", "zaslano", "naslov", "predmet",
+    "kimden", "tarih", "konu",
+    "dari", "dikirim", "tanggal", "subjek",
+    "kutoka", "tarehe", "mada",
+    "mới", "gửi", "ngày", "chủ đề",
+    "由", "发件人", "发件者", "发送时间", "发送日期", "寄件日期", "日期", "主题", "信件主题",
+    "送信者", "日付", "件名",
+    "من", "مرسل", "تاريخ", "التاريخ", "موضوع",
+    "فرستنده", "تاریخ",
+    "سے",
+    "प्रेषक", "दिनांक", "तारीख", "विषय",
+    "প্রেরক", "তারিখ", "বিষয়",
+    "ప్రేలగించు", "తేదీ", "విషయం",
+    "அனுப்புனர்", "தேதி", "பொருள்",
+]))
+HEADER_NAME_SET = frozenset(HEADER_NAMES)
+# Строка "Поле: значение"; название поля сверяется с HEADER_NAME_SET, а не перечисляется в шаблоне:
+# чередование из сотни названий без учёта регистра проверяется в каждой строке письма заметно дольше
+_HEADER_LINE = r"[ \t]*\*?(?P<{group}>[^\W\d_][^\n:*]{{0,24}}?)\*?[ \t]*:"
+
+# Маркеры начала цитаты: "-----Original Message-----" и пересылка
+ORIGINAL_MESSAGE_MARKERS = [
+    "original message", "forwarded message", "исходное сообщение", "пересланное сообщение",
+    "message d'origine", "message transféré", "ursprüngliche nachricht", "weitergeleitete nachricht",
+    "mensaje original", "mensaje reenviado", "messaggio originale", "messaggio inoltrato",
+    "mensagem original", "oorspronkelijk bericht", "原始邮件", "转发的邮件",
+]
+# Строка-вступление Gmail и Apple Mail: "On <дата>, <имя> wrote:" (может переноситься на вторую строку)
+REPLY_INTRO_VERBS = [
+    "wrote", "пишет", "написал", "написала", "написал\\(а\\)", "a écrit", "schrieb",
+    "escribió", "ha scritto", "escreveu", "schreef", "skrev", "napisał", "yazdı",
+]
+
+REPLY_INTRO_PREFIXES = ["on", "le", "am", "el", "il", "em", "op", "den"]
+
+# Все ветви привязаны к началу строки: в остальных позициях поиск отбрасывается одной проверкой
+SPLIT_PATTERN = re.compile(
+    r"^(?:"
+    # Заголовок цитаты Outlook: не менее двух строк "Поле: значение" подряд
+    rf"(?P<header>{_HEADER_LINE.format(group='header_name')}[^\n]*"
+    rf"(?=\n{_HEADER_LINE.format(group='next_header_name')}))|"
+    # -----Original Message----- / ---------- Forwarded message ---------
+    rf"(?P<marker>[ \t]*-{{2,}}[ \t]*(?:{'|'.join(re.escape(m) for m in ORIGINAL_MESSAGE_MARKERS)})[ \t]*-*[ \t]*$)|"
+    # Блок строк, процитированных через ">"
+    r"(?P<quote>[ \t]*>)|"
+    r"(?P<dashes>-{2,}[ \t]*$)|"  # Линия из дефисов как разделитель
+    # Строка, оканчивающаяся двоеточием: возможное вступление цитаты, проверяется INTRO_PATTERN.
+    # Поиск глагола "wrote" в каждой строке без учёта регистра намного медленнее.
+    r"(?P<intro>[^\n]*:[ \t]*$)"
+    r")",
+    re.IGNORECASE | re.MULTILINE
+)
+INTRO_PATTERN = re.compile(
+    # On Mon, 12 May 2024 at 10:00, Ivan <ivan@example.com> wrote
+    rf"(?![ \t]*>)[^\n]*\b(?:{'|'.join(REPLY_INTRO_VERBS)})[ \t]*|"
+    # пн, 12 мая 2024 г. в 10:00, Иван <ivan@example.ru>
+    r"[^\n]*\d{4}\s*г\.\s*в\s*\d{1,2}:\d{2},[^\n]*",
+    re.IGNORECASE
+)
+INTRO_PREFIX_PATTERN = re.compile(rf"[ \t]*(?:{'|'.join(REPLY_INTRO_PREFIXES)})\b", re.IGNORECASE)
+
+SplitOffsets = namedtuple("SplitOffsets", ["main_start", "main_end", "history_start", "history_end", "kind"])
+
+def _strip_bounds(text, start, end):
+    # Границы подстроки text[start:end] без пробельных символов по краям
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+def _match_kind(match):
+    # Имя сработавшей ветви SPLIT_PATTERN (lastgroup для ветви header - вложенная группа названия поля)
+    return "header" if match.group("header") is not None else match.lastgroup
+
+def _is_header(match):
+    # Обе строки - поля заголовка цитаты ("From:" / "Sent:", "От:" / "Отправлено:")
+    return (match.group("header_name").strip().lower() in HEADER_NAME_SET
+            and match.group("next_header_name").strip().lower() in HEADER_NAME_SET)
+
+def _intro_start(text, colon):
+    # Начало вступления цитаты, которое заканчивается двоеточием в позиции colon, или None
+    line_start = text.rfind("\n", 0, colon) + 1
+    if not INTRO_PATTERN.fullmatch(text, line_start, colon):
+        return None
+    # Вступление Gmail может быть перенесено: "On Mon, 12 May 2024 at 10:00, Ivan <" / "ivan@example.com> wrote:"
+    previous_start = text.rfind("\n", 0, max(line_start - 1, 0)) + 1
+    if line_start and INTRO_PREFIX_PATTERN.match(text, previous_start, line_start - 1):
+        line_start = previous_start
+    # Вступление содержит дату или время; "Клиент пишет:" без цифр - часть письма
+    if not any(char.isdigit() for char in text[line_start:colon]):
+        return None
+    return line_start
+
+def split_offsets(full_body):
+    """
+    Функция для поиска границ основного письма и истории переписки.
+
+    Возвращает:
+        SplitOffsets: Границы основного письма и истории (history_start = history_end = None,
+        если истории нет) и вид найденного маркера ('header', 'marker', 'quote', 'dashes', 'intro').
+    """
+    for match in SPLIT_PATTERN.finditer(full_body):
+        kind = _match_kind(match)
+        if kind == "header":
+            start = match.start() if _is_header(match) else None
+        elif kind == "intro":
+            start = _intro_start(full_body, match.start() + match.group("intro").rindex(":"))
+        elif kind == "dashes":
+            start = match.start() or None  # Линия из дефисов в самом начале письма - не разделитель
+        else:
+            start = match.start()
+        if start is not None:
+            main_start, main_end = _strip_bounds(full_body, 0, start)
+            history_start, history_end = _strip_bounds(full_body, start, len(full_body))
+            return SplitOffsets(main_start, main_end, history_start, history_end, kind)
+    main_start, main_end = _strip_bounds(full_body, 0, len(full_body))
+    return SplitOffsets(main_start, main_end, None, None, None)
 
 class EmailBodySplitter:
     def __init__(self, logger=None):
         # Если логгер не передан, создаем его
         self.logger = logger or logging.getLogger(__name__)
 
+    def split_offsets(self, full_body):
+        # Границы основного письма и истории переписки (см. split_offsets)
+        return split_offsets(full_body)
+
     def split_body(self, full_body):
         """
         Разделяет основное письмо и историю переписки на основе шаблонов, характерных для начала переписки.
         Возвращает кортеж (основное письмо, письмо с историей переписки).
         """
-        self.logger.debug("Начинаем разделение тела письма.")
-
-        # Ищем место начала истории переписки по характерным признакам
-        split_pattern = (
-            r"(?i)^((from|sent|date|subject|"
-            r"от|отправлено|дата|тема|"
-            r"de|envoyé|date|sujet|"
-            r"von|gesendet|datum|betreff|"
-            r"da|inviato|data|oggetto|"
-            r"de|enviado|fecha|asunto|"
-            r"由|发送时间|日期|主题|"
-            r"发件人|寄件日期|信件主题|"
-            r"van|verzonden|datum|onderwerp|"
-            r"fra|sendt|dato|emne|"
-            r"від|надіслано|дата|тема|"
-            r"من|مرسل|تاريخ|موضوع|"
-            r"fra|sendt|dato|emne|"
-            r"mới|gửi|ngày|chủ đề|"
-            r"od|poslano|datum|naslov|"
-            r"od|zaslano|datum|predmet|"
-            r"отправитель|отправлено|дата|тема|"
-            r"发件者|发送日期|日期|主题):\s+.*)|"
-            r"(\n-{2,}\n)"  # Линия из дефисов как разделитель
-        )  # Учитывает различные языки и форматы
-        split_match = re.search(split_pattern, full_body, re.MULTILINE)
-
-        if split_match:
-            main_body = full_body[:split_match.start()].strip()  # Основное письмо без истории переписки
-            history_body = full_body[split_match.start():].strip()  # История переписки
-            self.logger.debug("История переписки обнаружена и разделена.")
-        else:
-            main_body = full_body.strip()
-            history_body = None  # Если нет истории, устанавливаем None
+        offsets = split_offsets(full_body)
+        main_body = full_body[offsets.main_start:offsets.main_end]  # Основное письмо без истории переписки
+        if offsets.history_start is None:
             self.logger.debug("История переписки не обнаружена. Используем основное письмо полностью.")
-
-        return main_body, history_body
+            return main_body, None  # Если нет истории, возвращаем None
+        self.logger.debug(f"История переписки обнаружена и разделена ({offsets.kind}).")
+        return main_body, full_body[offsets.history_start:offsets.history_end]  # История переписки
@@ -21,3 +21,12 @@ class EmailClientBase(ABC):
     def get_messages(self):
         # Опять используем pass, так как реализация будет в дочерних классах.
         pass
+
+    # Быстрое перечисление заголовков писем (тема, отправитель, время, идентификаторы) без открытия писем.
+    # Метод не абстрактный: клиент, который так не умеет, возвращает None, и письма читаются по одному через get_messages.
+    def get_headers(self, since=None):
+        return None
+
+    # Открытие письма по идентификатору, полученному из get_headers (для чтения текста письма).
+    def get_message(self, entry_id):
+        return None
@@ -9,6 +9,12 @@ class EmailMessageProcessor:
         self.body_splitter = EmailBodySplitter()  # Экземпляр класса для разделения тела письма
 
     def process(self, message):
+        # Чтение данных письма и отделение истории переписки
+        email_data = self.read(message)
+        return self.parse(email_data) if email_data else None
+
+    def read(self, message):
+        # Чтение данных письма из Outlook (обращения к COM-объекту; выполняется в потоке, где получено письмо)
         try:
             subject = getattr(message, 'Subject', "Нет темы")  # Получаем тему письма
             full_body = getattr(message, 'Body', "Нет содержимого") or "Нет содержимого"  # Получаем текстовое содержимое письма
@@ -16,21 +22,16 @@ class EmailMessageProcessor:
             received_time = getattr(message, 'ReceivedTime', None)  # Время получения письма
             sender_email = self._get_sender_email(message)  # Получаем адрес отправителя
             attachments = self._get_attachments(message)  # Получаем список вложений
-            
-            # Используем EmailBodySplitter для разделения основного письма и истории переписки
-            main_body, history_body = self.body_splitter.split_body(full_body)
 
             # Формируем словарь с данными письма
-            email_data = {
+            return {
                 'subject': subject,
-                'body': main_body,  # Основное письмо без истории переписки
-                'history_body': history_body,  # Полное письмо с историей переписки
+                'full_body': full_body,  # Полный текст письма (разделяется в parse)
                 'html_body': html_body,
                 'sender': sender_email,
                 'received_time': str(received_time),  # Преобразуем время в строку для сериализации
                 'attachments': attachments
             }
-            return email_data  # Возвращаем данные письма
         except Exception as e:
             # Логируем ошибки и трассировку
             self.logger.error(f"Ошибка при обработке сообщения: {e}")
@@ -38,6 +39,14 @@ class EmailMessageProcessor:
             self.logger.debug(f"Трассировка ошибки:\n{traceback_str}")
             return None
 
+    def parse(self, email_data):
+        # Используем EmailBodySplitter для разделения основного письма и истории переписки (без обращений к COM)
+        main_body, history_body = self.body_splitter.split_body(email_data['full_body'])
+        del email_data['full_body']  # Удаляется после разделения: при ошибке письмо сохраняется с полным текстом
+        email_data['body'] = main_body  # Основное письмо без истории переписки
+        email_data['history_body'] = history_body  # Полное письмо с историей переписки
+        return email_data
+
     def _get_sender_email(self, message):
         # Метод для получения адреса отправителя
         try:
@@ -0,0 +1,191 @@
+# email_client/email_pipeline.py
+
+# Потоковая обработка писем: стадии (разбор, классификация, извлечение) соединены очередями
+# ограниченного размера и выполняются в отдельных потоках. Чтение писем (COM-объекты Outlook)
+# и запись в базу данных (соединение SQLite) выполняются в вызывающем потоке: пока очередь
+# следующей стадии заполнена, вызывающий поток записывает готовые письма пачками, поэтому чтение
+# замедляется до скорости обработки, а в памяти одновременно находится ограниченное число писем.
+
+import logging  # Для логирования
+import queue  # Очереди с ограничением размера
+import threading  # Потоки стадий
+import time  # Для измерения времени
+import traceback  # Для трассировки ошибок
+
+QUEUE_SIZE = 50  # Максимальное количество писем в очереди между стадиями
+PUT_TIMEOUT = 0.1  # Как часто вызывающий поток проверяет готовые письма, пока очередь заполнена, в секундах
+WRITE_BATCH_SIZE = 100  # Писем в одной пачке записи
+WRITE_BATCH_DELAY = 1.0  # Максимальное время ожидания неполной пачки перед записью, в секундах
+
+_STOP = object()  # Признак окончания потока писем
+
+class PipelineStage:
+    """
+    Стадия обработки.
+
+    Параметры:
+        name (str): Название стадии (для статистики и журнала).
+        func: Функция item -> item; None означает, что письмо дальше не передаётся.
+        workers (int): Количество потоков стадии.
+        on_error: Функция item -> item для письма, на котором стадия завершилась ошибкой
+            (например, письмо без результата извлечения); по умолчанию письмо передаётся без изменений.
+    """
+    def __init__(self, name, func, workers=1, on_error=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.on_error = on_error
+
+class EmailPipeline:
+    """
+    Конвейер обработки писем с очередями ограниченного размера между стадиями.
+
+    Параметры:
+        stages (list): Стадии PipelineStage в порядке выполнения.
+        queue_size (int): Размер очереди перед каждой стадией и перед записью.
+        write_batch_size (int): Писем в одной пачке записи.
+        write_batch_delay (float): Максимальное время от первого письма пачки до её записи, в секундах.
+    """
+    def __init__(self, stages, queue_size=QUEUE_SIZE, logger=None, write_batch_size=WRITE_BATCH_SIZE,
+                 write_batch_delay=WRITE_BATCH_DELAY):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.write_batch_size = write_batch_size
+        self.write_batch_delay = write_batch_delay
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+        self.stats = {'read': 0, 'written': 0, 'dropped': 0, 'errors': 0}
+
+    def _worker(self, stage, inbox, outbox, state):
+        # Поток стадии: берёт письмо из входной очереди, обрабатывает и передаёт дальше
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                break
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                # Письмо передаётся дальше без результата стадии, чтобы оно было записано в базу,
+                # а не читалось и не завершалось той же ошибкой при каждом запуске
+                self.logger.error(f"Ошибка на стадии {stage.name}: {e}")
+                self.logger.debug(f"Трассировка ошибки:\n{''.join(traceback.format_tb(e.__traceback__))}")
+                with state['lock']:
+                    self.stats['errors'] += 1
+                try:
+                    result = stage.on_error(item) if stage.on_error else item
+                except Exception as handler_error:
+                    self.logger.error(f"Письмо отброшено на стадии {stage.name}: {handler_error}")
+                    result = None
+            if result is None:
+                with state['lock']:
+                    self.stats['dropped'] += 1
+                continue
+            outbox.put(result)
+        # Последний завершившийся поток стадии передаёт признак окончания следующей стадии
+        with state['lock']:
+            state['running'] -= 1
+            last = state['running'] == 0
+        if last:
+            for _ in range(state['next_workers']):
+                outbox.put(_STOP)
+
+    def run(self, source, sink):
+        """
+        Функция для обработки писем.
+
+        Параметры:
+            source: Итератор писем (выполняется в вызывающем потоке).
+            sink: Функция записи пачки писем (список; выполняется в вызывающем потоке). Пачка записывается,
+                когда в ней набралось write_batch_size писем или прошло write_batch_delay секунд,
+                и в конце обработки.
+
+        Возвращает:
+            dict: Количество прочитанных, записанных, отброшенных писем и ошибок, время и скорость записи.
+        """
+        started = time.perf_counter()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = []
+        for index, stage in enumerate(self.stages):
+            next_workers = self.stages[index + 1].workers if index + 1 < len(self.stages) else 1
+            state = {'lock': threading.Lock(), 'running': stage.workers, 'next_workers': next_workers}
+            for number in range(stage.workers):
+                thread = threading.Thread(target=self._worker, args=(stage, queues[index], queues[index + 1], state),
+                                          name=f"{stage.name}-{number}", daemon=True)
+                thread.start()
+                threads.append(thread)
+        results = queues[-1]
+        finished = False
+        batch = []
+        batch_started = None
+
+        def flush():
+            # Запись накопленной пачки писем
+            nonlocal batch_started
+            if batch:
+                first = self.stats['written'] == 0
+                self._write(sink, list(batch))
+                batch.clear()
+                if first and self.stats['written']:
+                    self.logger.info(f"Первые письма записаны через {time.perf_counter() - started:.1f} с.")
+            batch_started = None
+
+        def drain(block=False):
+            # Собирает готовые письма в пачки и записывает их; возвращает True, когда все стадии завершены
+            nonlocal batch_started
+            while True:
+                if batch_started is not None and time.perf_counter() - batch_started >= self.write_batch_delay:
+                    flush()
+                # Блокирующее ожидание не дольше срока записи неполной пачки
+                timeout = None if batch_started is None else max(
+                    0.0, batch_started + self.write_batch_delay - time.perf_counter())
+                try:
+                    item = results.get(block=block, timeout=timeout if block else None)
+                except queue.Empty:
+                    if block:
+                        continue
+                    return False
+                if item is _STOP:
+                    flush()
+                    return True
+                batch.append(item)
+                if batch_started is None:
+                    batch_started = time.perf_counter()
+                if len(batch) >= self.write_batch_size:
+                    flush()
+
+        def put(target, item):
+            # Ожидание места в очереди; тем временем записываются готовые письма
+            nonlocal finished
+            while True:
+                try:
+                    target.put(item, timeout=PUT_TIMEOUT)
+                    return
+                except queue.Full:
+                    finished = drain() or finished
+
+        try:
+            for item in source:
+                self.stats['read'] += 1
+                put(queues[0], item)
+                finished = drain() or finished
+        finally:
+            for _ in range(self.stages[0].workers if self.stages else 1):
+                put(queues[0], _STOP)
+            while not finished:
+                finished = drain(block=True)
+            flush()
+            for thread in threads:
+                thread.join()
+
+        elapsed = time.perf_counter() - started
+        report = dict(self.stats, seconds=elapsed, emails_per_second=self.stats['written'] / elapsed if elapsed else 0.0)
+        self.logger.info(f"Обработка писем завершена: {report}")
+        return report
+
+    def _write(self, sink, items):
+        try:
+            sink(items)
+            self.stats['written'] += len(items)
+        except Exception as e:
+            self.logger.error(f"Ошибка при записи {len(items)} писем: {e}")
+            self.logger.debug(f"Трассировка ошибки:\n{''.join(traceback.format_tb(e.__traceback__))}")
+            self.stats['errors'] += len(items)
@@ -6,15 +6,32 @@
 
 import json  # Библиотека для работы с форматом JSON
 import os  # Библиотека для работы с операционной системой (например, для работы с путями файлов)
+import time  # Для измерения скорости перечисления писем
 import traceback  # Библиотека для получения трассировки исключений (ошибок)
 from email_client.email_client_base import EmailClientBase  # Импортируем базовый класс для клиента почты
 import logging  # Библиотека для логирования
 from database_manager import DatabaseManager  # Импортируем менеджер базы данных
 from email_client.email_message_processor import EmailMessageProcessor  # Импортируем EmailMessageProcessor
+from email_client.email_pipeline import EmailPipeline, PipelineStage, QUEUE_SIZE  # Потоковая обработка писем
+from fast_extractor import get_default_fast_extractor  # Извлечение данных о перевозке по правилам
+from mail_classifier import check_rules  # Правила фильтра по теме и отправителю (без текста письма)
+
+CLASSIFY_WORKERS = 4  # Количество потоков присвоения меток (ожидание ответа модели)
+
+def extract_transportation_info(email_data):
+    # Стадия извлечения: данные о перевозке по правилам (None, если письмо нужно обработать моделью)
+    email_data['transportation_info'] = get_default_fast_extractor().extract(email_data.get('body'))
+    return email_data
+
+def _unparsed(email_data):
+    # Письмо, которое не удалось разделить: полный текст сохраняется как основное письмо
+    email_data = dict(email_data)
+    email_data['body'] = email_data.pop('full_body', None)
+    return email_data
 
 # Определение класса EmailReader
 class EmailReader:
-    def __init__(self, email_client: EmailClientBase, db_manager, tags_manager, tag_processor):
+    def __init__(self, email_client: EmailClientBase, db_manager: DatabaseManager, tags_manager, tag_processor):
         # Инициализация класса EmailReader с необходимыми зависимостями
         self.email_client = email_client  # Клиент для работы с электронной почтой (например, Outlook)
         self.db_manager = db_manager  # Менеджер базы данных для сохранения данных писем
@@ -23,41 +40,162 @@ class EmailReader:
         self.tag_processor = tag_processor  # Обработчик меток для автоматического присвоения меток письмам
         self.message_processor = EmailMessageProcessor(self.logger)  # Создаем экземпляр для обработки сообщений
 
-    def fetch_emails(self, existing_entryids=set(), limit=None):
-        emails = []
+    def fetch_emails(self, existing_entryids=None, limit=None):
+        # Список писем (для совместимости); для большого ящика используйте iter_emails или run_pipeline
+        return list(self.iter_emails(existing_entryids, limit))
+
+    def iter_emails(self, existing_entryids=None, limit=None, parse=True):
+        """
+        Генератор новых писем от новых к старым: письма передаются по одному, а не собираются в список.
+
+        Параметры:
+            existing_entryids (set): Идентификаторы писем, которые уже есть в базе данных.
+            limit (int): Максимальное количество писем или None.
+            parse (bool): Отделять историю переписки сразу (False - только чтение из Outlook, см. run_pipeline).
+        """
+        existing_entryids = existing_entryids if existing_entryids is not None else set()
+        count = 0
         try:
+            headers = self.email_client.get_headers()
+            if headers is not None:
+                # Быстрый путь: заголовки одной таблицей, письма открываются только после проверок
+                yield from self._iter_emails_from_headers(headers, existing_entryids, limit, parse)
+                return
             messages = self.email_client.get_messages()
-            if messages is not None:
-                messages.Sort("[ReceivedTime]", True)
-                for message in messages:
-                    if message.Class == 43:  # MailItem
-                        # Получаем стабильный уникальный идентификатор письма
-                        entryid = self._get_unique_id(message)
-
-                        if entryid is None:
-                            self.logger.warning("Письмо без Internet Message ID пропущено.")
-                            continue
-
-                        self.logger.debug(f"Обработка сообщения с entryid: {entryid}")
-
-                        if entryid in existing_entryids:
-                            self.logger.debug(f"Письмо с entryid {entryid} уже существует в базе данных.")
-                            continue
-
-                        email_data = self._process_message(message)
-                        if email_data:
-                            email_data['entryid'] = entryid
-                            emails.append(email_data)
-
-                    if limit and len(emails) >= limit:
-                        break
-            else:
+            if messages is None:
                 self.logger.warning("Не удалось получить письма.")
+                return
+            messages.Sort("[ReceivedTime]", True)
+            for message in messages:
+                if limit and count >= limit:
+                    break
+                if message.Class != 43:  # MailItem
+                    continue
+                # Получаем стабильный уникальный идентификатор письма
+                entryid = self._get_unique_id(message)
+
+                if entryid is None:
+                    self.logger.warning("Письмо без Internet Message ID пропущено.")
+                    continue
+
+                self.logger.debug(f"Обработка сообщения с entryid: {entryid}")
+
+                if entryid in existing_entryids:
+                    self.logger.debug(f"Письмо с entryid {entryid} уже существует в базе данных.")
+                    continue
+
+                email_data = self._process_message(message) if parse else self.message_processor.read(message)
+                if email_data:
+                    email_data['entryid'] = entryid
+                    count += 1
+                    yield email_data
         except Exception as e:
             self.logger.error(f"Ошибка при чтении писем: {e}")
             traceback_str = ''.join(traceback.format_tb(e.__traceback__))
             self.logger.debug(f"Трассировка ошибки:\n{traceback_str}")
-        return emails
+
+    def _iter_emails_from_headers(self, headers, existing_entryids, limit, parse):
+        # Письма по заголовкам из get_headers: повторы и письма, отброшенные правилами фильтра,
+        # отсеиваются без открытия письма; текст читается только у оставшихся
+        stats = {'headers': 0, 'existing': 0, 'filtered': 0, 'opened': 0}
+        started = time.perf_counter()
+        try:
+            for header in headers:
+                if limit and stats['opened'] >= limit:
+                    break
+                stats['headers'] += 1
+                if not (header.message_class or "").startswith("IPM.Note"):  # MailItem
+                    continue
+                entryid = header.internet_message_id
+                if not entryid:
+                    self.logger.warning("Письмо без Internet Message ID пропущено.")
+                    continue
+                if entryid in existing_entryids:
+                    stats['existing'] += 1
+                    continue
+                sender = " ".join(filter(None, [header.sender_name, header.sender_email]))
+                decision = check_rules(header.subject, sender)
+                if decision is not None and not decision.relevant:
+                    stats['filtered'] += 1
+                    self.logger.debug(f"Письмо {entryid} отброшено по заголовкам ({decision.reason}).")
+                    continue
+                message = self.email_client.get_message(header.entry_id)
+                if message is None:
+                    continue
+                stats['opened'] += 1
+                email_data = self._process_message(message) if parse else self.message_processor.read(message)
+                if email_data:
+                    email_data['entryid'] = entryid
+                    yield email_data
+        finally:
+            elapsed = time.perf_counter() - started
+            stats['headers_per_second'] = stats['headers'] / elapsed if elapsed else 0.0
+            self.logger.info(f"Перечисление писем по заголовкам: {stats}")
+
+    def compare_enumeration_speed(self, limit=500):
+        """
+        Сравнение скорости перечисления писем: по одному письму (отдельное обращение к COM за каждым свойством)
+        и через get_headers (Folder.GetTable). Читаются одни и те же заголовки первых limit писем.
+
+        Возвращает:
+            dict: Писем в секунду для каждого способа и ускорение.
+        """
+        def items_per_second(rows):
+            started = time.perf_counter()
+            count = 0
+            for _ in rows:
+                count += 1
+                if count >= limit:
+                    break
+            elapsed = time.perf_counter() - started
+            return count / elapsed if elapsed else 0.0
+
+        def per_item_rows():
+            messages = self.email_client.get_messages()
+            messages.Sort("[ReceivedTime]", True)
+            for message in messages:
+                yield (message.Class, self._get_unique_id(message), message.Subject,
+                       self._get_sender_email(message), message.ReceivedTime)
+
+        report = {'per_item': items_per_second(per_item_rows())}
+        headers = self.email_client.get_headers()
+        report['table'] = items_per_second(headers) if headers is not None else None
+        report['speedup'] = report['table'] / report['per_item'] if report['table'] and report['per_item'] else None
+        self.logger.info(f"Скорость перечисления писем (писем в секунду): {report}")
+        return report
+
+    def run_pipeline(self, limit=None, extract=extract_transportation_info, classify_workers=CLASSIFY_WORKERS,
+                     queue_size=QUEUE_SIZE):
+        """
+        Потоковая загрузка новых писем: чтение -> разбор -> присвоение меток -> извлечение -> запись.
+        Первые письма записываются в базу, пока остальные ещё читаются из Outlook,
+        а в памяти одновременно находится не больше queue_size писем на каждую стадию.
+
+        Параметры:
+            limit (int): Максимальное количество писем или None.
+            extract: Функция извлечения данных из письма (None - стадия не выполняется).
+            classify_workers (int): Количество потоков присвоения меток (запросы к модели).
+            queue_size (int): Размер очереди между стадиями.
+
+        Возвращает:
+            dict: Статистика обработки (см. EmailPipeline.run).
+        """
+        existing_entryids = self.load_existing_emails()
+        # Категории загружаются один раз в этом потоке: соединение с базой данных нельзя использовать в потоках стадий
+        categories_and_tags = self.tags_manager.get_categories_and_tags()
+        # При ошибке стадии письмо записывается без её результата: без разделения на историю переписки,
+        # без меток или без извлечённых данных
+        stages = [
+            PipelineStage("parse", self.message_processor.parse, on_error=_unparsed),
+            PipelineStage("classify", lambda email_data: self.assign_tags(email_data, categories_and_tags),
+                          workers=classify_workers),
+        ]
+        if extract is not None:
+            stages.append(PipelineStage("extract", extract,
+                                        on_error=lambda email_data: dict(email_data, transportation_info=None)))
+        pipeline = EmailPipeline(stages, queue_size=queue_size, logger=self.logger)
+        # Письма и метки записываются пачками (DatabaseManager.save_emails / save_tags)
+        return pipeline.run(self.iter_emails(existing_entryids, limit, parse=False), self.save_emails)
 
     def _get_unique_id(self, message):
         try:
@@ -126,16 +264,21 @@ class EmailReader:
         return existing_entryids
 
     def save_emails(self, emails):
-        # Метод для сохранения писем в базу данных
-        for email_data in emails:  # Перебираем каждое письмо
-            email_id = self.db_manager.save_email(email_data)  # Сохраняем письмо и получаем его идентификатор
-            if 'tags' in email_data:
-                self.db_manager.save_tags(email_id, email_data['tags'])  # Сохраняем метки письма, если они есть
+        # Метод для сохранения писем в базу данных: письма и метки записываются пачками
+        email_ids = self.db_manager.save_emails(emails)  # ID писем (None - письмо уже было в базе)
+        self.db_manager.save_tags([(email_id, email_data['tags'])
+                                   for email_id, email_data in zip(email_ids, emails) if 'tags' in email_data])
+        return email_ids
+
+    def save_email(self, email_data):
+        # Сохраняем письмо и его метки, если они есть
+        return self.save_emails([email_data])[0]
 
-    def assign_tags(self, email_data):
+    def assign_tags(self, email_data, categories_and_tags=None):
         # Метод для присвоения меток письму
         try:
-            categories_and_tags = self.tags_manager.get_categories_and_tags()  # Получаем текущие категории и метки
+            if categories_and_tags is None:
+                categories_and_tags = self.tags_manager.get_categories_and_tags()  # Получаем текущие категории и метки
             tags = self.tag_processor.assign_tags(email_data, categories_and_tags)  # Присваиваем метки письму на основе данных
             email_data['tags'] = tags  # Сохраняем присвоенные метки в данные письма
             return email_data
@@ -2,9 +2,19 @@
 
 import win32com.client  # Библиотека для работы с COM-объектами Windows (Outlook)
 from .email_client_base import EmailClientBase
-from datetime import datetime, timedelta
+from outlook_sync import dasl_received_filter  # Фильтр Items.Restrict по времени получения
+from collections import namedtuple
 import logging  # Импортируем модуль для логирования
 
+PR_INTERNET_MESSAGE_ID = "http://schemas.microsoft.com/mapi/proptag/0x1035001E"  # Internet Message ID письма
+# Столбцы Folder.GetTable: все значения строки возвращаются одним обращением к Outlook вместо отдельного
+# обращения к COM-объекту за каждым свойством каждого письма
+HEADER_COLUMNS = ["EntryID", PR_INTERNET_MESSAGE_ID, "Subject", "SenderEmailAddress", "SenderName",
+                  "ReceivedTime", "MessageClass"]
+
+MessageHeader = namedtuple("MessageHeader", ["entry_id", "internet_message_id", "subject", "sender_email",
+                                             "sender_name", "received_time", "message_class"])
+
 # Определение класса OutlookClient, который наследуется от EmailClientBase
 class OutlookClient(EmailClientBase):
     def __init__(self):
@@ -28,31 +38,17 @@ class OutlookClient(EmailClientBase):
             self.outlook = None
             self.inbox = None
 
-    def get_messages(self):
-        # Метод для получения писем из папки "Входящие"
+    def get_messages(self, since=None):
+        # Метод для получения писем из папки "Входящие"; since - время получения, с которого нужны письма
         try:
             if self.inbox is not None:
-                # Получаем текущую дату и время, а также дату неделю назад
-                last_week = datetime.now() - timedelta(days=7)
-                today = datetime.now()
-                # Преобразуем дату в строку для использования в запросе к Outlook
-                last_week_str = last_week.strftime('%m/%d/%Y')
-                today_str = today.strftime('%m/%d/%Y %H:%M')
-                self.logger.debug(f"Фильтрация сообщений с {last_week_str} по {today_str}")
-
-                # Временно убираем фильтрацию по дате и проверяем количество всех сообщений
-                all_messages = self.inbox.Items
-                self.logger.info(f"Всего сообщений в папке 'Входящие': {len(all_messages)}")
-
-                # Если хотите, чтобы фильтрация заработала снова, закомментируйте следующую строку и раскомментируйте фильтр ниже
-                return all_messages  # Возвращаем все сообщения временно для проверки
-
-                # Восстановите фильтрацию, если всё заработает:
-                # messages = self.inbox.Items.Restrict(
-                #     f"[ReceivedTime] >= '{last_week_str}' AND [ReceivedTime] <= '{today_str}'"
-                # )
-                # self.logger.info(f"Получено сообщений: {len(messages)}")
-                # return messages
+                messages = self.inbox.Items
+                self.logger.info(f"Всего сообщений в папке 'Входящие': {messages.Count}")
+                if since:
+                    # Outlook отбирает письма сам, без перечисления всей папки
+                    messages = messages.Restrict(dasl_received_filter(since))
+                    self.logger.info(f"Получено сообщений с {since}: {messages.Count}")
+                return messages
             else:
                 # Если папка "Входящие" не найдена, логируем предупреждение и возвращаем None
                 self.logger.warning("Папка 'Входящие' не найдена.")
@@ -61,3 +57,28 @@ class OutlookClient(EmailClientBase):
             # Обрабатываем ошибку при получении писем и логируем её
             self.logger.error(f"Ошибка при получении писем: {e}")
             return None
+
+    def get_headers(self, since=None):
+        # Генератор заголовков писем папки "Входящие" от новых к старым через Folder.GetTable (без открытия писем)
+        if self.inbox is None:
+            self.logger.warning("Папка 'Входящие' не найдена.")
+            return None
+        table = self.inbox.GetTable(dasl_received_filter(since) if since else "", 0)  # 0 - olUserItems
+        table.Columns.RemoveAll()
+        for column in HEADER_COLUMNS:
+            table.Columns.Add(column)
+        table.Sort("[ReceivedTime]", True)
+        return self._iter_table(table)
+
+    def _iter_table(self, table):
+        while not table.EndOfTable:
+            row = table.GetNextRow()
+            yield MessageHeader(*row.GetValues())
+
+    def get_message(self, entry_id):
+        # Открываем письмо по EntryID (только для писем, текст которых действительно нужен)
+        try:
+            return self.outlook.GetItemFromID(entry_id)
+        except Exception as e:
+            self.logger.error(f"Ошибка при открытии письма {entry_id}: {e}")
+            return None
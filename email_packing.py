@@ -0,0 +1,208 @@
+import json
+import logging
+from openai_connection import get_openai_client
+from email_body_splitter import EmailBodySplitter
+from email_processor import (
+    setup_logging, pending_emails_for_extraction, extract_transportation_info, ingest_extraction,
+    EXTRACTION_MODEL, EXTRACTION_TEMPERATURE, SYSTEM_PROMPT, build_extraction_prompt, extraction_request_options
+)
+from extraction_schema import PACKED_FUNCTION_NAME, packed_request_options, parse_packed_answer
+from llm_cache import cached_chat_completion
+from mail_classifier import load_classifier
+from body_trimmer import count_tokens
+from api_resilience import TransientAPIError
+from database_connection import setup_database
+from retry_queue import enqueue_retry
+
+# Упаковка нескольких коротких писем в один запрос.
+# Постоянная часть запроса (инструкция и JSON-схема) оплачивается один раз на группу писем,
+# модель возвращает результаты по идентификаторам писем. Если ответ не прошёл проверку,
+# письма без корректного результата обрабатываются отдельными запросами.
+
+SHORT_EMAIL_TOKENS = 200  # Письма длиннее этого порога отправляются по одному
+PACK_TOKEN_BUDGET = 1500  # Максимальный суммарный объём писем в одном запросе
+MAX_PACK_SIZE = 10  # Максимальное количество писем в одном запросе
+ANSWER_TOKENS_PER_EMAIL = 150  # Запас выходных токенов на одно письмо
+
+logger = logging.getLogger("EmailPacking")
+
+def estimate_tokens(text):
+    # Количество токенов по локальному токенизатору
+    return count_tokens(text)
+
+def estimate_request_tokens(prompt, options):
+    # Оценка входных токенов запроса: системный промпт, текст запроса и JSON-схема функции
+    return estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(prompt) + estimate_tokens(json.dumps(options, ensure_ascii=False))
+
+def pack_emails(items, token_budget=PACK_TOKEN_BUDGET, max_pack_size=MAX_PACK_SIZE, short_threshold=SHORT_EMAIL_TOKENS):
+    """
+    Функция для разбиения писем на группы.
+
+    Параметры:
+        items: Список пар (id письма, текст).
+
+    Возвращает:
+        tuple: (список групп коротких писем, список длинных писем для отдельной обработки).
+    """
+    packs, singles = [], []
+    current, current_tokens = [], 0
+    for email_id, body in items:
+        tokens = estimate_tokens(body)
+        if tokens > short_threshold:
+            singles.append((email_id, body))
+            continue
+        if current and (current_tokens + tokens > token_budget or len(current) >= max_pack_size):
+            packs.append(current)
+            current, current_tokens = [], 0
+        current.append((email_id, body))
+        current_tokens += tokens
+    if current:
+        packs.append(current)
+    return packs, singles
+
+def build_packed_prompt(pack):
+    # Формируем запрос для группы писем; каждое письмо помечено своим идентификатором
+    emails = "\n\n".join(f'Письмо id={email_id}:\n"""\n{body}\n"""' for email_id, body in pack)
+    return f"""
+Для каждого письма ниже извлеките информацию о перевозке или ценовом предложении и вызовите функцию {PACKED_FUNCTION_NAME}
+с одним элементом items на каждое письмо (id - идентификатор письма). Если письмо не связано с перевозкой, укажите rel=false.
+
+{emails}
+"""
+
+class PackedExtractor:
+    """
+    Извлечение информации из писем с упаковкой коротких писем в общие запросы.
+
+    Параметры:
+        client (OpenAI): Клиент OpenAI.
+    """
+    def __init__(self, client, token_budget=PACK_TOKEN_BUDGET, max_pack_size=MAX_PACK_SIZE,
+                 short_threshold=SHORT_EMAIL_TOKENS):
+        self.client = client
+        self.token_budget = token_budget
+        self.max_pack_size = max_pack_size
+        self.short_threshold = short_threshold
+        self.stats = {'emails': 0, 'packed_emails': 0, 'packs': 0, 'fallback_emails': 0, 'deferred_emails': 0,
+                      'failed_emails': 0, 'baseline_prompt_tokens': 0, 'sent_prompt_tokens': 0}
+
+    def _extract_single(self, email_id, body):
+        # Отдельный запрос для одного письма
+        prompt = build_extraction_prompt(body)
+        self.stats['sent_prompt_tokens'] += estimate_request_tokens(prompt, extraction_request_options())
+        return extract_transportation_info(self.client, body)
+
+    def _extract_pack(self, pack):
+        # Один запрос на группу писем; возвращает {id: dict или None} и список id для повторной обработки
+        prompt = build_packed_prompt(pack)
+        options = packed_request_options()
+        self.stats['sent_prompt_tokens'] += estimate_request_tokens(prompt, options)
+        try:
+            answer, _, _ = cached_chat_completion(
+                self.client, EXTRACTION_MODEL, SYSTEM_PROMPT, prompt, EXTRACTION_TEMPERATURE,
+                ANSWER_TOKENS_PER_EMAIL * len(pack), options=options
+            )
+        except TransientAPIError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при обращении к OpenAI API для группы из {len(pack)} писем: {e}")
+            return {}, [email_id for email_id, _ in pack]
+        results, missing = parse_packed_answer(answer, [email_id for email_id, _ in pack])
+        return {email_id: info.to_dict() if info else None for email_id, info in results.items()}, missing
+
+    def extract(self, items, on_result, on_error=None):
+        """
+        Функция для извлечения информации из набора писем.
+
+        Параметры:
+            items: Список пар (id письма, текст).
+            on_result: Функция (id, dict или None), вызывается для каждого письма.
+            on_error: Функция (id, exception) для писем, запрос по которым завершился постоянной ошибкой, или None.
+
+        Возвращает:
+            dict: Статистика, включая снижение количества входных токенов на письмо.
+        """
+        items = list(items)
+        self.stats['emails'] += len(items)
+        for _, body in items:
+            self.stats['baseline_prompt_tokens'] += estimate_request_tokens(build_extraction_prompt(body),
+                                                                            extraction_request_options())
+
+        packs, singles = pack_emails(items, self.token_budget, self.max_pack_size, self.short_threshold)
+        bodies = dict(items)
+        for pack in packs:
+            if len(pack) == 1:
+                singles.extend(pack)
+                continue
+            self.stats['packs'] += 1
+            self.stats['packed_emails'] += len(pack)
+            try:
+                results, missing = self._extract_pack(pack)
+            except TransientAPIError as e:
+                # Письма остаются необработанными и попадут в следующий запуск
+                logger.error(f"Группа из {len(pack)} писем отложена из-за временной ошибки API: {e}")
+                self.stats['deferred_emails'] += len(pack)
+                continue
+            for email_id, data in results.items():
+                on_result(email_id, data)
+            if missing:
+                # Ответ не прошёл проверку для части писем: обрабатываем их по одному
+                logger.warning(f"Группа из {len(pack)} писем: нет корректного результата для {missing}. Повтор по одному.")
+                self.stats['fallback_emails'] += len(missing)
+                singles.extend((email_id, bodies[email_id]) for email_id in missing)
+
+        for email_id, body in singles:
+            try:
+                on_result(email_id, self._extract_single(email_id, body))
+            except TransientAPIError as e:
+                logger.error(f"Письмо ID {email_id} отложено из-за временной ошибки API: {e}")
+                self.stats['deferred_emails'] += 1
+            except Exception as e:
+                logger.error(f"Письмо ID {email_id}: Ошибка при обращении к OpenAI API: {e}")
+                self.stats['failed_emails'] += 1
+                if on_error:
+                    on_error(email_id, e)
+
+        return self.report()
+
+    def report(self):
+        # Отчёт о снижении количества входных токенов на письмо
+        emails = self.stats['emails'] or 1
+        baseline = self.stats['baseline_prompt_tokens'] / emails
+        sent = self.stats['sent_prompt_tokens'] / emails
+        report = dict(self.stats, baseline_tokens_per_email=baseline, tokens_per_email=sent,
+                      reduction=1 - sent / baseline if baseline else 0.0)
+        logger.info(f"Упаковка писем: {report}")
+        return report
+
+def extract_pending_emails_packed(db_path="emails.db"):
+    # Обрабатывает письма из базы данных с processed = 0, упаковывая короткие письма в общие запросы
+    client = get_openai_client()
+    if not client:
+        logger.error("Не удалось получить клиент OpenAI.")
+        return None
+
+    conn, cursor = setup_database(db_path)
+    splitter = EmailBodySplitter(logger=logger)
+    pending = pending_emails_for_extraction(conn, splitter, load_classifier())
+
+    def on_result(email_id, transportation_info):
+        if ingest_extraction(cursor, email_id, transportation_info):
+            logger.info(f"Письмо из базы данных с ID {email_id} обработано и обновлено.")
+        else:
+            logger.info(f"Письмо из базы данных с ID {email_id} не содержит котировку или запрос на перевозку.")
+        conn.commit()
+
+    def on_error(email_id, error):
+        # Письмо не помечается обработанным, а ставится в очередь повторов
+        enqueue_retry(cursor, "extract", email_id, error)
+        conn.commit()
+
+    try:
+        return PackedExtractor(client).extract(pending, on_result, on_error)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    setup_logging()
+    extract_pending_emails_packed()
@@ -1,8 +1,22 @@
+import json
 import logging
 from openai_connection import get_openai_client
-from outlook_connection import get_outlook_messages
+from outlook_connection import get_outlook_inbox
 from email_body_splitter import EmailBodySplitter
 from database_connection import setup_database, insert_email, email_exists_in_db, get_emails_from_db
+from llm_cache import cached_chat_completion, get_default_cache
+from mail_classifier import load_classifier, get_message_headers
+from extraction_schema import FUNCTION_NAME, request_options, parse_structured_answer
+from body_trimmer import BodyTrimmer
+from api_resilience import TransientAPIError
+from retry_queue import enqueue_retry, clear_retry, deferred_email_ids
+from fast_extractor import get_default_fast_extractor
+from thread_index import ThreadIndex, thread_key
+from similarity_index import get_default_similarity_index
+from boilerplate_learner import BoilerplateLearner
+from outlook_sync import SyncWatermark, folder_key, received_time_str
+from price_parser import save_price_components
+from body_store import load_body
 
 # Импортируем модуль logging для ведения журнала событий
 # Импортируем функции для подключения к OpenAI и Outlook
@@ -33,25 +47,38 @@ def refers_to_thread(main_body):
             return True
     return False  # Иначе возвращаем False
 
-def extract_transportation_info(client, body):
-    # Функция для извлечения информации о перевозке из текста письма с помощью OpenAI
-    logger = logging.getLogger("EmailProcessor")  # Получаем логгер
-    try:
-        # Формируем запрос (prompt) для модели OpenAI
-        prompt = f"""
+EXTRACTION_MODEL = "gpt-3.5-turbo"  # Модель для извлечения информации
+EXTRACTION_TEMPERATURE = 0.2  # Температура для генерации (степень случайности)
+EXTRACTION_MAX_TOKENS = 500  # Максимальное количество токенов в ответе
+SYSTEM_PROMPT = "Вы полезный помощник."
+STRUCTURED_OUTPUT = True  # Ответ в виде вызова функции с JSON-схемой вместо текста "Ключ: значение"
+
+def format_examples(examples):
+    # Похожие ранее обработанные письма и результаты их анализа для добавления в запрос
+    if not examples:
+        return ""
+    parts = ["Примеры ранее обработанных похожих писем:"]
+    for text, info in examples:
+        parts.append(f'Письмо:\n"""\n{text}\n"""\nРезультат: {json.dumps(info, ensure_ascii=False)}')
+    return "\n\n".join(parts) + "\n"
+
+def build_extraction_prompt(body, examples=None):
+    # Формируем запрос (prompt) для модели OpenAI; examples - пары (текст, результат) похожих писем
+    if STRUCTURED_OUTPUT:
+        # Поля и их описания передаются в JSON-схеме функции, поэтому запрос короткий
+        return f"""
+Извлеките информацию о перевозке или ценовом предложении из письма и вызовите функцию {FUNCTION_NAME}.
+Если письмо не связано с перевозкой, укажите rel=false.
+{format_examples(examples)}
+Письмо:
+\"\"\"
+{body}
+\"\"\"
+"""
+    return f"""
 Вы помощник, который извлекает информацию из писем, связанных с перевозками и ценовыми предложениями, для дальнейшего анализа.
-Пожалуйста, прочитайте следующее письмо и извлеките информацию о перевозке, сосредоточившись на ключевых деталях, таких как:
-
-- Место отправления
-- Место назначения
-- Детали груза
-- Тип письма (запрос на перевозку или ответ на запрос или другое)
-- Тип запроса
-- Тип транспортировки
-- Даты
-- Цена
-- Дополнительная информация
-
+Пожалуйста, прочитайте следующее письмо и извлеките информацию о перевозке.
+{format_examples(examples)}
 Письмо:
 \"\"\"
 {body}
@@ -59,12 +86,11 @@ def extract_transportation_info(client, body):
 
 Пожалуйста, предоставьте извлеченную информацию в следующем формате:
 
-Тип письма:
+Тип письма: (запрос на перевозку или ответ на запрос или другое)
 Место отправления:
 Место назначения:
 Детали груза:
-Тип письма:
-Тип запроса: 
+Тип запроса:
 Тип транспортировки:
 Даты:
 Цена:
@@ -73,42 +99,243 @@ def extract_transportation_info(client, body):
 Если письмо не связано с перевозкой или вы не можете извлечь достаточную информацию, ответьте "Нет информации о перевозке".
 """
 
-        # Отправляем запрос в OpenAI API и получаем ответ
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",  # Указываем модель
-            messages=[
-                {"role": "system", "content": "Вы полезный помощник."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2,  # Температура для генерации (степень случайности)
-            max_tokens=500,  # Максимальное количество токенов в ответе
+def extraction_request_options():
+    # Дополнительные параметры запроса для структурированного ответа
+    return request_options() if STRUCTURED_OUTPUT else {}
+
+def parse_extraction_answer(answer):
+    # Функция для разбора ответа модели в словарь (JSON или резервный формат "Ключ: значение")
+    info = parse_structured_answer(answer)
+    if info is None:
+        # Если письмо не связано с перевозкой, возвращаем None
+        return None
+    return info.to_dict()  # Возвращаем словарь с извлеченными данными
+
+def extract_transportation_info(client, body, cache=None, examples=None):
+    # Функция для извлечения информации о перевозке из текста письма с помощью OpenAI
+    logger = logging.getLogger("EmailProcessor")  # Получаем логгер
+    try:
+        prompt = build_extraction_prompt(body, examples)
+
+        # Отправляем запрос в OpenAI API (или берем ответ из кэша) и получаем ответ
+        answer, _, from_cache = cached_chat_completion(
+            client, EXTRACTION_MODEL, SYSTEM_PROMPT, prompt,
+            EXTRACTION_TEMPERATURE, EXTRACTION_MAX_TOKENS, cache=cache,
+            options=extraction_request_options()
         )
-        answer = response.choices[0].message.content.strip()  # Извлекаем ответ из ответа API
-
-        if "Нет информации о перевозке" in answer:
-            # Если в ответе указано, что информации нет, возвращаем None
-            return None
-        else:
-            # Иначе обрабатываем ответ и извлекаем данные
-            lines = answer.split('\n')  # Разбиваем ответ на строки
-            data = {}
-            current_field = ''
-            for line in lines:
-                if ':' in line:
-                    # Если в строке есть двоеточие, считаем это новым полем
-                    key, value = line.split(':', 1)
-                    data[key.strip().lower()] = value.strip()
-                    current_field = key.strip().lower()
-                elif current_field:
-                    # Если продолжается предыдущее поле, добавляем информацию
-                    data[current_field] += ' ' + line.strip()
-
-            return data  # Возвращаем словарь с извлеченными данными
+        if from_cache:
+            logger.debug("Ответ модели взят из кэша.")
+
+        return parse_extraction_answer(answer)
+    except TransientAPIError:
+        # Временная ошибка API: письмо не сохраняется как обработанное и будет обработано при следующем запуске
+        logger.error("Письмо не обработано из-за временной ошибки OpenAI API.")
+        raise
     except Exception as e:
-        # Обрабатываем исключения, если возникли ошибки при обращении к API
+        # Постоянная ошибка (ответ API 400, ошибка разбора) передаётся вызывающему коду: письмо ставится
+        # в очередь повторной обработки, а не сохраняется как обработанное без информации о перевозке
         logger.error(f"Ошибка при обращении к OpenAI API: {e}")
-        logger.exception("Трассировка ошибки:")
-        return None  # Возвращаем None в случае ошибки
+        raise
+
+def extract_with_fast_path(client, body, cache=None, similarity_index=None):
+    # Сначала извлечение по правилам, затем перенос результата с почти полной копии ранее обработанного письма;
+    # модель вызывается, только если оба способа не дали результата, с похожими письмами в качестве примеров
+    transportation_info = get_default_fast_extractor().extract(body)
+    if transportation_info is not None:
+        return transportation_info
+    similarity_index = similarity_index or get_default_similarity_index()
+    match = similarity_index.lookup(body)
+    if match.info is not None:
+        return match.info
+    transportation_info = extract_transportation_info(client, body, cache, match.examples)
+    if transportation_info:
+        similarity_index.add(body, transportation_info)
+    return transportation_info
+
+def select_body_to_analyze(splitter, full_body, trimmer=None, sender=None, boilerplate=None):
+    # Функция для выбора текста, который будет отправлен на анализ
+    logger = logging.getLogger("EmailProcessor")
+    # Разделяем тело письма на основное и историю переписки
+    main_body, history_body = splitter.split_body(full_body)
+    if boilerplate is not None:
+        # Убираем шаблон отправителя (подпись, реквизиты, оговорки)
+        main_body = boilerplate.strip(sender, main_body)
+
+    # Решаем, нужна ли история переписки для анализа
+    include_history = len(main_body) < 50 or refers_to_thread(main_body)
+    if include_history:
+        # Если основное тело короткое или ссылается на переписку, добавляем историю
+        logger.debug("Используем основное письмо вместе с историей для анализа.")
+
+    # Убираем подписи, оговорки и повторяющиеся цитаты, ограничиваем количество токенов
+    trimmer = trimmer or get_default_trimmer(splitter)
+    return trimmer.trim(main_body, history_body if include_history else None)
+
+def select_thread_body_to_analyze(splitter, full_body, thread_index, key, trimmer=None, sender=None, boilerplate=None):
+    """
+    Функция для выбора текста письма из цепочки переписки.
+    Сообщения истории, уже проанализированные в этой цепочке, не отправляются повторно;
+    вместо них к тексту добавляется ранее извлечённый контекст цепочки.
+
+    Параметры:
+        splitter (EmailBodySplitter): Разделитель письма и истории переписки.
+        full_body (str): Полный текст письма.
+        thread_index (ThreadIndex): Индекс цепочек переписки.
+        key (str): Ключ цепочки или None.
+        sender (str): Отправитель письма.
+        boilerplate (BoilerplateLearner): Шаблоны отправителей или None.
+
+    Возвращает:
+        tuple: (текст для анализа, список текстов проанализированных сообщений).
+    """
+    logger = logging.getLogger("EmailProcessor")
+    main_body, history_body, history = thread_index.split_segments(splitter, full_body)
+    unseen = thread_index.unseen_history(key, history)
+
+    include_history = len(main_body) < 50 or refers_to_thread(main_body)
+    if include_history:
+        logger.debug(f"Используем основное письмо и {len(unseen)} из {len(history)} сообщений истории для анализа.")
+    new_history = "\n".join(head + "\n" + body for head, body in unseen) if include_history else None
+
+    trimmer = trimmer or get_default_trimmer(splitter)
+    # Шаблон отправителя убирается только из текста для анализа; хэш сообщения считается по исходному тексту
+    analyzed_body = boilerplate.strip(sender, main_body) if boilerplate is not None else main_body
+    text = trimmer.trim(analyzed_body, new_history or None)
+    context = thread_index.context_text(key) if key else ""
+    if context:
+        text = context + "\n\n" + text
+
+    segments = [main_body] + ([body for _, body in unseen] if include_history else [])
+    return text, segments
+
+_default_trimmer = None
+
+def get_default_trimmer(splitter):
+    # Общий экземпляр BodyTrimmer (накапливает статистику сокращения)
+    global _default_trimmer
+    if _default_trimmer is None:
+        _default_trimmer = BodyTrimmer(splitter)
+    return _default_trimmer
+
+def update_email_with_extraction(cursor, email_id, transportation_info):
+    # Функция для записи извлеченной информации в существующую строку таблицы emails.
+    # Возвращает True, если письмо содержит цену или запрос и было обновлено.
+    price = transportation_info.get('цена', '').strip()
+    query_type = transportation_info.get('тип письма', '').strip().lower()
+
+    if not (price or 'запрос' in query_type):
+        return False
+
+    cursor.execute('''
+        UPDATE emails SET
+            origin = ?,
+            destination = ?,
+            cargo_details = ?,
+            query_type = ?,
+            request_type = ?,
+            transport_type = ?,
+            dates = ?,
+            price = ?,
+            additional_info = ?,
+            processed = 1
+        WHERE id = ?
+    ''', (
+        transportation_info.get('место отправления', ''),
+        transportation_info.get('место назначения', ''),
+        transportation_info.get('детали груза', ''),
+        transportation_info.get('тип письма', ''),
+        transportation_info.get('тип запроса', ''),
+        transportation_info.get('тип транспортировки', ''),
+        transportation_info.get('даты', ''),
+        price,
+        transportation_info.get('дополнительная информация', ''),
+        email_id
+    ))
+    save_price_components(
+        cursor, email_id, price,
+        transportation_info.get('место отправления', ''),
+        transportation_info.get('место назначения', ''),
+        transportation_info.get('детали груза', ''),
+        transportation_info.get('тип транспортировки', '')
+    )
+    return True
+
+def mark_email_filtered(cursor, email_id, decision):
+    # Функция для пометки письма, отброшенного предварительным фильтром
+    cursor.execute(
+        "UPDATE emails SET processed = 1, prefilter_score = ?, prefilter_skipped = 1 WHERE id = ?",
+        (decision.confidence, email_id)
+    )
+
+def ingest_extraction(cursor, email_id, transportation_info):
+    # Функция для записи результата извлечения в письмо из базы данных (общая для обработки по одному,
+    # пакетной, асинхронной и с упаковкой писем). Письмо без котировки или запроса (в том числе rel=false)
+    # помечается обработанным, чтобы не отправляться в модель повторно. Транзакцией управляет вызывающий код.
+    # Возвращает True, если письмо обновлено извлеченной информацией.
+    clear_retry(cursor, "extract", email_id)
+    if transportation_info and update_email_with_extraction(cursor, email_id, transportation_info):
+        return True
+    cursor.execute("UPDATE emails SET processed = 1 WHERE id = ?", (email_id,))
+    return False
+
+def defer_failed_email(cursor, message, entry_id, received_time, error):
+    # Письмо, обработка которого завершилась постоянной ошибкой, сохраняется необработанным (processed = 0)
+    # и ставится в очередь повторной обработки: отметка синхронизации переносится дальше, а письмо
+    # обрабатывается повторно из базы данных с увеличивающейся задержкой (retry_queue).
+    email_id = insert_email(cursor, {
+        'entry_id': entry_id,
+        'subject': getattr(message, 'Subject', ''),
+        'sender': getattr(message, 'SenderName', ''),
+        'received_time': received_time,
+        'body': getattr(message, 'Body', ''),
+        'processed': 0
+    }, commit=False)
+    if email_id is None:
+        row = cursor.execute("SELECT id FROM emails WHERE entry_id = ?", (entry_id,)).fetchone()
+        email_id = row[0] if row else None
+    if email_id is not None:
+        enqueue_retry(cursor, "extract", email_id, error)
+    cursor.connection.commit()
+    return email_id
+
+def pending_emails_for_extraction(conn, splitter, classifier):
+    # Функция для выборки необработанных писем (processed = 0) с применением предварительного фильтра.
+    # Письма из очереди повторной обработки пропускаются до наступления срока повтора.
+    # Отброшенные письма помечаются сразу, письма со стандартными котировками обрабатываются по правилам,
+    # почти полные копии ранее обработанных писем - по их результату;
+    # возвращается список (id, текст для анализа) для отправки в модель.
+    logger = logging.getLogger("EmailProcessor")
+    cursor = conn.cursor()
+    fast_extractor = get_default_fast_extractor()
+    similarity_index = get_default_similarity_index()
+    boilerplate = BoilerplateLearner(conn)
+    deferred = deferred_email_ids(cursor, "extract")  # Срок повтора не наступил или попытки исчерпаны
+    rows = cursor.execute("SELECT id, subject, sender, body_id FROM emails WHERE processed = 0").fetchall()
+    rows = [row for row in rows if row[0] not in deferred]
+    pending = []
+    filtered = resolved = 0
+    for email_id, subject, sender, body_id in rows:
+        body = load_body(cursor, body_id)
+        decision = classifier.classify(subject, sender, body)
+        if not decision.relevant:
+            mark_email_filtered(cursor, email_id, decision)
+            filtered += 1
+            continue
+        body_to_analyze = select_body_to_analyze(splitter, body or "", sender=sender, boilerplate=boilerplate)
+        transportation_info = fast_extractor.extract(body_to_analyze)
+        if transportation_info is None:
+            transportation_info = similarity_index.lookup(body_to_analyze, k=0).info
+        if transportation_info is not None and update_email_with_extraction(cursor, email_id, transportation_info):
+            resolved += 1
+            continue
+        pending.append((email_id, body_to_analyze))
+    conn.commit()
+    logger.info(f"Найдено необработанных писем: {len(rows)}, отброшено фильтром: {filtered}, "
+                f"обработано по правилам и по похожим письмам: {resolved}")
+    fast_extractor.report()
+    similarity_index.report()
+    boilerplate.report()
+    return pending
 
 def process_emails():
     # Главная функция для обработки писем
@@ -122,52 +349,82 @@ def process_emails():
     # Подключаемся к базе данных
     conn, cursor = setup_database()
     splitter = EmailBodySplitter(logger=logger)  # Создаем экземпляр класса для разделения тела письма
+    classifier = load_classifier()  # Предварительный фильтр писем
+    thread_index = ThreadIndex(conn)  # Индекс цепочек переписки
+    boilerplate = BoilerplateLearner(conn)  # Шаблоны отправителей
 
     # Обработка писем из Outlook
-    messages = get_outlook_messages()  # Получаем сообщения из Outlook
-    if not messages:
-        # Если не удалось получить сообщения, логируем ошибку и завершаем функцию
+    inbox = get_outlook_inbox()
+    if inbox is None:
+        # Если не удалось подключиться к Outlook, логируем ошибку и завершаем функцию
         logger.error("Не удалось получить сообщения из Outlook.")
         return
 
-    # Сортируем сообщения по дате получения, от старых к новым
-    messages.Sort("[ReceivedTime]", False)
+    # Перечисляем только письма, полученные после прошлого запуска, от старых к новым
+    watermark = SyncWatermark(conn, folder_key(inbox))
+    messages = watermark.restrict(inbox)
 
     message = messages.GetFirst()  # Получаем первое сообщение
     while message:
+        entry_id = received_time = None
         try:
             if message.Class == 43:  # Проверяем, является ли элемент почтовым сообщением
                 entry_id = message.EntryID  # Получаем уникальный идентификатор письма
+                received_time = received_time_str(message)  # Время получения
+
+                # Письма старше отметки синхронизации уже обработаны (фильтр Outlook точен до минуты)
+                if not watermark.is_new(received_time, entry_id):
+                    message = messages.GetNext()  # Переходим к следующему сообщению
+                    continue
 
                 # Проверяем, было ли письмо уже обработано (есть ли оно в базе данных)
                 if email_exists_in_db(cursor, entry_id):
                     logger.info(f"Письмо с EntryID {entry_id} уже существует в базе данных. Пропускаем.")
+                    watermark.advance(received_time, entry_id)
                     message = messages.GetNext()  # Переходим к следующему сообщению
                     continue
 
                 # Извлекаем данные письма
                 subject = message.Subject  # Тема письма
                 sender = message.SenderName  # Имя отправителя
-                received_time = message.ReceivedTime.strftime("%Y-%m-%d %H:%M:%S")  # Время получения
+                sender_address = getattr(message, 'SenderEmailAddress', '') or sender  # Адрес для правил фильтра
                 full_body = message.Body  # Полное тело письма
+                headers = get_message_headers(message)  # Заголовки письма
+                key = thread_key(getattr(message, 'ConversationID', None), headers)  # Цепочка переписки
+
+                # Предварительный фильтр: рассылки, автоответы и нерелевантные письма не отправляем в LLM
+                decision = classifier.classify(subject, sender, full_body, headers, sender_address)
+                if not decision.relevant:
+                    insert_email(cursor, {
+                        'entry_id': entry_id,
+                        'subject': subject,
+                        'sender': sender,
+                        'received_time': received_time,
+                        'body': full_body,
+                        'processed': 1,
+                        'conversation_id': key,
+                        'prefilter_score': decision.confidence,
+                        'prefilter_skipped': 1
+                    })
+                    logger.info(f"Письмо от {sender} от {received_time} отброшено фильтром ({decision.reason}, уверенность {decision.confidence:.2f}).")
+                    watermark.advance(received_time, entry_id)
+                    message = messages.GetNext()  # Переходим к следующему сообщению
+                    continue
 
-                # Разделяем тело письма на основное и историю переписки
-                main_body, history_body = splitter.split_body(full_body)
-
-                # Решаем, какое тело использовать для анализа
-                body_to_analyze = main_body
-                if len(main_body) < 50 or refers_to_thread(main_body):
-                    # Если основное тело короткое или ссылается на переписку, добавляем историю
-                    body_to_analyze = main_body + "\n" + (history_body or "")
-                    logger.debug("Используем основное письмо вместе с историей для анализа.")
+                # Выбираем текст для анализа: новая часть письма и ещё не проанализированная история цепочки
+                body_to_analyze, segments = select_thread_body_to_analyze(
+                    splitter, full_body, thread_index, key, sender=sender, boilerplate=boilerplate
+                )
 
-                # Извлекаем информацию о перевозке с помощью OpenAI
-                transportation_info = extract_transportation_info(client, body_to_analyze)
+                # Извлекаем информацию о перевозке по правилам или с помощью OpenAI
+                transportation_info = extract_with_fast_path(client, body_to_analyze)
+                # Пустые поля (маршрут, груз) дополняем контекстом цепочки
+                transportation_info = thread_index.merge_context(key, transportation_info)
 
                 if transportation_info:
                     # Если удалось извлечь информацию, проверяем наличие цены или типа запроса
                     price = transportation_info.get('цена', '').strip()
-                    query_type = transportation_info.get('Тип письма', '').strip().lower()
+                    query_type = transportation_info.get('тип письма', '').strip().lower()
 
                     if price or 'запрос' in query_type:
                         # Если есть цена или указание на запрос, формируем данные для сохранения
@@ -177,8 +434,8 @@ def process_emails():
                             'sender': sender,
                             'received_time': received_time,
                             'body': full_body,
-                            'query_type': transportation_info.get('Тип письма', ''),
-                            'request_type': transportation_info.get('Тип запроса', ''),
+                            'query_type': transportation_info.get('тип письма', ''),
+                            'request_type': transportation_info.get('тип запроса', ''),
                             'origin': transportation_info.get('место отправления', ''),
                             'destination': transportation_info.get('место назначения', ''),
                             'cargo_details': transportation_info.get('детали груза', ''),
@@ -186,11 +443,14 @@ def process_emails():
                             'dates': transportation_info.get('даты', ''),
                             'price': price,
                             'additional_info': transportation_info.get('дополнительная информация', ''),
-                            'processed': 1  # Помечаем как обработанное
+                            'processed': 1,  # Помечаем как обработанное
+                            'conversation_id': key
                         }
-                        insert_email(cursor, email_data)  # Вставляем данные в базу данных
+                        email_id = insert_email(cursor, email_data)  # Вставляем данные в базу данных
+                        thread_index.record(key, email_id, segments, transportation_info)
                         logger.info(f"Письмо от {sender} от {received_time} обработано и сохранено.")
                     else:
+                        thread_index.record(key, None, segments, transportation_info)
                         # Если нет цены или запроса, логируем информацию
                         logger.info(f"Письмо от {sender} от {received_time} не содержит котировку или запрос на перевозку.")
                 else:
@@ -209,91 +469,83 @@ def process_emails():
                             'dates': '',
                             'price': '',
                             'additional_info': '',
-                            'processed': 1  # Помечаем как обработанное
+                            'processed': 1,  # Помечаем как обработанное
+                            'conversation_id': key
                          }
-                insert_email(cursor, email_data)
-                logger.info(f"Письмо от {sender} от {received_time} не содержит информации о перевозке и сохранено в базе данных.")
-  
-               
+                     thread_index.record(key, None, segments, None)
+                     insert_email(cursor, email_data)
+                     logger.info(f"Письмо от {sender} от {received_time} не содержит информации о перевозке и сохранено в базе данных.")
+                watermark.advance(received_time, entry_id)
             else:
                 # Если элемент не является почтовым сообщением, логируем отладочную информацию
                 logger.debug("Пропущен элемент, который не является почтовым сообщением.")
+        except TransientAPIError as e:
+            # Временная ошибка API: отметка не переносится, письмо будет перечислено при следующем запуске
+            logger.error(f"Ошибка при обработке письма: {e}")
+            watermark.mark_failed()
         except Exception as e:
-            # Обрабатываем исключения, возникшие при обработке письма
+            # Постоянная ошибка (ошибка разбора, ответ API 400): письмо откладывается в очередь повторной
+            # обработки, чтобы одно письмо не останавливало синхронизацию всех следующих
             logger.error(f"Ошибка при обработке письма: {e}")
             logger.exception("Трассировка ошибки:")
+            try:
+                if entry_id is None or received_time is None:
+                    raise ValueError("не удалось прочитать EntryID и время получения письма")
+                defer_failed_email(cursor, message, entry_id, received_time, e)
+                watermark.advance(received_time, entry_id)
+            except Exception as defer_error:
+                logger.error(f"Письмо не поставлено в очередь повторной обработки: {defer_error}")
+                watermark.mark_failed()
         message = messages.GetNext()  # Переходим к следующему сообщению
+    watermark.report(inbox.Items.Count)
 
     # Обработка писем из базы данных (повторная обработка необработанных писем)
     emails_from_db = get_emails_from_db(cursor)
+    deferred = deferred_email_ids(cursor, "extract")  # Срок повтора не наступил или попытки исчерпаны
     for email_record in emails_from_db:
+        # Распаковываем данные письма из записи базы данных
+        (id, entry_id, subject, sender, received_time, body_id, query_type,
+         origin, destination, cargo_details, transport_type, dates, price, additional_info, processed) = email_record
         try:
-            # Распаковываем данные письма из записи базы данных
-            (id, entry_id, subject, sender, received_time, body, query_type,
-             origin, destination, cargo_details, transport_type, dates, price, additional_info, processed) = email_record
-
-            # Если письмо уже обработано, пропускаем его
-            if processed:
+            # Если письмо уже обработано или отложено, пропускаем его
+            if processed or id in deferred:
+                continue
+            body = load_body(cursor, body_id)  # Текст письма из хранилища email_bodies
+
+            # Предварительный фильтр: нерелевантные письма не отправляем в LLM
+            decision = classifier.classify(subject, sender, body)
+            if not decision.relevant:
+                mark_email_filtered(cursor, id, decision)
+                conn.commit()
+                logger.info(f"Письмо из базы данных с ID {id} отброшено фильтром ({decision.reason}).")
                 continue
 
-            # Разделяем тело письма на основное и историю переписки
-            main_body, history_body = splitter.split_body(body)
-
-            # Решаем, какое тело использовать для анализа
-            body_to_analyze = main_body
-            if len(main_body) < 50 or refers_to_thread(main_body):
-                # Если основное тело короткое или ссылается на переписку, добавляем историю
-                body_to_analyze = main_body + "\n" + (history_body or "")
-                logger.debug("Используем основное письмо вместе с историей для анализа.")
-
-            # Извлекаем информацию о перевозке с помощью OpenAI
-            transportation_info = extract_transportation_info(client, body_to_analyze)
-
-            if transportation_info:
-                # Если удалось извлечь информацию, проверяем наличие цены или типа запроса
-                price = transportation_info.get('цена', '').strip()
-                query_type = transportation_info.get('Тип письма', '').strip().lower()
-
-                if price or 'запрос' in query_type:
-                    # Если есть цена или указание на запрос или ответ на запрос, обновляем данные письма в базе данных
-                    cursor.execute('''
-                        UPDATE emails SET
-                            origin = ?,
-                            destination = ?,
-                            cargo_details = ?,
-                            query_type = ?,
-                            transport_type = ?,
-                            dates = ?,
-                            price = ?,
-                            additional_info = ?,
-                            processed = 1
-                        WHERE id = ?
-                    ''', (
-                   
-                        transportation_info.get('место отправления', ''),
-                        transportation_info.get('место назначения', ''),
-                        transportation_info.get('детали груза', ''),
-                        transportation_info.get('Тип письма', ''),
-                        transportation_info.get('Тип запроса', ''),
-                        transportation_info.get('тип транспортировки', ''),
-                        transportation_info.get('даты', ''),
-                        price,
-                        transportation_info.get('дополнительная информация', ''),
-                        id
-                    ))
-                    conn.commit()  # Сохраняем изменения в базе данных
-                    logger.info(f"Письмо из базы данных с ID {id} обработано и обновлено.")
-                else:
-                    # Если нет цены или запроса, логируем информацию
-                    logger.info(f"Письмо из базы данных с ID {id} не содержит котировку или запрос на перевозку.")
+            # Выбираем текст для анализа: основное письмо или письмо с историей
+            body_to_analyze = select_body_to_analyze(splitter, body, sender=sender, boilerplate=boilerplate)
+
+            # Извлекаем информацию о перевозке по правилам или с помощью OpenAI
+            transportation_info = extract_with_fast_path(client, body_to_analyze)
+
+            # Обновляем данные письма в базе данных; письмо без цены или запроса больше не отправляется в модель
+            if ingest_extraction(cursor, id, transportation_info):
+                logger.info(f"Письмо из базы данных с ID {id} обработано и обновлено.")
             else:
-                # Если не удалось извлечь информацию о перевозке, логируем информацию
-                logger.info(f"Письмо из базы данных с ID {id} не содержит информации о перевозке.")
+                logger.info(f"Письмо из базы данных с ID {id} не содержит котировку или запрос на перевозку.")
+            conn.commit()  # Сохраняем изменения в базе данных
 
         except Exception as e:
             # Обрабатываем исключения, возникшие при обработке письма из базы данных
             logger.error(f"Ошибка при обработке письма из базы данных: {e}")
             logger.exception("Трассировка ошибки:")
+            enqueue_retry(cursor, "extract", id, e)
+            conn.commit()
+
+    logger.info(f"Статистика кэша ответов: {get_default_cache().stats()}")
+    get_default_trimmer(splitter).report()
+    get_default_fast_extractor().report()
+    get_default_similarity_index().report()
+    boilerplate.report()
+    thread_index.report()
 
     # Закрываем соединение с базой данных после обработки всех писем
     conn.close()
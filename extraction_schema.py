@@ -0,0 +1,257 @@
+import json
+import logging
+from dataclasses import dataclass, fields
+
+# Структурированный ответ модели: функция (function calling) с JSON-схемой и короткими именами полей.
+# Короткие ключи экономят выходные токены, а типизированный объект результата
+# проверяет ответ; для ответов в старом формате "Ключ: значение" есть резервный разборщик.
+
+FUNCTION_NAME = "save_transport_info"
+
+# Короткое имя поля -> (ключ словаря результата, описание для модели)
+FIELDS = {
+    "t": ("тип письма", "тип письма: запрос на перевозку, ответ на запрос или другое"),
+    "o": ("место отправления", "место отправления"),
+    "d": ("место назначения", "место назначения"),
+    "c": ("детали груза", "детали груза"),
+    "rq": ("тип запроса", "тип запроса"),
+    "tr": ("тип транспортировки", "тип транспортировки"),
+    "dt": ("даты", "даты"),
+    "p": ("цена", "цена с валютой"),
+    "x": ("дополнительная информация", "дополнительная информация"),
+}
+
+# Альтернативные написания ключей в текстовых ответах
+KEY_ALIASES = {
+    "тип транспорта": "тип транспортировки",
+    "место загрузки": "место отправления",
+    "место выгрузки": "место назначения",
+}
+
+NO_INFO_ANSWER = "Нет информации о перевозке"
+
+TRANSPORT_INFO_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "rel": {"type": "boolean", "description": "письмо связано с перевозкой"},
+        **{key: {"type": "string", "description": description} for key, (_, description) in FIELDS.items()},
+    },
+    "required": ["rel"] + list(FIELDS),
+    "additionalProperties": False,
+}
+
+TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": FUNCTION_NAME,
+        "description": "Сохранить информацию о перевозке из письма. Неизвестные поля - пустая строка.",
+        "parameters": TRANSPORT_INFO_SCHEMA,
+    },
+}]
+TOOL_CHOICE = {"type": "function", "function": {"name": FUNCTION_NAME}}
+
+# Схема для нескольких писем в одном запросе: массив результатов с идентификаторами писем
+PACKED_FUNCTION_NAME = "save_transport_info_list"
+PACKED_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {"id": {"type": "string", "description": "идентификатор письма"},
+                   **TRANSPORT_INFO_SCHEMA["properties"]},
+    "required": ["id"] + TRANSPORT_INFO_SCHEMA["required"],
+    "additionalProperties": False,
+}
+PACKED_TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": PACKED_FUNCTION_NAME,
+        "description": "Сохранить информацию о перевозке для каждого письма. Неизвестные поля - пустая строка.",
+        "parameters": {
+            "type": "object",
+            "properties": {"items": {"type": "array", "items": PACKED_ITEM_SCHEMA}},
+            "required": ["items"],
+            "additionalProperties": False,
+        },
+    },
+}]
+PACKED_TOOL_CHOICE = {"type": "function", "function": {"name": PACKED_FUNCTION_NAME}}
+
+# Схема для повторного запроса только недостающих полей
+PARTIAL_FUNCTION_NAME = "save_missing_fields"
+FIELD_KEYS = {name: key for key, (name, _) in FIELDS.items()}  # Ключ результата -> короткое имя поля
+
+logger = logging.getLogger("ExtractionSchema")
+
+@dataclass
+class TransportationInfo:
+    # Проверенный результат извлечения
+    letter_type: str = ""
+    origin: str = ""
+    destination: str = ""
+    cargo_details: str = ""
+    request_type: str = ""
+    transport_type: str = ""
+    dates: str = ""
+    price: str = ""
+    additional_info: str = ""
+
+    @classmethod
+    def from_compact(cls, data):
+        # Создаёт объект из словаря с короткими ключами, приводя значения к строкам
+        values = []
+        for key in FIELDS:
+            value = data.get(key)
+            if value is None:
+                value = ""
+            elif not isinstance(value, str):
+                value = json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else str(value)
+            values.append(value.strip())
+        return cls(*values)
+
+    @classmethod
+    def from_dict(cls, data):
+        # Создаёт объект из словаря с русскими ключами (формат "Ключ: значение")
+        return cls(*((data.get(name) or "").strip() for name, _ in FIELDS.values()))
+
+    def to_dict(self):
+        # Словарь с русскими ключами в нижнем регистре, как его ожидает остальной код
+        return {name: getattr(self, field.name) for (name, _), field in zip(FIELDS.values(), fields(self))}
+
+    def to_compact(self):
+        # Словарь с короткими ключами (формат ответа модели)
+        return {key: getattr(self, field.name) for key, field in zip(FIELDS, fields(self))}
+
+def request_options():
+    # Дополнительные параметры запроса chat.completions для структурированного ответа
+    return {"tools": TOOLS, "tool_choice": TOOL_CHOICE}
+
+def packed_request_options():
+    # Параметры запроса для нескольких писем в одном запросе
+    return {"tools": PACKED_TOOLS, "tool_choice": PACKED_TOOL_CHOICE}
+
+def partial_request_options(field_names):
+    # Параметры запроса только для перечисленных полей (ключи результата, например "цена")
+    keys = [FIELD_KEYS[name] for name in field_names]
+    parameters = {
+        "type": "object",
+        "properties": {key: TRANSPORT_INFO_SCHEMA["properties"][key] for key in keys},
+        "required": keys,
+        "additionalProperties": False,
+    }
+    tools = [{
+        "type": "function",
+        "function": {
+            "name": PARTIAL_FUNCTION_NAME,
+            "description": "Сохранить недостающие поля письма. Неизвестные поля - пустая строка.",
+            "parameters": parameters,
+        },
+    }]
+    return {"tools": tools, "tool_choice": {"type": "function", "function": {"name": PARTIAL_FUNCTION_NAME}}}
+
+def response_text(message):
+    # Текст ответа: аргументы вызова функции или обычное содержимое сообщения
+    tool_calls = getattr(message, "tool_calls", None)
+    if tool_calls:
+        return tool_calls[0].function.arguments.strip()
+    return (message.content or "").strip()
+
+def response_text_from_json(message):
+    # То же для сообщения в виде словаря (результаты Batch API)
+    tool_calls = message.get("tool_calls")
+    if tool_calls:
+        return tool_calls[0]["function"]["arguments"].strip()
+    return (message.get("content") or "").strip()
+
+def parse_key_value_answer(answer):
+    # Резервный разбор ответа в формате "Ключ: значение"
+    data = {}
+    current_field = ''
+    for line in answer.split('\n'):
+        if ':' in line:
+            key, value = line.split(':', 1)
+            key = key.strip().strip('-* ').lower()
+            key = KEY_ALIASES.get(key, key)
+            data[key] = value.strip()
+            current_field = key
+        elif current_field:
+            data[current_field] += ' ' + line.strip()
+    return data
+
+def parse_structured_answer(answer):
+    """
+    Функция для разбора ответа модели.
+
+    Параметры:
+        answer (str): JSON с короткими ключами или текст "Ключ: значение".
+
+    Возвращает:
+        TransportationInfo: Результат или None, если письмо не связано с перевозкой.
+    """
+    answer = (answer or "").strip()
+    if NO_INFO_ANSWER.lower() in answer.lower():
+        return None
+    try:
+        data = json.loads(answer)
+    except ValueError:
+        data = None
+
+    if isinstance(data, dict):
+        if not data.get("rel", True):
+            return None
+        return TransportationInfo.from_compact(data)
+
+    logger.debug("Ответ модели не является JSON. Используется разбор формата 'Ключ: значение'.")
+    data = parse_key_value_answer(answer)
+    if not data:
+        return None
+    return TransportationInfo.from_dict(data)
+
+def parse_packed_answer(answer, expected_ids):
+    """
+    Функция для разбора ответа на запрос с несколькими письмами.
+
+    Параметры:
+        answer (str): JSON-аргументы вызова функции.
+        expected_ids: Идентификаторы писем, отправленных в запросе.
+
+    Возвращает:
+        tuple: (словарь {id: TransportationInfo или None}, список id без корректного результата).
+    """
+    expected = {str(email_id): email_id for email_id in expected_ids}
+    try:
+        items = json.loads(answer).get("items")
+    except (ValueError, AttributeError):
+        return {}, list(expected.values())
+    if not isinstance(items, list):
+        return {}, list(expected.values())
+
+    results = {}
+    for item in items:
+        if not isinstance(item, dict) or str(item.get("id")) not in expected:
+            continue
+        email_id = expected[str(item["id"])]
+        if email_id in results or not isinstance(item.get("rel", True), bool):
+            continue
+        results[email_id] = TransportationInfo.from_compact(item) if item.get("rel", True) else None
+    missing = [email_id for email_id in expected.values() if email_id not in results]
+    return results, missing
+
+def parse_partial_answer(answer, field_names):
+    """
+    Функция для разбора ответа на запрос недостающих полей.
+
+    Параметры:
+        answer (str): JSON с короткими ключами или текст "Ключ: значение".
+        field_names: Запрошенные поля (ключи результата).
+
+    Возвращает:
+        dict: Непустые значения запрошенных полей.
+    """
+    answer = (answer or "").strip()
+    try:
+        data = json.loads(answer)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        values = TransportationInfo.from_compact(data).to_dict()
+    else:
+        values = parse_key_value_answer(answer)
+    return {name: (values.get(name) or "").strip() for name in field_names if (values.get(name) or "").strip()}
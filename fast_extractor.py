@@ -0,0 +1,335 @@
+import logging
+import re
+from collections import namedtuple
+from extraction_schema import TransportationInfo
+
+# Детерминированное извлечение по правилам для писем со стандартными котировками
+# ("USD 1,250 / 40'HC", "Shanghai - Almaty", "тент 82м3"). Регулярные выражения и справочники
+# (валюты, типы контейнеров и транспорта, города) компилируются один раз при импорте.
+# Если все обязательные поля найдены однозначно, запрос к модели не выполняется.
+
+MIN_CONFIDENCE = 0.9  # Минимальная уверенность по каждому обязательному полю
+REQUIRED_FIELDS = ("origin", "destination", "price", "transport_type")
+QUOTE_LETTER_TYPE = "ответ на запрос"
+CONTAINER_CATEGORY = "контейнер"  # Тип транспортировки для контейнеров (как в ответах модели)
+TRUCK_CATEGORY = "авто"  # Тип транспортировки для автомобильных перевозок
+
+logger = logging.getLogger("FastExtractor")
+
+# Справочник валют: вариант написания -> код
+CURRENCIES = {
+    "usd": "USD", "$": "USD", "долл": "USD", "доллар": "USD", "dollar": "USD",
+    "eur": "EUR", "€": "EUR", "евро": "EUR", "euro": "EUR",
+    "rub": "RUB", "₽": "RUB", "руб": "RUB", "рубл": "RUB",
+    "cny": "CNY", "rmb": "CNY", "¥": "CNY", "юан": "CNY",
+    "kzt": "KZT", "₸": "KZT", "тенге": "KZT",
+}
+
+# Справочник городов: каноническое название -> варианты написания
+CITIES = {
+    "Москва": ("Москва", "Moscow"),
+    "Санкт-Петербург": ("Санкт-Петербург", "Петербург", "Saint Petersburg", "St. Petersburg", "St Petersburg", "СПб"),
+    "Екатеринбург": ("Екатеринбург", "Yekaterinburg"),
+    "Новосибирск": ("Новосибирск", "Novosibirsk"),
+    "Казань": ("Казань", "Kazan"),
+    "Владивосток": ("Владивосток", "Vladivostok"),
+    "Новороссийск": ("Новороссийск", "Novorossiysk"),
+    "Калининград": ("Калининград", "Kaliningrad"),
+    "Забайкальск": ("Забайкальск", "Zabaikalsk"),
+    "Алматы": ("Алматы", "Алма-Ата", "Almaty"),
+    "Астана": ("Астана", "Astana"),
+    "Хоргос": ("Хоргос", "Khorgos"),
+    "Ташкент": ("Ташкент", "Tashkent"),
+    "Бишкек": ("Бишкек", "Bishkek"),
+    "Минск": ("Минск", "Minsk"),
+    "Брест": ("Брест", "Brest"),
+    "Шанхай": ("Шанхай", "Shanghai"),
+    "Нинбо": ("Нинбо", "Ningbo"),
+    "Циндао": ("Циндао", "Qingdao"),
+    "Шэньчжэнь": ("Шэньчжэнь", "Шеньчжень", "Shenzhen"),
+    "Гуанчжоу": ("Гуанчжоу", "Guangzhou"),
+    "Тяньцзинь": ("Тяньцзинь", "Tianjin"),
+    "Сямынь": ("Сямынь", "Xiamen"),
+    "Иу": ("Иу", "Yiwu"),
+    "Урумчи": ("Урумчи", "Urumqi"),
+    "Пусан": ("Пусан", "Busan"),
+    "Стамбул": ("Стамбул", "Istanbul"),
+    "Мерсин": ("Мерсин", "Mersin"),
+    "Дубай": ("Дубай", "Dubai", "Jebel Ali"),
+    "Гамбург": ("Гамбург", "Hamburg"),
+    "Роттердам": ("Роттердам", "Rotterdam"),
+    "Антверпен": ("Антверпен", "Antwerp"),
+    "Гданьск": ("Гданьск", "Gdansk"),
+    "Рига": ("Рига", "Riga"),
+    "Берлин": ("Берлин", "Berlin"),
+    "Варшава": ("Варшава", "Warsaw"),
+    "Милан": ("Милан", "Milan"),
+}
+
+# Справочник типов автотранспорта: регулярное выражение слова -> каноническое название
+TRUCK_TYPES = {
+    r"тент\w*": "тент", r"tilt": "тент", r"curtain\w*": "тент",
+    r"рефрижератор\w*": "рефрижератор", r"реф": "рефрижератор", r"reefer": "рефрижератор",
+    r"изотерм\w*": "изотерм",
+    r"трал": "трал",
+    r"контейнеровоз\w*": "контейнеровоз",
+    r"бортов\w*": "бортовой",
+    r"мега": "мега", r"mega": "мега",
+}
+
+# Нормализация кодов контейнеров
+CONTAINER_CODES = {"DC": "DC", "GP": "DC", "DV": "DC", "ST": "DC", "HC": "HC", "HQ": "HC",
+                   "RF": "RF", "RH": "RH", "OT": "OT", "FR": "FR", "PW": "PW"}
+
+AMOUNT = r"\d{1,3}(?:[ \u00a0\u202f.,]\d{3})+(?:[.,]\d{1,2})?|\d+(?:[.,]\d{1,2})?"
+CURRENCY = r"\$|€|₽|¥|₸|(?<!\w)(?:usd|eur|rub|cny|rmb|kzt|долл\w*|доллар\w*|dollars?|евро|euros?|руб\w*|рубл\w*|юан\w*|тенге)(?!\w)"
+PRICE_PATTERN = re.compile(
+    rf"(?P<cur1>{CURRENCY})\s*(?P<amount1>{AMOUNT})|(?<![\d.,])(?P<amount2>{AMOUNT})\s*(?P<cur2>{CURRENCY})",
+    re.IGNORECASE
+)
+CONTAINER_PATTERN = re.compile(
+    r"(?<!\d)(20|40|45)\s*(?:'|’|ft|фут\w*)?\s*-?\s*(" + "|".join(CONTAINER_CODES) + r")(?![a-z])",
+    re.IGNORECASE
+)
+TRUCK_NAMES = list(TRUCK_TYPES.values())
+TRUCK_PATTERN = re.compile(
+    r"(?<!\w)(?:" + "|".join(f"(?P<t{index}>{pattern})" for index, pattern in enumerate(TRUCK_TYPES)) + r")(?!\w)",
+    re.IGNORECASE
+)
+WEIGHT_PATTERN = re.compile(r"(?<![\d.,])(\d+(?:[.,]\d+)?)\s*(тонн\w*|тн|т|tons?|tonnes?|t|кг|kg)(?!\w)", re.IGNORECASE)
+VOLUME_PATTERN = re.compile(r"(?<![\d.,])(\d+(?:[.,]\d+)?)\s*(м3|м³|куб\w*|cbm|m3)(?!\w)", re.IGNORECASE)
+ROUTE_SEPARATOR_PATTERN = re.compile(r"\s*(?:->|=>|-|–|—|→|>|/)\s*")
+ROUTE_WORDS_PATTERN = re.compile(r"\s+(?:в|во|до|на|to)\s+", re.IGNORECASE)
+ROUTE_START_PATTERN = re.compile(r"(?:^|\W)(?:из|от|с|from|ex)\s+$", re.IGNORECASE)
+# Признаки запроса: цена в запросе может быть целевой ставкой, такие письма анализирует модель
+REQUEST_PATTERN = re.compile(
+    r"(?i)(запрос|прошу|просим|просьба|нужн[аоы]\s+(?:ставк|цен|машин|перевозк)|рассчита|"
+    r"please\s+(?:quote|advise|offer)|request|rfq|need\s+(?:a\s+)?(?:rate|price|quote))"
+)
+
+def _city_variant_pattern(name):
+    # Для кириллических названий допускаем падежные окончания (Москва -> Москвы, Москве)
+    escaped = re.escape(name)
+    if re.search(r"[а-яё]$", name, re.IGNORECASE):
+        if name[-1].lower() in "аяыьйо":
+            escaped = re.escape(name[:-1])
+        return escaped + r"[а-яё]{0,2}"
+    return escaped
+
+def _build_city_pattern(cities):
+    # Одно регулярное выражение со всеми городами; имя группы - индекс канонического названия
+    groups = []
+    for index, variants in enumerate(cities.values()):
+        alternatives = "|".join(_city_variant_pattern(v) for v in sorted(variants, key=len, reverse=True))
+        groups.append(f"(?P<c{index}>{alternatives})")
+    return re.compile(r"(?<!\w)(?:" + "|".join(groups) + r")(?!\w)", re.IGNORECASE)
+
+CITY_NAMES = list(CITIES)
+CITY_PATTERN = _build_city_pattern(CITIES)
+
+FieldMatch = namedtuple("FieldMatch", ["value", "confidence"])
+
+def parse_amount(text):
+    # "1,250" / "1 250" / "1.250,50" / "1250.5" -> число
+    text = re.sub(r"[\s\u00a0\u202f]", "", text)
+    if "," in text and "." in text:
+        decimal = "," if text.rfind(",") > text.rfind(".") else "."
+        thousands = "." if decimal == "," else ","
+        text = text.replace(thousands, "").replace(decimal, ".")
+    elif "," in text or "." in text:
+        separator = "," if "," in text else "."
+        parts = text.split(separator)
+        if len(parts) > 2 or len(parts[-1]) == 3:
+            text = "".join(parts)  # Разделитель тысяч
+        else:
+            text = ".".join(parts)
+    return float(text)
+
+def format_amount(amount):
+    return str(int(amount)) if amount == int(amount) else f"{amount:.2f}"
+
+def currency_code(text):
+    text = text.lower()
+    for variant, code in CURRENCIES.items():
+        if text.startswith(variant):
+            return code
+    return None
+
+def _single(values):
+    # Однозначное значение поля: уверенность 1.0, если найден ровно один вариант
+    distinct = list(dict.fromkeys(values))
+    if not distinct:
+        return FieldMatch("", 0.0)
+    if len(distinct) == 1:
+        return FieldMatch(distinct[0], 1.0)
+    # Несколько вариантов (маршруты - пары городов): письмо неоднозначно и отправляется в модель
+    text = ", ".join(" - ".join(value) if isinstance(value, tuple) else value for value in distinct)
+    return FieldMatch(text, 1.0 / len(distinct))
+
+def find_price_values(text):
+    # Цены с валютой: список пар (сумма, код валюты)
+    prices = []
+    for match in PRICE_PATTERN.finditer(text):
+        amount = match.group("amount1") or match.group("amount2")
+        code = currency_code(match.group("cur1") or match.group("cur2"))
+        try:
+            value = parse_amount(amount)
+        except ValueError:
+            continue
+        if code and value > 0:
+            prices.append((value, code))
+    return prices
+
+def find_prices(text):
+    return [f"{format_amount(value)} {code}" for value, code in find_price_values(text)]
+
+def find_containers(text):
+    return [f"{size}{CONTAINER_CODES[code.upper()]}" for size, code in CONTAINER_PATTERN.findall(text)]
+
+def find_trucks(text):
+    return [TRUCK_NAMES[int(match.lastgroup[1:])] for match in TRUCK_PATTERN.finditer(text)]
+
+def find_cities(text):
+    # Канонические названия городов из справочника в порядке упоминания
+    return [CITY_NAMES[int(match.lastgroup[1:])] for match in CITY_PATTERN.finditer(text)]
+
+def find_weights(text):
+    return [f"{value.replace(',', '.')} {unit.lower()}" for value, unit in WEIGHT_PATTERN.findall(text)]
+
+def find_volumes(text):
+    return [f"{value.replace(',', '.')} м3" for value, _ in VOLUME_PATTERN.findall(text)]
+
+def find_routes(text):
+    # Пары городов: "Шанхай - Алматы", "Shanghai → Almaty", "из Москвы в Берлин", "from Ningbo to Riga"
+    cities = [(match.start(), match.end(), CITY_NAMES[int(match.lastgroup[1:])])
+              for match in CITY_PATTERN.finditer(text)]
+    routes = []
+    for (start, end, origin), (next_start, _, destination) in zip(cities, cities[1:]):
+        if origin == destination:
+            continue
+        between = text[end:next_start]
+        if ROUTE_SEPARATOR_PATTERN.fullmatch(between):
+            routes.append((origin, destination))
+        elif ROUTE_WORDS_PATTERN.fullmatch(between) and ROUTE_START_PATTERN.search(text[max(0, start - 6):start]):
+            routes.append((origin, destination))
+    return routes
+
+def analyze(text):
+    """
+    Функция для извлечения полей котировки по правилам.
+
+    Параметры:
+        text (str): Текст письма.
+
+    Возвращает:
+        tuple: (TransportationInfo, словарь {поле: уверенность}).
+    """
+    route = _single(find_routes(text))
+    price = _single(find_prices(text))
+    containers = _single(find_containers(text))
+    trucks = _single(find_trucks(text))
+    transport = containers if containers.value else trucks
+    category = CONTAINER_CATEGORY if containers.value else TRUCK_CATEGORY if trucks.value else ""
+    weight = _single(find_weights(text))
+    volume = _single(find_volumes(text))
+
+    origin, destination = route.value if route.confidence == 1.0 else ("", "")
+    cargo = ", ".join(part for part in (transport.value, volume.value, weight.value) if part)
+    info = TransportationInfo(
+        letter_type=QUOTE_LETTER_TYPE,
+        origin=origin,
+        destination=destination,
+        cargo_details=cargo,  # Код контейнера или тип кузова
+        transport_type=category,
+        price=price.value,
+    )
+    confidence = {
+        "origin": route.confidence if origin else 0.0,
+        "destination": route.confidence if destination else 0.0,
+        "price": price.confidence,
+        "transport_type": transport.confidence,
+    }
+    if REQUEST_PATTERN.search(text):
+        # Похоже на запрос, а не на котировку
+        confidence = {field: 0.0 for field in confidence}
+    return info, confidence
+
+class FastPathExtractor:
+    """
+    Извлечение по правилам перед обращением к модели с учётом доли писем, обработанных без модели.
+
+    Параметры:
+        min_confidence (float): Минимальная уверенность по каждому обязательному полю.
+    """
+    def __init__(self, min_confidence=MIN_CONFIDENCE, required_fields=REQUIRED_FIELDS):
+        self.min_confidence = min_confidence
+        self.required_fields = required_fields
+        self.stats = {'emails': 0, 'hits': 0, 'partial': 0, 'misses': 0}
+
+    def extract(self, text):
+        """
+        Функция для извлечения информации без модели.
+
+        Возвращает:
+            dict: Словарь с русскими ключами (как у extract_transportation_info) или None,
+            если обязательные поля не найдены однозначно и письмо нужно отправить в модель.
+        """
+        self.stats['emails'] += 1
+        info, confidence = analyze(text or "")
+        found = [field for field in self.required_fields if confidence.get(field, 0.0) >= self.min_confidence]
+        if len(found) == len(self.required_fields):
+            self.stats['hits'] += 1
+            logger.debug(f"Письмо обработано без модели: {info}")
+            return info.to_dict()
+        self.stats['partial' if found else 'misses'] += 1
+        return None
+
+    def report(self):
+        # Доля писем, обработанных без обращения к модели
+        emails = self.stats['emails']
+        report = dict(self.stats, hit_rate=self.stats['hits'] / emails if emails else 0.0)
+        logger.info(f"Извлечение по правилам: {report}")
+        return report
+
+_default_extractor = None
+
+def get_default_fast_extractor():
+    # Общий экземпляр (накапливает статистику попаданий)
+    global _default_extractor
+    if _default_extractor is None:
+        _default_extractor = FastPathExtractor()
+    return _default_extractor
+
+# Письма для проверки правил: текст -> ожидаемые поля (None - письмо должно уйти в модель)
+SAMPLE_LETTERS = [
+    ("Ставка Шанхай - Алматы 40HC 1250 USD",
+     {"место отправления": "Шанхай", "место назначения": "Алматы", "тип транспортировки": CONTAINER_CATEGORY,
+      "детали груза": "40HC", "цена": "1250 USD"}),
+    # Два маршрута в одном письме: однозначного ответа нет
+    ("Шанхай - Алматы 40HC 1250 USD, Алматы - Ташкент тент 900 USD", None),
+]
+
+def check_samples(extractor=None):
+    """
+    Функция для проверки извлечения по правилам на письмах SAMPLE_LETTERS.
+
+    Возвращает:
+        list: Письма, для которых результат не совпал с ожидаемым.
+    """
+    extractor = extractor or FastPathExtractor()
+    failed = []
+    for text, expected in SAMPLE_LETTERS:
+        result = extractor.extract(text)
+        if expected is None:
+            ok = result is None
+        else:
+            ok = result is not None and all(result.get(key) == value for key, value in expected.items())
+        if not ok:
+            logger.warning(f"Неожиданный результат для письма '{text}': {result}")
+            failed.append(text)
+    return failed
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    failed = check_samples()
+    print("Все письма разобраны верно." if not failed else f"Ошибки: {failed}")
@@ -0,0 +1,139 @@
+import re
+from collections import namedtuple
+from fast_extractor import (
+    AMOUNT, CONTAINER_CATEGORY, TRUCK_CATEGORY, parse_amount, find_price_values, find_cities, find_containers,
+    find_trucks, find_weights, find_volumes
+)
+
+# Локальная нормализация полей, уже извлечённых из письма на этапе email_processor:
+# очистка мест отправления и назначения, разбор типа транспорта на тип, подтип и размер,
+# разбор цены в число и валюту. Результат записывается в таблицы routes, transport_types,
+# transport_details и prices без повторного запроса к модели; модель используется только
+# для строк, которые не удалось разобрать однозначно.
+
+# Значения, означающие отсутствие данных
+PLACEHOLDER_VALUES = {
+    "-", "—", "нет", "не указано", "не указан", "не указана", "неизвестно", "нет данных", "уточняется",
+    "n/a", "na", "none", "null", "unknown", "tbd", "tba",
+}
+LOCATION_PREFIX_PATTERN = re.compile(
+    r"(?i)^\s*(?:г\.|гор\.|город|пгт\.?|пос\.|порт|port\s+of|port|ст\.|станция|city\s+of)\s*"
+)
+LOCATION_MAX_WORDS = 4  # Более длинные значения обычно содержат несколько пунктов или пояснения
+LOCATION_SEPARATOR_PATTERN = re.compile(r"\s*(?:[,;/+]|\s(?:и|and)\s)\s*", re.IGNORECASE)
+# Страны и регионы, которые указывают после города ("Шанхай, Китай") и не являются отдельным пунктом
+COUNTRIES = {
+    "россия", "рф", "russia", "китай", "кнр", "china", "prc", "казахстан", "kazakhstan", "рк",
+    "узбекистан", "uzbekistan", "кыргызстан", "киргизия", "kyrgyzstan", "беларусь", "belarus", "рб",
+    "германия", "germany", "польша", "poland", "латвия", "latvia", "литва", "lithuania", "турция", "turkey",
+    "нидерланды", "netherlands", "бельгия", "belgium", "италия", "italy", "оаэ", "uae", "корея", "korea",
+}
+
+# Категории транспорта для строк без кода контейнера и типа кузова
+TRANSPORT_CATEGORY_PATTERNS = [
+    (re.compile(r"(?i)ж/?д|железнодорож|вагон|rail|платформ"), "ж/д"),
+    (re.compile(r"(?i)авиа|\bair\b|самол[её]т"), "авиа"),
+    (re.compile(r"(?i)мор[ес]|\bsea\b|ocean|\bfcl\b|\blcl\b|фрахт"), "море"),
+    (re.compile(r"(?i)авто|фур[аы]|грузовик|truck|\bftl\b|\bltl\b|машин"), "авто"),
+]
+AMOUNT_PATTERN = re.compile(AMOUNT)
+
+NormalizedRecord = namedtuple(
+    "NormalizedRecord", ["origin", "destination", "transport_type", "subtype", "size", "amount", "currency"]
+)
+
+def is_placeholder(text):
+    return not text or text.strip().strip(".").lower() in PLACEHOLDER_VALUES
+
+def normalize_location(text):
+    """
+    Функция для очистки места отправления или назначения.
+
+    Возвращает:
+        tuple: (значение, признак однозначности).
+    """
+    text = re.sub(r"\s+", " ", (text or "").strip().strip(".,;"))
+    if is_placeholder(text):
+        return "", False
+    text = LOCATION_PREFIX_PATTERN.sub("", text)
+    parts = [part for part in LOCATION_SEPARATOR_PATTERN.split(text) if part and part.lower() not in COUNTRIES]
+    if len(parts) > 1:
+        return text, False  # Несколько пунктов в одном поле
+    cities = list(dict.fromkeys(find_cities(text)))
+    if len(cities) == 1:
+        return cities[0], True  # Название из справочника
+    if cities:
+        return text, False  # Несколько пунктов в одном поле
+    return text, len(text.split()) <= LOCATION_MAX_WORDS and not re.search(r"\d", text)
+
+def parse_transport(transport_type, cargo_details):
+    """
+    Функция для разбора типа транспорта.
+
+    Возвращает:
+        tuple: (тип, подтип, размер, признак однозначности).
+    """
+    transport_type = (transport_type or "").strip()
+    cargo_details = (cargo_details or "").strip()
+    text = f"{transport_type} {cargo_details}"
+    size = ", ".join(dict.fromkeys(find_volumes(cargo_details) + find_weights(cargo_details)))
+
+    containers = list(dict.fromkeys(find_containers(text)))
+    if containers:
+        return CONTAINER_CATEGORY, ", ".join(containers), size, len(containers) == 1
+    trucks = list(dict.fromkeys(find_trucks(text)))
+    if trucks:
+        return TRUCK_CATEGORY, ", ".join(trucks), size, len(trucks) == 1
+    if is_placeholder(transport_type):
+        return "", "", size, False
+    for pattern, category in TRANSPORT_CATEGORY_PATTERNS:
+        if pattern.search(text):
+            return category, transport_type, size, True
+    # Тип транспорта не распознан: сохраняется как есть
+    return transport_type, transport_type, size or cargo_details, False
+
+def parse_price(text):
+    """
+    Функция для разбора цены.
+
+    Возвращает:
+        tuple: (сумма или None, код валюты или None, признак однозначности).
+    """
+    text = (text or "").strip()
+    if is_placeholder(text):
+        return None, None, True  # Цены нет (например, запрос)
+    prices = list(dict.fromkeys(find_price_values(text)))
+    if prices:
+        amount, currency = prices[0]
+        return amount, currency, len(prices) == 1
+    amounts = []
+    for match in AMOUNT_PATTERN.findall(text):
+        try:
+            amounts.append(parse_amount(match))
+        except ValueError:
+            continue
+    amounts = list(dict.fromkeys(amounts))
+    if amounts:
+        return amounts[0], None, len(amounts) == 1
+    return None, None, False  # Например, "договорная"
+
+def normalize_fields(origin, destination, cargo_details, price, transport_type):
+    """
+    Функция для нормализации полей письма.
+
+    Параметры:
+        origin, destination, cargo_details, price, transport_type: Поля из таблицы emails.
+
+    Возвращает:
+        tuple: (NormalizedRecord, список полей, которые не удалось разобрать однозначно).
+    """
+    problems = []
+    origin, origin_ok = normalize_location(origin)
+    destination, destination_ok = normalize_location(destination)
+    category, subtype, size, transport_ok = parse_transport(transport_type, cargo_details)
+    amount, currency, price_ok = parse_price(price)
+    for field, ok in (("место отправления", origin_ok), ("место назначения", destination_ok),
+                      ("тип транспортировки", transport_ok), ("цена", price_ok)):
+        if not ok:
+            problems.append(field)
+    return NormalizedRecord(origin, destination, category, subtype, size, amount, currency), problems
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+from extraction_schema import response_text
+from api_resilience import call_with_retry
+
+# Постоянный кэш ответов модели. Ключ - хэш (модель, температура, системный промпт, промпт),
+# поэтому повторная обработка тех же писем после сбоя или изменения схемы не оплачивается повторно.
+
+CACHE_DB_PATH = "llm_cache.db"  # Отдельный файл, чтобы не блокировать основную базу
+MAX_ENTRIES = 100000  # Максимальное количество записей в кэше
+MAX_AGE_DAYS = 90  # Максимальный возраст записи
+EVICT_EVERY = 500  # Запуск очистки после каждых N записей
+
+logger = logging.getLogger("LLMCache")
+
+def make_cache_key(model, temperature, system_prompt, prompt, options=None):
+    # Хэш всех параметров, влияющих на ответ модели (options - схема структурированного ответа)
+    parts = [model, temperature, system_prompt, prompt]
+    if options:
+        parts.append(options)
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class LLMCache:
+    """
+    Кэш ответов модели в SQLite с вытеснением по возрасту и размеру.
+
+    Параметры:
+        db_path (str): Путь к файлу кэша.
+        max_entries (int): Максимальное количество записей.
+        max_age_days (int): Максимальный возраст записи в днях.
+    """
+    def __init__(self, db_path=CACHE_DB_PATH, max_entries=MAX_ENTRIES, max_age_days=MAX_AGE_DAYS):
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                answer TEXT NOT NULL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                total_tokens INTEGER,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL,
+                hit_count INTEGER DEFAULT 0
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache(last_used_at)")
+        self.conn.commit()
+        self.evict()
+
+    def get(self, key):
+        # Возвращает (ответ, usage) или None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT answer, prompt_tokens, completion_tokens, total_tokens FROM llm_cache WHERE key = ?",
+                (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute(
+                "UPDATE llm_cache SET last_used_at = ?, hit_count = hit_count + 1 WHERE key = ?",
+                (time.time(), key)
+            )
+            self.conn.commit()
+        answer, prompt_tokens, completion_tokens, total_tokens = row
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens or 0, completion_tokens=completion_tokens or 0,
+                                total_tokens=total_tokens or 0)
+        return answer, usage
+
+    def put(self, key, model, answer, usage=None):
+        # Сохраняет ответ модели и количество токенов
+        now = time.time()
+        with self.lock:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO llm_cache
+                    (key, model, answer, prompt_tokens, completion_tokens, total_tokens, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                key, model, answer,
+                getattr(usage, "prompt_tokens", None),
+                getattr(usage, "completion_tokens", None),
+                getattr(usage, "total_tokens", None),
+                now, now
+            ))
+            self.conn.commit()
+            self.puts += 1
+        if self.puts % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        # Удаляет устаревшие записи и самые давно использованные сверх лимита
+        with self.lock:
+            cutoff = time.time() - self.max_age_days * 86400
+            expired = self.conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (cutoff,)).rowcount
+            overflow = self.conn.execute("""
+                DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,)).rowcount
+            self.conn.commit()
+        if expired or overflow:
+            logger.info(f"Кэш: удалено устаревших записей {expired}, сверх лимита {overflow}.")
+
+    def stats(self):
+        # Счётчики попаданий и промахов
+        with self.lock:
+            entries, saved_tokens = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(total_tokens * hit_count), 0) FROM llm_cache"
+            ).fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+            "saved_tokens": saved_tokens,
+        }
+
+    def close(self):
+        self.conn.close()
+
+_default_cache = None
+
+def get_default_cache():
+    # Общий экземпляр кэша для всех скриптов
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = LLMCache()
+    return _default_cache
+
+def cached_chat_completion(client, model, system_prompt, prompt, temperature, max_tokens, cache=None, options=None):
+    """
+    Функция для запроса к модели с проверкой кэша.
+    options - дополнительные параметры запроса (например, tools для структурированного ответа).
+    Временные ошибки API повторяются; если повторы исчерпаны, вызывается TransientAPIError.
+
+    Возвращает:
+        tuple: (ответ модели, usage, признак ответа из кэша).
+    """
+    cache = cache or get_default_cache()
+    options = options or {}
+    key = make_cache_key(model, temperature, system_prompt, prompt, options)
+    cached = cache.get(key)
+    if cached is not None:
+        answer, usage = cached
+        logger.debug("Ответ получен из кэша.")
+        return answer, usage, True
+
+    response = call_with_retry(lambda: client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=temperature,
+        max_tokens=max_tokens,
+        **options
+    ))
+    answer = response_text(response.choices[0].message)
+    cache.put(key, model, answer, response.usage)
+    return answer, response.usage, False
@@ -0,0 +1,260 @@
+import logging
+import re
+import sqlite3
+import zlib
+from collections import namedtuple
+from email.parser import HeaderParser
+import numpy as np
+from body_store import decompress_body
+
+# Локальный предварительный фильтр писем перед обращением к OpenAI.
+# Первая ступень - дешёвые правила по заголовкам, отправителю и теме,
+# вторая - логистическая регрессия на хэшированных признаках текста,
+# обученная на уже размеченных письмах (emails.query_type / emails.price).
+
+MODEL_PATH = "mail_classifier.npz"  # Файл с весами модели
+N_FEATURES = 2 ** 18  # Размерность пространства хэшированных признаков
+MAX_TEXT_LENGTH = 4000  # Анализируем только начало письма
+THRESHOLD = 0.3  # Порог вероятности: ниже - письмо не отправляется в LLM
+PR_TRANSPORT_MESSAGE_HEADERS = "http://schemas.microsoft.com/mapi/proptag/0x007D001E"
+
+# Списки отправителей (адрес или домен целиком)
+ALLOWED_SENDERS = []  # Письма от этих отправителей всегда анализируются
+DENIED_SENDERS = ["noreply", "no-reply", "mailer-daemon", "postmaster"]  # Письма от этих отправителей пропускаются
+
+# Темы автоответов и рассылок
+SKIP_SUBJECT_PATTERN = re.compile(
+    r"(?i)^(automatic reply|auto[- ]?reply|autoreply|out of office|автоответ|автоматический ответ|"
+    r"undeliverable|delivery status notification|не доставлено)"
+)
+TOKEN_PATTERN = re.compile(r"\w+")
+
+FilterDecision = namedtuple("FilterDecision", ["relevant", "confidence", "reason"])
+
+logger = logging.getLogger("MailClassifier")
+
+def get_message_headers(message):
+    # Получает заголовки письма Outlook (MailItem) в виде словаря
+    try:
+        raw_headers = message.PropertyAccessor.GetProperty(PR_TRANSPORT_MESSAGE_HEADERS)
+    except Exception as e:
+        logger.debug(f"Не удалось получить заголовки письма: {e}")
+        return {}
+    if not raw_headers:
+        return {}
+    parsed = HeaderParser().parsestr(raw_headers)
+    return {key.lower(): value for key, value in parsed.items()}
+
+def check_rules(subject, sender, headers=None, allowed_senders=ALLOWED_SENDERS, denied_senders=DENIED_SENDERS):
+    """
+    Функция для проверки дешёвых правил по заголовкам.
+
+    Возвращает:
+        FilterDecision: Решение или None, если правила не дают однозначного ответа.
+    """
+    headers = headers or {}
+    sender = (sender or "").lower()
+
+    if any(entry.lower() in sender for entry in allowed_senders):
+        return FilterDecision(True, 1.0, "отправитель в списке разрешённых")
+    if any(entry.lower() in sender for entry in denied_senders):
+        return FilterDecision(False, 1.0, "отправитель в списке запрещённых")
+    if "list-unsubscribe" in headers or "list-id" in headers:
+        return FilterDecision(False, 1.0, "рассылка (List-Unsubscribe)")
+    auto_submitted = headers.get("auto-submitted", "no").strip().lower()
+    if auto_submitted != "no":
+        return FilterDecision(False, 1.0, f"автоматическое письмо (Auto-Submitted: {auto_submitted})")
+    if "x-autoreply" in headers or "x-autorespond" in headers:
+        return FilterDecision(False, 1.0, "автоответ (X-Autoreply)")
+    if headers.get("precedence", "").strip().lower() in ("bulk", "list", "junk", "auto_reply"):
+        return FilterDecision(False, 1.0, f"массовая рассылка (Precedence: {headers['precedence']})")
+    if SKIP_SUBJECT_PATTERN.search((subject or "").strip()):
+        return FilterDecision(False, 1.0, "тема автоответа или уведомления")
+    return None
+
+def hash_features(text, n_features=N_FEATURES):
+    """
+    Функция для преобразования текста в хэшированные признаки (слова и пары слов).
+
+    Возвращает:
+        tuple: (индексы, значения) нормированного разреженного вектора.
+    """
+    tokens = TOKEN_PATTERN.findall(text[:MAX_TEXT_LENGTH].lower())
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    counts = {}
+    for gram in grams:
+        h = zlib.crc32(gram.encode("utf-8"))
+        index = h % n_features
+        sign = 1.0 if h & 0x80000000 else -1.0  # Знак уменьшает влияние коллизий
+        counts[index] = counts.get(index, 0.0) + sign
+    if not counts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+    values = np.sign(values) * np.log1p(np.abs(values))
+    norm = np.linalg.norm(values)
+    return indices, values / norm if norm else values
+
+def build_text(subject, sender, body):
+    # Текст для классификации: тема, отправитель и тело письма
+    return f"{subject or ''}\n{sender or ''}\n{body or ''}"
+
+class SparseMatrix:
+    # Простейшая разреженная матрица (строки в формате COO) для обучения на NumPy
+    def __init__(self, rows, n_features=N_FEATURES):
+        self.n_rows = len(rows)
+        self.n_features = n_features
+        self.row_ids = np.concatenate([np.full(len(idx), i) for i, (idx, _) in enumerate(rows)] or [np.zeros(0, int)])
+        self.indices = np.concatenate([idx for idx, _ in rows] or [np.zeros(0, int)])
+        self.values = np.concatenate([val for _, val in rows] or [np.zeros(0)])
+
+    def dot(self, weights):
+        # X @ w
+        return np.bincount(self.row_ids, weights=self.values * weights[self.indices], minlength=self.n_rows)
+
+    def t_dot(self, vector):
+        # X.T @ v
+        return np.bincount(self.indices, weights=self.values * vector[self.row_ids], minlength=self.n_features)
+
+def sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-np.clip(z, -30, 30)))
+
+class MailClassifier:
+    """
+    Классификатор писем: правила + логистическая регрессия.
+
+    Параметры:
+        weights (numpy.ndarray): Веса модели (None - только правила).
+        bias (float): Свободный член.
+        threshold (float): Порог вероятности для отправки письма в LLM.
+    """
+    def __init__(self, weights=None, bias=0.0, threshold=THRESHOLD,
+                 allowed_senders=ALLOWED_SENDERS, denied_senders=DENIED_SENDERS):
+        self.weights = weights
+        self.bias = bias
+        self.threshold = threshold
+        self.allowed_senders = allowed_senders
+        self.denied_senders = denied_senders
+
+    def predict_proba(self, text):
+        # Вероятность того, что письмо связано с перевозкой
+        indices, values = hash_features(text, len(self.weights))
+        return float(sigmoid(np.dot(self.weights[indices], values) + self.bias))
+
+    def classify(self, subject, sender, body, headers=None, sender_address=None):
+        """
+        Функция для принятия решения, нужно ли отправлять письмо в LLM.
+        Списки отправителей проверяются по адресу (sender_address), если он известен: имя отправителя
+        в Outlook ("Иван Петров") не содержит адреса или домена из ALLOWED_SENDERS / DENIED_SENDERS.
+
+        Возвращает:
+            FilterDecision: (relevant, confidence, reason).
+        """
+        decision = check_rules(subject, sender_address or sender, headers, self.allowed_senders, self.denied_senders)
+        if decision is not None:
+            return decision
+        if self.weights is None:
+            return FilterDecision(True, 0.5, "модель не обучена")
+        probability = self.predict_proba(build_text(subject, sender, body))
+        if probability >= self.threshold:
+            return FilterDecision(True, probability, "модель")
+        return FilterDecision(False, 1.0 - probability, "модель")
+
+    def fit(self, texts, labels, epochs=200, learning_rate=2.0, l2=1e-4):
+        # Обучение полным градиентным спуском с балансировкой классов
+        X = SparseMatrix([hash_features(text) for text in texts])
+        y = np.asarray(labels, dtype=np.float64)
+        positives = max(y.sum(), 1.0)
+        negatives = max(len(y) - y.sum(), 1.0)
+        sample_weights = np.where(y == 1, len(y) / (2 * positives), len(y) / (2 * negatives))
+        weights = np.zeros(N_FEATURES)
+        bias = 0.0
+        for _ in range(epochs):
+            residual = (sigmoid(X.dot(weights) + bias) - y) * sample_weights / len(y)
+            weights -= learning_rate * (X.t_dot(residual) + l2 * weights)
+            bias -= learning_rate * residual.sum()
+        self.weights = weights
+        self.bias = bias
+        return self
+
+    def save(self, path=MODEL_PATH):
+        np.savez_compressed(path, weights=self.weights, bias=self.bias, threshold=self.threshold)
+        logger.info(f"Модель классификатора сохранена в '{path}'.")
+
+def load_classifier(path=MODEL_PATH):
+    # Загружает модель; если файла нет, классификатор работает только по правилам
+    try:
+        data = np.load(path)
+    except (FileNotFoundError, OSError):
+        logger.info(f"Файл модели '{path}' не найден. Используются только правила.")
+        return MailClassifier()
+    return MailClassifier(data["weights"], float(data["bias"]), float(data["threshold"]))
+
+def load_training_data(db_path="emails.db"):
+    """
+    Функция для загрузки размеченных писем из базы данных.
+    Положительный класс - письма с ценой или запросом, отрицательный - обработанные письма без них.
+    Письма, отброшенные самим фильтром, в обучение не попадают.
+
+    Возвращает:
+        tuple: (список текстов, список меток).
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("""
+            SELECT emails.subject, emails.sender, email_bodies.codec, email_bodies.data, emails.query_type, emails.price
+            FROM emails LEFT JOIN email_bodies ON email_bodies.id = emails.body_id
+            WHERE emails.processed = 1 AND COALESCE(emails.prefilter_skipped, 0) = 0
+        """).fetchall()
+    finally:
+        conn.close()
+    texts, labels = [], []
+    for subject, sender, codec, data, query_type, price in rows:
+        body = decompress_body(codec, data) if data is not None else ""
+        texts.append(build_text(subject, sender, body))
+        labels.append(1 if (price or "").strip() or "запрос" in (query_type or "").lower() else 0)
+    return texts, labels
+
+def evaluate(classifier, texts, labels):
+    # Точность и полнота на отложенной выборке
+    predicted = [classifier.predict_proba(text) >= classifier.threshold for text in texts]
+    tp = sum(1 for p, y in zip(predicted, labels) if p and y)
+    fp = sum(1 for p, y in zip(predicted, labels) if p and not y)
+    fn = sum(1 for p, y in zip(predicted, labels) if not p and y)
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    skipped = sum(1 for p in predicted if not p) / len(predicted) if predicted else 0.0
+    return {"precision": precision, "recall": recall, "f1": f1, "skipped_share": skipped, "samples": len(labels)}
+
+def train_classifier(db_path="emails.db", path=MODEL_PATH, test_share=0.2, seed=42):
+    """
+    Функция для обучения модели на письмах из базы данных и вывода отчёта о качестве.
+
+    Возвращает:
+        dict: Точность, полнота, F1 и доля пропускаемых писем на отложенной выборке.
+    """
+    texts, labels = load_training_data(db_path)
+    if len(set(labels)) < 2:
+        logger.error("Недостаточно размеченных писем обоих классов для обучения.")
+        return None
+
+    order = np.random.default_rng(seed).permutation(len(texts))
+    split = int(len(order) * (1 - test_share))
+    train, test = order[:split], order[split:]
+
+    classifier = MailClassifier().fit([texts[i] for i in train], [labels[i] for i in train])
+    report = evaluate(classifier, [texts[i] for i in test], [labels[i] for i in test])
+    logger.info(f"Отчёт классификатора (порог {classifier.threshold}): {report}")
+
+    # Итоговая модель обучается на всех данных
+    classifier.fit(texts, labels)
+    classifier.save(path)
+    return report
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    report = train_classifier()
+    if report:
+        print(f"Точность: {report['precision']:.3f}, Полнота: {report['recall']:.3f}, "
+              f"F1: {report['f1']:.3f}, Пропускается писем: {report['skipped_share']:.1%}")
@@ -1,6 +1,19 @@
-import sqlite3
+import json
+import re
 import logging
+import time
+from collections import namedtuple
 from openai_connection import get_openai_client
+from llm_cache import cached_chat_completion, get_default_cache
+from extraction_schema import (
+    FUNCTION_NAME, PARTIAL_FUNCTION_NAME, request_options, partial_request_options, parse_structured_answer,
+    parse_partial_answer
+)
+from retry_queue import enqueue_retry, clear_retry, deferred_email_ids, retry_stats
+from field_normalizer import normalize_fields
+from body_trimmer import count_tokens
+from database_writer import connect
+from schema_migrations import migrate
 
 # Настройка логирования
 logging.basicConfig(
@@ -17,35 +30,64 @@ logger = logging.getLogger("EmailProcessor")
 logging.getLogger("httpx").setLevel(logging.CRITICAL)
 logging.getLogger("openai").setLevel(logging.CRITICAL)
 
-# Стоимость токенов для модели gpt-3.5-turbo
-COST_PER_1000_INPUT_TOKENS = 0.002  # в долларах США
-COST_PER_1000_OUTPUT_TOKENS = 0.002  # в долларах США
-
-def extract_transportation_info(client, combined_data, email_id):
+# Каскад моделей: сначала прежняя модель миграции, следующая - только если ответ не прошёл проверку.
+# Стоимость указана в долларах США за 1000 токенов.
+ModelTier = namedtuple("ModelTier", ["model", "cost_per_1000_input_tokens", "cost_per_1000_output_tokens"])
+MODEL_TIERS = [
+    ModelTier("gpt-3.5-turbo", 0.002, 0.002),
+    ModelTier("gpt-4o", 0.0025, 0.01),
+]
+
+MIGRATION_MODEL = MODEL_TIERS[0].model  # Модель для пакетного и асинхронного режимов
+MIGRATION_TEMPERATURE = 0.2
+MIGRATION_MAX_TOKENS = 500
+SYSTEM_PROMPT = "Вы полезный помощник."
+STRUCTURED_OUTPUT = True  # Ответ в виде вызова функции с JSON-схемой
+
+# Обязательные поля ответа модели
+REQUIRED_FIELDS = [
+    "тип письма",
+    "место отправления",
+    "место назначения",
+    "детали груза",
+    "тип запроса",
+    "тип транспортировки",
+    "даты",
+    "цена",
+    "дополнительная информация"
+]
+
+# Поля, без которых ответ считается неполным и письмо передаётся следующей модели каскада
+ESCALATION_REQUIRED_FIELDS = [
+    "место отправления",
+    "место назначения",
+    "тип транспортировки",
+]
+
+def build_migration_prompt(combined_data):
     """
-    Функция для анализа текста письма с использованием OpenAI API.
+    Функция для формирования запроса к модели по подготовленным данным письма.
 
     Параметры:
         combined_data (str): Текст письма для анализа.
-        email_id (int): Идентификатор письма для логирования.
 
     Возвращает:
-        dict: Словарь с извлечённой информацией.
+        str: Текст запроса.
     """
-    try:
-        prompt = f"""
+    if STRUCTURED_OUTPUT:
+        # Поля и их описания передаются в JSON-схеме функции
+        return f"""
+Приведите информацию о перевозке из письма к структурированному виду и вызовите функцию {FUNCTION_NAME}.
+Если письмо не связано с перевозкой, укажите rel=false.
+
+Письмо:
+\"\"\"
+{combined_data}
+\"\"\"
+"""
+    return f"""
 Вы помощник, который извлекает информацию из писем, связанных с перевозками и ценовыми предложениями.
-Пожалуйста, прочитайте следующее письмо и извлеките информацию о перевозке, сосредоточившись на следующих ключевых деталях:
-
-- Место отправления
-- Место назначения
-- Детали груза
-- Тип письма (запрос на перевозку или ответ на запрос или другое)
-- Тип запроса
-- Тип транспортировки
-- Даты
-- Цена
-- Дополнительная информация
+Пожалуйста, прочитайте следующее письмо и извлеките информацию о перевозке.
 
 Письмо:
 \"\"\"
@@ -54,11 +96,11 @@ def extract_transportation_info(client, combined_data, email_id):
 
 Пожалуйста, предоставьте извлечённую информацию в следующем формате:
 
-Тип письма:
+Тип письма: (запрос на перевозку или ответ на запрос или другое)
 Место отправления:
 Место назначения:
 Детали груза:
-Тип запроса: 
+Тип запроса:
 Тип транспортировки:
 Даты:
 Цена:
@@ -67,145 +109,388 @@ def extract_transportation_info(client, combined_data, email_id):
 Если письмо не связано с перевозкой, ответьте "Нет информации о перевозке".
 """
 
-        logger.debug(f"Письмо ID {email_id}: Отправка запроса к OpenAI API.")
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Вы полезный помощник."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2,
-            max_tokens=500
-        )
-
-        answer = response.choices[0].message.content.strip()
-        logger.debug(f"Письмо ID {email_id}: Полный ответ ИИ: {answer}")
-
-        # Извлечение информации об использовании токенов
-        usage = response.usage
-        prompt_tokens = usage.prompt_tokens
-        completion_tokens = usage.completion_tokens
-        total_tokens = usage.total_tokens
-
-        # Расчёт стоимости
-        input_cost = (prompt_tokens / 1000) * COST_PER_1000_INPUT_TOKENS
-        output_cost = (completion_tokens / 1000) * COST_PER_1000_OUTPUT_TOKENS
-        total_cost = input_cost + output_cost
-
-        # Логирование информации о токенах и стоимости
-        logger.info(f"Письмо ID {email_id}: Использовано токенов - Входные: {prompt_tokens}, Выходные: {completion_tokens}, Всего: {total_tokens}")
-        logger.info(f"Письмо ID {email_id}: Стоимость запроса - Входные: ${input_cost:.6f}, Выходные: ${output_cost:.6f}, Общая: ${total_cost:.6f}")
-
-        if "Нет информации о перевозке" in answer or "нет информации о перевозке" in answer.lower():
-            logger.info(f"Письмо ID {email_id}: ИИ ответил - Нет информации о перевозке.")
-            return None
-
-        # Обработка ответа и преобразование в словарь
-        lines = answer.split('\n')
-        data = {}
-        current_field = ''
-
-        for line in lines:
-            if ':' in line:
-                key, value = line.split(':', 1)
-                key = key.strip().lower()
-                value = value.strip()
-                data[key] = value
-                current_field = key
-            elif current_field:
-                data[current_field] += ' ' + line.strip()
-
-        logger.debug(f"Письмо ID {email_id}: Извлечённые данные: {data}")
-
-        # Проверка обязательных полей
-        required_fields = [
-            "тип письма",
-            "место отправления",
-            "место назначения",
-            "детали груза",
-            "тип запроса",
-            "тип транспортировки",
-            "даты",
-            "цена",
-            "дополнительная информация"
-        ]
-        missing_fields = [field for field in required_fields if field not in data or not data[field]]
-        if missing_fields:
-            logger.warning(f"Письмо ID {email_id}: Отсутствуют обязательные поля: {missing_fields}")
-
-        return data
+def migration_request_options():
+    # Дополнительные параметры запроса для структурированного ответа
+    return request_options() if STRUCTURED_OUTPUT else {}
+
+def build_partial_prompt(combined_data, field_names):
+    """
+    Функция для формирования короткого запроса только недостающих полей.
+
+    Параметры:
+        combined_data (str): Текст письма для анализа.
+        field_names: Недостающие поля (ключи результата, например "цена").
+
+    Возвращает:
+        str: Текст запроса.
+    """
+    names = ", ".join(f'"{name}"' for name in field_names)
+    if STRUCTURED_OUTPUT:
+        instruction = f"Вызовите функцию {PARTIAL_FUNCTION_NAME}; если значение не указано, оставьте пустую строку."
+    else:
+        instruction = "Ответьте в формате \"Ключ: значение\", по одному полю в строке."
+    return f"""
+Найдите в письме только следующие поля: {names}. {instruction}
+
+Письмо:
+\"\"\"
+{combined_data}
+\"\"\"
+"""
+
+def partial_request_options_for(field_names):
+    # Параметры запроса недостающих полей
+    return partial_request_options(field_names) if STRUCTURED_OUTPUT else {}
+
+def estimate_request_tokens(prompt, options):
+    # Оценка входных токенов запроса: системный промпт, текст запроса и JSON-схема функции
+    return count_tokens(SYSTEM_PROMPT) + count_tokens(prompt) + count_tokens(json.dumps(options, ensure_ascii=False))
+
+def parse_migration_answer(answer, email_id):
+    """
+    Функция для разбора ответа модели в словарь.
+
+    Параметры:
+        answer (str): Ответ модели (JSON или текст "Ключ: значение").
+        email_id (int): Идентификатор письма для логирования.
+
+    Возвращает:
+        dict: Словарь с извлечённой информацией или None, если информации о перевозке нет.
+    """
+    info = parse_structured_answer(answer)
+    if info is None:
+        logger.info(f"Письмо ID {email_id}: ИИ ответил - Нет информации о перевозке.")
+        return None
+
+    data = info.to_dict()
+    logger.debug(f"Письмо ID {email_id}: Извлечённые данные: {data}")
+
+    # Проверка обязательных полей
+    missing_fields = [field for field in REQUIRED_FIELDS if field not in data or not data[field]]
+    if missing_fields:
+        logger.warning(f"Письмо ID {email_id}: Отсутствуют обязательные поля: {missing_fields}")
+
+    return data
+
+def validate_migration_data(data):
+    """
+    Функция для проверки ответа модели перед сохранением.
+
+    Параметры:
+        data (dict): Словарь с извлечённой информацией.
+
+    Возвращает:
+        list: Поля, которые нужно запросить повторно (пустой список, если ответ можно сохранять).
+    """
+    problems = [field for field in ESCALATION_REQUIRED_FIELDS if not (data.get(field) or "").strip()]
+    price = (data.get("цена") or "").strip()
+    if price:
+        if not re.search(r"\d", price):
+            problems.append("цена")  # Цена не распознана, например "договорная" или "по запросу"
+    elif "запрос" not in (data.get("тип письма") or "").lower():
+        problems.append("цена")
+    return problems
+
+def log_usage(email_id, usage, from_cache=False, tier=None):
+    """
+    Функция для логирования использованных токенов и стоимости запроса.
+
+    Параметры:
+        email_id (int): Идентификатор письма для логирования.
+        usage: Объект usage из ответа OpenAI API.
+        from_cache (bool): Ответ получен из кэша и не оплачивался.
+        tier (ModelTier): Модель каскада (по умолчанию первая).
+
+    Возвращает:
+        float: Стоимость запроса в долларах США.
+    """
+    tier = tier or MODEL_TIERS[0]
+    prompt_tokens = usage.prompt_tokens
+    completion_tokens = usage.completion_tokens
+    total_tokens = usage.total_tokens
+
+    if from_cache:
+        logger.info(f"Письмо ID {email_id}: Ответ взят из кэша, сэкономлено токенов: {total_tokens}")
+        return 0.0
+
+    # Расчёт стоимости
+    input_cost = (prompt_tokens / 1000) * tier.cost_per_1000_input_tokens
+    output_cost = (completion_tokens / 1000) * tier.cost_per_1000_output_tokens
+    total_cost = input_cost + output_cost
+
+    # Логирование информации о токенах и стоимости
+    logger.info(f"Письмо ID {email_id}: Использовано токенов - Входные: {prompt_tokens}, Выходные: {completion_tokens}, Всего: {total_tokens}")
+    logger.info(f"Письмо ID {email_id}: Стоимость запроса ({tier.model}) - Входные: ${input_cost:.6f}, Выходные: ${output_cost:.6f}, Общая: ${total_cost:.6f}")
+    return total_cost
+
+def extract_transportation_info(client, combined_data, email_id, cache=None, calls=None):
+    """
+    Функция для анализа текста письма с использованием OpenAI API.
+    Письмо анализирует первая модель из MODEL_TIERS. Если ответ не прошёл проверку validate_migration_data,
+    следующая модель получает короткий запрос только недостающих полей, и ответ объединяется с результатом.
+
+    Параметры:
+        combined_data (str): Текст письма для анализа.
+        email_id (int): Идентификатор письма для логирования.
+        cache (LLMCache): Кэш ответов модели (по умолчанию общий кэш).
+        calls (list): Список, в который добавляются сведения о запросах (для record_model_calls).
+
+    Возвращает:
+        dict: Словарь с извлечённой информацией или None, если письмо не связано с перевозкой.
+        Ошибки API передаются вызывающему коду, чтобы письмо не было помечено обработанным.
+    """
+    try:
+        prompt = build_migration_prompt(combined_data)
+        options = migration_request_options()
+        data, problems, full_tokens = None, [], 0
+
+        for level, tier in enumerate(MODEL_TIERS):
+            partial = bool(problems)
+            if partial:
+                # Повторный запрос только недостающих полей
+                request_prompt = build_partial_prompt(combined_data, problems)
+                request_options_ = partial_request_options_for(problems)
+            else:
+                request_prompt, request_options_ = prompt, options
+
+            logger.debug(f"Письмо ID {email_id}: Отправка запроса к OpenAI API ({tier.model}).")
+            started = time.monotonic()
+            answer, usage, from_cache = cached_chat_completion(
+                client, tier.model, SYSTEM_PROMPT, request_prompt,
+                MIGRATION_TEMPERATURE, MIGRATION_MAX_TOKENS, cache=cache,
+                options=request_options_
+            )
+            latency = time.monotonic() - started
+            logger.debug(f"Письмо ID {email_id}: Полный ответ ИИ: {answer}")
+
+            # Извлечение информации об использовании токенов
+            cost = log_usage(email_id, usage, from_cache, tier)
+
+            saved_tokens = 0
+            if partial:
+                values = parse_partial_answer(answer, problems)
+                logger.info(f"Письмо ID {email_id}: Получены недостающие поля: {list(values)}")
+                data.update(values)
+                # Экономия относительно повторного полного запроса (входные токены и полный ответ)
+                saved_tokens = max(0, full_tokens - usage.total_tokens)
+            else:
+                data = parse_migration_answer(answer, email_id)
+                full_tokens = estimate_request_tokens(prompt, options) + usage.completion_tokens
+
+            problems = validate_migration_data(data) if data else []
+            escalated = bool(problems) and level + 1 < len(MODEL_TIERS)
+            if calls is not None:
+                calls.append({
+                    "email_id": email_id, "tier": level, "model": tier.model, "latency": latency,
+                    "prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens,
+                    "cost": cost, "from_cache": int(from_cache), "escalated": int(escalated),
+                    "partial": int(partial), "saved_tokens": saved_tokens,
+                })
+            if not escalated:
+                if problems:
+                    logger.warning(f"Письмо ID {email_id}: Ответ последней модели каскада не прошёл проверку: {problems}")
+                return data
+            logger.info(f"Письмо ID {email_id}: Ответ {tier.model} не прошёл проверку ({problems}), "
+                        f"запрос недостающих полей к {MODEL_TIERS[level + 1].model}.")
 
     except Exception as e:
         logger.error(f"Письмо ID {email_id}: Ошибка при обращении к OpenAI API: {e}")
-        logger.exception("Трассировка ошибки:")
-        return None
+        raise
 
 def create_tables_if_not_exists(cursor):
     """
-    Функция для создания необходимых таблиц, если они не существуют.
+    Функция для создания необходимых таблиц, если они не существуют (миграции schema_migrations).
     """
     try:
-        # Включаем поддержку внешних ключей
-        cursor.execute("PRAGMA foreign_keys = ON;")
-        logger.debug("Включена поддержка внешних ключей.")
-
-        # Создание таблицы routes
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS routes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                loading_location TEXT NOT NULL,
-                unloading_location TEXT NOT NULL,
-                UNIQUE(loading_location, unloading_location)
-            );
-        """)
-        logger.debug("Таблица 'routes' создана или уже существует.")
-
-        # Создание таблицы transport_types
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS transport_types (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                type TEXT NOT NULL UNIQUE
-            );
-        """)
-        logger.debug("Таблица 'transport_types' создана или уже существует.")
-
-        # Создание таблицы transport_details
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS transport_details (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                transport_type_id INTEGER NOT NULL,
-                subtype TEXT,
-                size TEXT,
-                FOREIGN KEY (transport_type_id) REFERENCES transport_types(id),
-                UNIQUE(transport_type_id, subtype, size)
-            );
-        """)
-        logger.debug("Таблица 'transport_details' создана или уже существует.")
-
-        # Создание таблицы prices
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS prices (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                transport_id INTEGER NOT NULL,
-                route_id INTEGER NOT NULL,
-                price REAL NOT NULL,
-                email_id INTEGER NOT NULL,
-                FOREIGN KEY (transport_id) REFERENCES transport_details(id),
-                FOREIGN KEY (route_id) REFERENCES routes(id),
-                FOREIGN KEY (email_id) REFERENCES emails(id)
-            );
-        """)
-        logger.debug("Таблица 'prices' создана или уже существует.")
-
-        logger.info("Все необходимые таблицы успешно созданы или уже существуют.")
+        applied = migrate(cursor.connection)
+        logger.debug(f"Схема базы данных актуальна, применены миграции: {applied}")
     except Exception as e:
         logger.error(f"Ошибка при создании таблиц: {e}")
         raise  # Поднять исключение для дальнейшей обработки
 
+def record_model_calls(cursor, calls):
+    # Записывает сведения о запросах к моделям каскада в таблицу model_calls
+    cursor.executemany("""
+        INSERT INTO model_calls (email_id, tier, model, latency, prompt_tokens, completion_tokens, cost, from_cache,
+                                 escalated, partial, saved_tokens)
+        VALUES (:email_id, :tier, :model, :latency, :prompt_tokens, :completion_tokens, :cost, :from_cache,
+                :escalated, :partial, :saved_tokens)
+    """, calls)
+
+def model_tier_report(cursor):
+    """
+    Функция для сводки по моделям каскада.
+
+    Возвращает:
+        list: Словари с количеством запросов, средней задержкой, стоимостью, долей эскалаций
+        и экономией токенов за счёт запросов недостающих полей по каждой модели.
+    """
+    rows = cursor.execute("""
+        SELECT tier, model, COUNT(*), AVG(latency), SUM(cost), AVG(escalated), SUM(from_cache),
+               SUM(partial), SUM(saved_tokens)
+        FROM model_calls GROUP BY tier, model ORDER BY tier
+    """).fetchall()
+    return [{"tier": tier, "model": model, "requests": requests, "avg_latency": avg_latency,
+             "cost": cost, "escalation_rate": escalation_rate, "cache_hits": cache_hits,
+             "partial_requests": partial_requests, "saved_tokens": saved_tokens}
+            for tier, model, requests, avg_latency, cost, escalation_rate, cache_hits, partial_requests, saved_tokens
+            in rows]
+
+def pending_migration_rows(cursor):
+    """
+    Функция для выборки писем этапа миграции (migration_processed = 0).
+    Письма из очереди повторов, срок обработки которых не наступил, пропускаются.
+
+    Возвращает:
+        list: Строки (id, request_type, origin, destination, cargo_details, price, additional_info, transport_type).
+    """
+    cursor.execute("""
+        SELECT id, request_type, origin, destination, cargo_details, price, additional_info, transport_type
+        FROM emails
+        WHERE migration_processed = 0
+    """)
+    rows = cursor.fetchall()
+    deferred = deferred_email_ids(cursor, "migrate")
+    if deferred:
+        logger.info(f"Отложено писем в очереди повторов: {len(deferred)}")
+    return [row for row in rows if row[0] not in deferred]
+
+def build_combined_data(request_type, origin, destination, cargo_details, price, additional_info, transport_type):
+    """
+    Функция для подготовки данных письма к анализу ИИ.
+
+    Возвращает:
+        str: Текст с ранее извлечёнными полями письма.
+    """
+    return f"""
+Тип запроса: {request_type}
+Место отправления: {origin}
+Место назначения: {destination}
+Детали груза: {cargo_details}
+Цена: {price}
+Дополнительная информация: {additional_info}
+Тип транспорта: {transport_type}
+"""
+
+def save_normalized_record(cursor, email_id, record):
+    """
+    Функция для записи нормализованных полей письма в таблицы routes, transport_types, transport_details и prices.
+    Транзакцией управляет вызывающий код.
+
+    Параметры:
+        cursor: Курсор базы данных.
+        email_id (int): Идентификатор письма.
+        record (NormalizedRecord): Нормализованные поля.
+    """
+    logger.debug(f"Письмо ID {email_id}: Нормализованные данные: {record}")
+
+    # === Маршруты (routes) ===
+    cursor.execute("SELECT id FROM routes WHERE loading_location = ? AND unloading_location = ?",
+                   (record.origin, record.destination))
+    route = cursor.fetchone()
+    if route:
+        route_id = route[0]
+        logger.debug(f"Письмо ID {email_id}: Найден существующий маршрут с id {route_id}.")
+    else:
+        cursor.execute("INSERT INTO routes (loading_location, unloading_location) VALUES (?, ?)",
+                       (record.origin, record.destination))
+        route_id = cursor.lastrowid
+        logger.debug(f"Письмо ID {email_id}: Добавлен новый маршрут с id {route_id}.")
+
+    if not record.transport_type:
+        logger.warning(f"Письмо ID {email_id}: Тип транспорта отсутствует. Цены не будут добавлены.")
+        return
+
+    # === Типы транспорта (transport_types) ===
+    cursor.execute("SELECT id FROM transport_types WHERE type = ?", (record.transport_type,))
+    transport_type_record = cursor.fetchone()
+    if transport_type_record:
+        transport_type_id = transport_type_record[0]
+    else:
+        cursor.execute("INSERT INTO transport_types (type) VALUES (?)", (record.transport_type,))
+        transport_type_id = cursor.lastrowid
+        logger.debug(f"Письмо ID {email_id}: Добавлен новый тип транспорта с id {transport_type_id}.")
+
+    # === Детали транспорта (transport_details) ===
+    cursor.execute("SELECT id FROM transport_details WHERE transport_type_id = ? AND subtype = ? AND size = ?",
+                   (transport_type_id, record.subtype, record.size))
+    transport_detail = cursor.fetchone()
+    if transport_detail:
+        transport_id = transport_detail[0]
+    else:
+        cursor.execute("INSERT INTO transport_details (transport_type_id, subtype, size) VALUES (?, ?, ?)",
+                       (transport_type_id, record.subtype, record.size))
+        transport_id = cursor.lastrowid
+        logger.debug(f"Письмо ID {email_id}: Добавлена новая деталь транспорта с id {transport_id}.")
+
+    # === Цены (prices) ===
+    if record.amount is None:
+        logger.debug(f"Письмо ID {email_id}: Цена отсутствует или не распознана. Запись в 'prices' не добавлена.")
+        return
+    cursor.execute("INSERT INTO prices (transport_id, route_id, price, currency, email_id) VALUES (?, ?, ?, ?, ?)",
+                   (transport_id, route_id, record.amount, record.currency, email_id))
+    logger.debug(f"Письмо ID {email_id}: Добавлена новая запись в таблицу 'prices'.")
+
+def save_structured_data(cursor, email_id, analyzed_data, origin, destination, cargo_details, price, transport_type):
+    """
+    Функция для записи результата анализа ИИ в нормализованные таблицы.
+    Транзакцией управляет вызывающий код.
+
+    Параметры:
+        cursor: Курсор базы данных.
+        email_id (int): Идентификатор письма.
+        analyzed_data (dict): Данные, извлечённые ИИ.
+        origin, destination, cargo_details, price, transport_type: Исходные значения письма,
+            используемые, если ИИ не вернул соответствующее поле.
+    """
+    record, problems = normalize_fields(
+        analyzed_data.get("место отправления") or origin,
+        analyzed_data.get("место назначения") or destination,
+        analyzed_data.get("детали груза") or cargo_details,
+        analyzed_data.get("цена") or price,
+        analyzed_data.get("тип транспортировки") or transport_type,
+    )
+    if problems:
+        logger.warning(f"Письмо ID {email_id}: Поля не удалось разобрать однозначно: {problems}")
+    save_normalized_record(cursor, email_id, record)
+
+def migrate_locally(conn, rows):
+    """
+    Функция для миграции писем без обращения к модели.
+    Письма, поля которых нормализуются однозначно, записываются в таблицы и помечаются обработанными.
+
+    Параметры:
+        conn: Соединение с базой данных.
+        rows: Строки из pending_migration_rows.
+
+    Возвращает:
+        list: Строки, которые нужно отправить в модель.
+    """
+    cursor = conn.cursor()
+    unresolved = []
+    try:
+        conn.execute("BEGIN")
+        for row in rows:
+            email_id, request_type, origin, destination, cargo_details, price, additional_info, transport_type = row
+            record, problems = normalize_fields(origin, destination, cargo_details, price, transport_type)
+            if problems:
+                logger.debug(f"Письмо ID {email_id}: Требуется анализ ИИ, не разобраны поля: {problems}")
+                unresolved.append(row)
+                continue
+            save_normalized_record(cursor, email_id, record)
+            cursor.execute("UPDATE emails SET migration_processed = 1 WHERE id = ?", (email_id,))
+            clear_retry(cursor, "migrate", email_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    logger.info(f"Нормализовано без ИИ: {len(rows) - len(unresolved)} из {len(rows)} писем.")
+    return unresolved
+
 def analyze_and_migrate():
     # Подключение к базе данных
     try:
-        conn = sqlite3.connect("emails.db")
+        conn = connect("emails.db")
         cursor = conn.cursor()
         logger.debug("Подключение к базе данных 'emails.db' установлено.")
     except Exception as e:
@@ -224,30 +509,34 @@ def analyze_and_migrate():
 
     # Извлечение всех необработанных данных из таблицы
     try:
-        cursor.execute("""
-            SELECT id, request_type, origin, destination, cargo_details, price, additional_info, transport_type 
-            FROM emails
-            WHERE migration_processed = 0 OR migration_processed IS NULL
-        """)
-        emails = cursor.fetchall()
+        emails = pending_migration_rows(cursor)
         logger.debug(f"Запрос на выборку необработанных писем выполнен. Найдено {len(emails)} писем.")
     except Exception as e:
         logger.error(f"Ошибка при извлечении писем из базы данных: {e}")
         conn.close()
         return
 
+    # Письма с однозначно разбираемыми полями переносятся без обращения к ИИ
+    total_emails = len(emails)
+    try:
+        emails = migrate_locally(conn, emails)
+    except Exception as e:
+        logger.error(f"Ошибка при локальной нормализации писем: {e}")
+        logger.exception("Трассировка ошибки:")
+    normalized_emails = total_emails - len(emails)
+
     if not emails:
-        logger.info("Нет необработанных писем для обработки.")
+        logger.info("Нет писем, требующих анализа ИИ.")
         conn.close()
         print("Данные успешно структурированы и перенесены.")
         return
 
     # Подсчёт для логирования
-    total_emails = len(emails)
-    processed_emails = 0
+    processed_emails = normalized_emails
     skipped_emails = 0
+    failed_emails = 0
 
-    logger.info(f"Найдено писем для обработки: {total_emails}")
+    logger.info(f"Найдено писем для обработки: {total_emails}, из них требуют анализа ИИ: {len(emails)}")
 
     # Обработка каждой записи
     for email in emails:
@@ -259,25 +548,20 @@ def analyze_and_migrate():
         logger.debug(f"Клиент OpenAI для письма с id {email_id} успешно создан.")
 
         # === Подготовка данных для анализа ИИ ===
-        combined_data = f"""
-Тип запроса: {request_type}
-Место отправления: {origin}
-Место назначения: {destination}
-Детали груза: {cargo_details}
-Цена: {price}
-Дополнительная информация: {additional_info}
-Тип транспорта: {transport_type}
-"""
+        combined_data = build_combined_data(request_type, origin, destination, cargo_details,
+                                            price, additional_info, transport_type)
 
         logger.debug(f"Письмо ID {email_id}: Подготовленные данные для ИИ:\n{combined_data}")
 
+        calls = []  # Запросы к моделям каскада по этому письму
         try:
+            # Вызов ИИ для анализа данных (до начала транзакции: база не блокируется на время запроса)
+            analyzed_data = extract_transportation_info(client, combined_data, email_id, calls=calls)
+
             # Начало транзакции
             conn.execute('BEGIN')
             logger.debug(f"Письмо ID {email_id}: Начата транзакция.")
-
-            # Вызов ИИ для анализа данных
-            analyzed_data = extract_transportation_info(client, combined_data, email_id)
+            record_model_calls(cursor, calls)
 
             if not analyzed_data:
                 logger.info(f"Письмо ID {email_id}: Пропущено - информация о перевозке отсутствует.")
@@ -285,87 +569,19 @@ def analyze_and_migrate():
                 logger.debug(f"Письмо ID {email_id}: Ответ модели:\n{analyzed_data}")
                 # Отмечаем письмо как обработанное для миграции
                 cursor.execute("UPDATE emails SET migration_processed = 1 WHERE id = ?", (email_id,))
+                clear_retry(cursor, "migrate", email_id)
                 conn.commit()
                 logger.debug(f"Письмо ID {email_id}: Флаг 'migration_processed' обновлён.")
                 skipped_emails += 1
                 continue
 
-            # Извлечение структурированных данных из анализа
-            structured_route = {
-                "origin": analyzed_data.get("место отправления", origin),
-                "destination": analyzed_data.get("место назначения", destination)
-            }
-            structured_price = analyzed_data.get("цена", price)
-            transport_subtype = analyzed_data.get("тип транспортировки", transport_type)
-            transport_size = analyzed_data.get("детали груза", cargo_details)
-            transport_type_extracted = analyzed_data.get("тип транспортировки", transport_type)
-
-            logger.debug(f"Письмо ID {email_id}: Структурированные данные:")
-            logger.debug(f"Письмо ID {email_id}: Маршрут - Отправление: {structured_route['origin']}, Назначение: {structured_route['destination']}")
-            logger.debug(f"Письмо ID {email_id}: Цена: {structured_price}")
-            logger.debug(f"Письмо ID {email_id}: Тип транспортировки: {transport_type_extracted}")
-            logger.debug(f"Письмо ID {email_id}: Детали груза: {transport_size}")
-
-            # Проверка наличия transport_type
-            if not transport_type_extracted:
-                logger.warning(f"Письмо ID {email_id}: Поле 'тип транспортировки' отсутствует или пусто. Пропуск вставки в связанные таблицы.")
-
-            # === Маршруты (routes) ===
-            origin = structured_route["origin"]
-            destination = structured_route["destination"]
-            logger.debug(f"Письмо ID {email_id}: Поиск маршрута - От: {origin} -> До: {destination}")
-            cursor.execute("SELECT id FROM routes WHERE loading_location = ? AND unloading_location = ?", (origin, destination))
-            route = cursor.fetchone()
-
-            if route:
-                route_id = route[0]
-                logger.debug(f"Письмо ID {email_id}: Найден существующий маршрут с id {route_id}.")
-            else:
-                cursor.execute("INSERT INTO routes (loading_location, unloading_location) VALUES (?, ?)", (origin, destination))
-                route_id = cursor.lastrowid
-                logger.debug(f"Письмо ID {email_id}: Добавлен новый маршрут с id {route_id}.")
-
-            # === Типы транспорта (transport_types) ===
-            if transport_type_extracted:
-                logger.debug(f"Письмо ID {email_id}: Обработка типа транспорта - {transport_type_extracted}")
-                cursor.execute("SELECT id FROM transport_types WHERE type = ?", (transport_type_extracted,))
-                transport_type_record = cursor.fetchone()
-
-                if transport_type_record:
-                    transport_type_id = transport_type_record[0]
-                    logger.debug(f"Письмо ID {email_id}: Найден существующий тип транспорта с id {transport_type_id}.")
-                else:
-                    cursor.execute("INSERT INTO transport_types (type) VALUES (?)", (transport_type_extracted,))
-                    transport_type_id = cursor.lastrowid
-                    logger.debug(f"Письмо ID {email_id}: Добавлен новый тип транспорта с id {transport_type_id}.")
-
-                # === Детали транспорта (transport_details) ===
-                logger.debug(f"Письмо ID {email_id}: Обработка деталей транспорта - Подтип: {transport_subtype}, Размер: {transport_size}")
-                cursor.execute("SELECT id FROM transport_details WHERE transport_type_id = ? AND subtype = ? AND size = ?", 
-                               (transport_type_id, transport_subtype, transport_size))
-                transport_detail = cursor.fetchone()
-
-                if transport_detail:
-                    transport_id = transport_detail[0]
-                    logger.debug(f"Письмо ID {email_id}: Найден существующий деталь транспорта с id {transport_id}.")
-                else:
-                    cursor.execute("""
-                        INSERT INTO transport_details (transport_type_id, subtype, size) 
-                        VALUES (?, ?, ?)
-                    """, (transport_type_id, transport_subtype, transport_size))
-                    transport_id = cursor.lastrowid
-                    logger.debug(f"Письмо ID {email_id}: Добавлена новая деталь транспорта с id {transport_id}.")
-
-                # === Цены (prices) ===
-                logger.debug(f"Письмо ID {email_id}: Добавление цены - transport_id: {transport_id}, route_id: {route_id}, цена: {structured_price}")
-                cursor.execute("INSERT INTO prices (transport_id, route_id, price, email_id) VALUES (?, ?, ?, ?)", 
-                               (transport_id, route_id, structured_price, email_id))
-                logger.debug(f"Письмо ID {email_id}: Добавлена новая запись в таблицу 'prices'.")
-            else:
-                logger.warning(f"Письмо ID {email_id}: Тип транспорта отсутствует. Цены не будут добавлены.")
+            # Сохранение структурированных данных в связанные таблицы
+            save_structured_data(cursor, email_id, analyzed_data,
+                                 origin, destination, cargo_details, price, transport_type)
 
             # Отмечаем письмо как обработанное для миграции
             cursor.execute("UPDATE emails SET migration_processed = 1 WHERE id = ?", (email_id,))
+            clear_retry(cursor, "migrate", email_id)
             logger.debug(f"Письмо ID {email_id}: Флаг 'migration_processed' обновлён.")
 
             # Коммит всех изменений для текущего письма
@@ -379,11 +595,20 @@ def analyze_and_migrate():
             conn.rollback()
             logger.error(f"Письмо ID {email_id}: Ошибка при обработке: {e}")
             logger.exception("Трассировка ошибки:")
-            skipped_emails += 1
+            # Письмо не помечается обработанным, а ставится в очередь повторов
+            record_model_calls(cursor, calls)  # Выполненные запросы оплачены и учитываются в статистике
+            enqueue_retry(cursor, "migrate", email_id, e)
+            conn.commit()
+            failed_emails += 1
             continue
 
     # Логирование итогов
-    logger.info(f"Итоги обработки: Всего писем: {total_emails}, Обработано: {processed_emails}, Пропущено: {skipped_emails}")
+    logger.info(f"Итоги обработки: Всего писем: {total_emails}, Обработано: {processed_emails}, "
+                f"Пропущено: {skipped_emails}, Отложено до повтора: {failed_emails}")
+    logger.info(f"Очередь повторов: {retry_stats(cursor, 'migrate')}")
+    for tier_stats in model_tier_report(cursor):
+        logger.info(f"Каскад моделей: {tier_stats}")
+    logger.info(f"Статистика кэша ответов: {get_default_cache().stats()}")
 
     # Закрытие соединения
     try:
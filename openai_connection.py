@@ -1,5 +1,5 @@
 import logging
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
 import os
 
@@ -17,10 +17,33 @@ def get_openai_client():
 
     # Создание клиента OpenAI
     try:
-        client = OpenAI(api_key=openai_api_key)
+        # Повторы при временных ошибках выполняет api_resilience, встроенные повторы SDK отключены
+        client = OpenAI(api_key=openai_api_key, max_retries=0)
         logger.info("Клиент OpenAI успешно создан.")
         return client
     except Exception as e:
         logger.error(f"Не удалось создать клиента OpenAI: {e}")
         logger.exception("Трассировка ошибки:")
         return None
+
+def get_async_openai_client():
+    logger = logging.getLogger("OpenAIConnection")
+
+    # Загрузка переменных окружения из .env файла
+    load_dotenv()
+
+    # Получение API ключа
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    if not openai_api_key:
+        logger.error("Переменная окружения OPENAI_API_KEY не установлена.")
+        return None
+
+    # Создание асинхронного клиента OpenAI
+    try:
+        client = AsyncOpenAI(api_key=openai_api_key, max_retries=0)
+        logger.info("Асинхронный клиент OpenAI успешно создан.")
+        return client
+    except Exception as e:
+        logger.error(f"Не удалось создать асинхронного клиента OpenAI: {e}")
+        logger.exception("Трассировка ошибки:")
+        return None
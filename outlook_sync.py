@@ -0,0 +1,126 @@
+import json
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+# Инкрементальная синхронизация с Outlook. Для каждой папки в базе писем хранится отметка:
+# время получения последнего обработанного письма и EntryID писем с этим временем.
+# При следующем запуске Items.Restrict с DASL-фильтром перечисляет только письма не старше отметки,
+# поэтому запуск на ящике в десятки тысяч писем затрагивает только новую почту.
+
+RECEIVED_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"  # Формат received_time в таблице emails
+DASL_TIME_FORMAT = "%Y-%m-%d %H:%M"  # DASL сравнивает время с точностью до минуты
+RESTRICT_MARGIN_MINUTES = 1  # Запас фильтра; письма старше отметки отбрасываются после перечисления
+
+logger = logging.getLogger("OutlookSync")
+
+def received_time_str(message):
+    # Время получения письма в формате таблицы emails (местное время)
+    return message.ReceivedTime.strftime(RECEIVED_TIME_FORMAT)
+
+def dasl_received_filter(since):
+    """
+    Функция для построения DASL-фильтра Items.Restrict по времени получения.
+
+    Параметры:
+        since (str): Местное время в формате RECEIVED_TIME_FORMAT.
+
+    Возвращает:
+        str: Фильтр '@SQL=...'; urn:schemas:httpmail:datereceived сравнивается во времени UTC.
+    """
+    local = datetime.strptime(since, RECEIVED_TIME_FORMAT) - timedelta(minutes=RESTRICT_MARGIN_MINUTES)
+    utc = local.astimezone(timezone.utc)  # Время без часового пояса считается местным
+    return f"@SQL=\"urn:schemas:httpmail:datereceived\" >= '{utc.strftime(DASL_TIME_FORMAT)}'"
+
+def folder_key(folder):
+    # Ключ папки для отметки синхронизации
+    return getattr(folder, "FolderPath", None) or "Inbox"
+
+class SyncWatermark:
+    """
+    Отметка синхронизации папки Outlook в базе писем.
+
+    Параметры:
+        conn (sqlite3.Connection): Соединение с базой данных emails.db.
+        folder (str): Ключ папки (см. folder_key).
+    """
+    def __init__(self, conn, folder):
+        self.conn = conn
+        self.folder = folder
+        self.received_time = None
+        self.entry_ids = set()
+        self.failed = False
+        self.stats = {'enumerated': 0, 'already_synced': 0, 'new': 0}
+        self.create_table()
+        self.load()
+
+    def create_table(self):
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS sync_watermarks (
+                folder TEXT PRIMARY KEY,
+                received_time TEXT NOT NULL,
+                entry_ids TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        self.conn.commit()
+
+    def load(self):
+        row = self.conn.execute(
+            "SELECT received_time, entry_ids FROM sync_watermarks WHERE folder = ?", (self.folder,)
+        ).fetchone()
+        if row:
+            self.received_time, self.entry_ids = row[0], set(json.loads(row[1]))
+            return
+        # Первый запуск с отметкой: начинаем с последнего письма в базе, чтобы не перечислять весь ящик.
+        # Письма с этим же временем проверяются по базе (email_exists_in_db).
+        row = self.conn.execute("SELECT MAX(received_time) FROM emails").fetchone()
+        self.received_time = row[0] if row else None
+
+    def is_new(self, received_time, entry_id):
+        # Письмо ещё не обработано предыдущими запусками
+        self.stats['enumerated'] += 1
+        new = (self.received_time is None or received_time > self.received_time
+               or (received_time == self.received_time and entry_id not in self.entry_ids))
+        self.stats['new' if new else 'already_synced'] += 1
+        return new
+
+    def advance(self, received_time, entry_id):
+        # Переносит отметку на обработанное письмо (письма перечисляются от старых к новым)
+        if self.failed:
+            return
+        if self.received_time is None or received_time > self.received_time:
+            self.received_time, self.entry_ids = received_time, {entry_id}
+        elif received_time == self.received_time:
+            self.entry_ids.add(entry_id)
+        else:
+            return
+        self.conn.execute('''
+            INSERT INTO sync_watermarks (folder, received_time, entry_ids, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(folder) DO UPDATE SET received_time = excluded.received_time,
+                entry_ids = excluded.entry_ids, updated_at = excluded.updated_at
+        ''', (self.folder, self.received_time, json.dumps(sorted(self.entry_ids)), time.time()))
+        self.conn.commit()
+
+    def mark_failed(self):
+        # После ошибки отметка не переносится: письмо будет перечислено и обработано при следующем запуске
+        self.failed = True
+
+    def restrict(self, folder):
+        """
+        Функция для получения писем папки, полученных не раньше отметки.
+
+        Возвращает:
+            Items: Письма от старых к новым (все письма папки, если отметки ещё нет).
+        """
+        items = folder.Items
+        if self.received_time:
+            items = items.Restrict(dasl_received_filter(self.received_time))
+        items.Sort("[ReceivedTime]", False)  # От старых к новым
+        return items
+
+    def report(self, total=None):
+        # Сколько писем перечислено за запуск по сравнению с размером папки
+        report = dict(self.stats, folder_items=total, watermark=self.received_time)
+        logger.info(f"Синхронизация папки {self.folder}: {report}")
+        return report
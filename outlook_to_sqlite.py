@@ -1,40 +1,12 @@
 import logging
 import os
-import re
-import sqlite3
 import win32com.client
 from dotenv import load_dotenv
 import openai
-
-class EmailBodySplitter:
-    def __init__(self, logger=None):
-        # Если логгер не передан, создаем его
-        self.logger = logger or logging.getLogger(__name__)
-
-    def split_body(self, full_body):
-        """
-        Разделяет основное письмо и историю переписки на основе шаблонов, характерных для начала переписки.
-        Возвращает кортеж (основное письмо, письмо с историей переписки).
-        """
-        self.logger.debug("Начинаем разделение тела письма.")
-
-        # Ищем место начала истории переписки по характерным признакам
-        split_pattern = (
-            r"(?i)^((from|sent|date|subject|от|отправлено|дата|тема):\s+.*)|"
-            r"(\n-{2,}\n)"  # Линия из дефисов как разделитель
-        )  # Учитывает различные языки и форматы
-        split_match = re.search(split_pattern, full_body, re.MULTILINE)
-
-        if split_match:
-            main_body = full_body[:split_match.start()].strip()  # Основное письмо без истории переписки
-            history_body = full_body[split_match.start():].strip()  # История переписки
-            self.logger.debug("История переписки обнаружена и разделена.")
-        else:
-            main_body = full_body.strip()
-            history_body = None  # Если нет истории, устанавливаем None
-            self.logger.debug("История переписки не обнаружена. Используем основное письмо полностью.")
-
-        return main_body, history_body
+from email_body_splitter import EmailBodySplitter
+from database_writer import connect
+from schema_migrations import migrate
+from body_store import store_body
 
 def setup_logging():
     logging.basicConfig(
@@ -60,28 +32,10 @@ def setup_openai_api():
     return True
 
 def setup_database():
-    # Подключаемся к базе данных SQLite (или создаем новую)
-    conn = sqlite3.connect('emails.db')
-    cursor = conn.cursor()
-
-    # Создаем таблицу для хранения писем, если она еще не существует
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS emails (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            subject TEXT,
-            sender TEXT,
-            received_time TEXT,
-            body TEXT,
-            origin TEXT,
-            destination TEXT,
-            cargo_details TEXT,
-            dates TEXT,
-            price TEXT,
-            additional_info TEXT
-        )
-    ''')
-    conn.commit()
-    return conn, cursor
+    # Подключаемся к базе данных SQLite; таблицы создаются миграциями (schema_migrations)
+    conn = connect('emails.db')
+    migrate(conn)
+    return conn, conn.cursor()
 
 def refers_to_thread(main_body):
     # Простая эвристика для определения ссылок на историю переписки
@@ -198,14 +152,14 @@ def process_emails():
                     # Сохраняем письмо и извлеченную информацию в базу данных
                     cursor.execute('''
                         INSERT INTO emails (
-                            subject, sender, received_time, body,
+                            subject, sender, received_time, body_id,
                             origin, destination, cargo_details, dates, price, additional_info
                         ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                     ''', (
                         subject,
                         sender,
                         received_time,
-                        full_body,
+                        store_body(cursor, full_body),
                         transportation_info.get('место отправления', ''),
                         transportation_info.get('место назначения', ''),
                         transportation_info.get('детали груза', ''),
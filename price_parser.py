@@ -0,0 +1,278 @@
+import argparse
+import logging
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+from fast_extractor import (
+    AMOUNT, PRICE_PATTERN, CONTAINER_PATTERN, CONTAINER_CODES, parse_amount, currency_code, find_containers
+)
+from field_normalizer import AMOUNT_PATTERN, is_placeholder, normalize_location
+
+# Разбор цен из текста ("1 200 USD + THC", "USD 1,250 / 40'HC, THC 150 USD", "85 EUR за тонну")
+# на составляющие: сумма, валюта, единица расчёта, контейнер и вид (основная ставка или надбавка).
+# Составляющие записываются в таблицу price_components с маршрутом и временем письма, основная ставка -
+# в числовые столбцы emails.price_amount / price_currency, поэтому выборки по ценам (диапазон,
+# сортировка, минимум по направлению) выполняются одним запросом по индексу, а не перебором строк в Python.
+
+FREIGHT = "ставка"  # Основная ставка перевозки
+SURCHARGE = "надбавка"  # Дополнительный сбор (THC, BAF, оформление и т.п.)
+BACKFILL_BATCH_SIZE = 1000  # Писем в одной транзакции заполнения
+RIGHT_CONTEXT = 25  # Сколько символов после цены просматривается для единицы расчёта и контейнера
+RANGE_MIN_RATIO = 0.5  # Нижняя граница диапазона не меньше этой доли верхней ("20 - 1500 USD" - контейнер и цена)
+
+# Надбавки и сборы: слово в тексте -> название
+SURCHARGE_WORDS = (r"o?d?thc|baf|caf|isps|pss|gri|ebs|lss|cic|b/l|bl\s*fee|doc\s*fee|"
+                   r"сбор\w*|надбав\w*|доплат\w*|surcharges?|fees?|локальн\w*|local\s+charges?|"
+                   r"демередж\w*|demurrage|detention|хранени\w*|оформлени\w*|таможн\w*|customs")
+SURCHARGE_PATTERN = re.compile(rf"(?<!\w)(?P<label>{SURCHARGE_WORDS})(?!\w)", re.IGNORECASE)
+# Надбавка уже включена в ставку ("включая THC", "THC включено", "all in")
+INCLUDED_BEFORE_PATTERN = re.compile(r"(?:включ\w*|вкл\.?|incl\w*|all\s*-?\s*in)\s*$", re.IGNORECASE)
+INCLUDED_AFTER_PATTERN = re.compile(r"^\s*(?:включ\w*|вкл\.?|incl\w*)", re.IGNORECASE)
+# Надбавка, указанная сразу после суммы ("150 USD THC"), а не следующая позиция ("1200 USD + THC")
+RIGHT_LABEL_PATTERN = re.compile(rf"\s*[-–—:]?\s*(?P<label>{SURCHARGE_WORDS})(?!\w)", re.IGNORECASE)
+LABEL_SEPARATORS = " \t:-–—="
+
+# Единица расчёта: шаблон после суммы ("/т", "за контейнер", "per cbm") -> название
+BASIS_PATTERNS = [
+    (re.compile(r"\s*(?:/|за|per|each)\s*(?:конт\w*|ктк|cntr|containers?|teu|feu|box)", re.IGNORECASE), "контейнер"),
+    (re.compile(r"\s*(?:/|за|per)\s*(?:тонн\w*|тн|т|tons?|tonnes?|mt|t)(?!\w)", re.IGNORECASE), "тонна"),
+    (re.compile(r"\s*(?:/|за|per)\s*(?:кг|kg)(?!\w)", re.IGNORECASE), "кг"),
+    (re.compile(r"\s*(?:/|за|per)\s*(?:м3|м³|куб\w*|cbm|m3)", re.IGNORECASE), "м3"),
+    (re.compile(r"\s*(?:/|за|per)\s*(?:машин\w*|авто\w*|фур\w*|рейс\w*|trucks?|trips?)", re.IGNORECASE), "машина"),
+    (re.compile(r"\s*(?:/|за|per)\s*(?:вагон\w*|wagons?)", re.IGNORECASE), "вагон"),
+]
+# Нижняя граница диапазона перед суммой с валютой: "от 1500 до 1800 USD", "1500-1800 USD", "1500–1800$"
+RANGE_START_PATTERN = re.compile(rf"(?<![\w.,])(?P<low>{AMOUNT})\s*(?:-|–|—|до|to)\s*$", re.IGNORECASE)
+# Контейнер сразу после суммы: "USD 1,250 / 40'HC", "1200$ за 40HC"
+RIGHT_CONTAINER_PATTERN = re.compile(r"\s*(?:/|за|per|x|х)?\s*(?=(?:20|40|45)\D)", re.IGNORECASE)
+
+PriceComponent = namedtuple("PriceComponent", ["kind", "label", "amount", "currency", "basis", "container"])
+
+logger = logging.getLogger("PriceParser")
+
+def _container(match):
+    return f"{match.group(1)}{CONTAINER_CODES[match.group(2).upper()]}"
+
+def _basis_and_container(text, start, end):
+    # Единица расчёта и контейнер сразу после цены; возвращает (единица, контейнер, конец найденного текста)
+    prefix = RIGHT_CONTAINER_PATTERN.match(text, start, end)
+    if prefix:
+        match = CONTAINER_PATTERN.match(text, prefix.end(), end)
+        if match:
+            return "контейнер", _container(match), match.end()
+    for pattern, basis in BASIS_PATTERNS:
+        match = pattern.match(text, start, end)
+        if match:
+            return basis, None, match.end()
+    return None, None, start
+
+def _left_container(segment):
+    # Контейнер перед ценой в той же строке: "40HC: 1200 USD"
+    matches = list(CONTAINER_PATTERN.finditer(segment.rsplit("\n", 1)[-1]))
+    return _container(matches[-1]) if matches else None
+
+def _labels(segment):
+    # Надбавки в отрезке текста, кроме включённых в ставку
+    return [match for match in SURCHARGE_PATTERN.finditer(segment)
+            if not INCLUDED_BEFORE_PATTERN.search(segment[max(0, match.start() - 20):match.start()])
+            and not INCLUDED_AFTER_PATTERN.match(segment[match.end():])]
+
+def _label(match):
+    # Коды сборов (THC, BAF) - прописными, слова - строчными
+    label = re.sub(r"\s+", " ", match.group("label"))
+    return label.upper() if label.isascii() and len(label) <= 6 else label.lower()
+
+def _amount_or_none(text):
+    try:
+        return parse_amount(text)
+    except ValueError:
+        return None
+
+def _unpriced(labels):
+    return [PriceComponent(SURCHARGE, _label(label), None, None, None, None) for label in labels]
+
+def parse_prices(text, price_field=True):
+    """
+    Функция для разбора цен в тексте.
+
+    Параметры:
+        text (str): Поле цены письма или текст письма.
+        price_field (bool): Текст - поле цены: сумма без валюты тоже считается ставкой.
+
+    Возвращает:
+        list: Составляющие PriceComponent в порядке упоминания; надбавки без суммы ("+ THC") - с amount = None,
+        для диапазона ("1500-1800 USD") - нижняя граница.
+    """
+    text = text or ""
+    if is_placeholder(text):
+        return []
+    matches = list(PRICE_PATTERN.finditer(text))
+    components = []
+    previous_end = 0
+    for index, match in enumerate(matches):
+        currency = currency_code(match.group("cur1") or match.group("cur2"))
+        try:
+            amount = parse_amount(match.group("amount1") or match.group("amount2"))
+        except ValueError:
+            continue
+        if not currency or amount <= 0:
+            continue
+        segment = text[previous_end:match.start()]
+        range_start = RANGE_START_PATTERN.search(segment) if match.group("amount2") else None
+        low = _amount_or_none(range_start.group("low")) if range_start else None
+        if low is not None and amount * RANGE_MIN_RATIO <= low <= amount:
+            # Диапазон с валютой только у верхней границы - одна ставка в этой валюте по нижней границе,
+            # по которой котировки сравниваются (cheapest_quote)
+            amount = low
+            segment = segment[:range_start.start()]
+        labels = _labels(segment)
+        # Название сбора непосредственно перед суммой ("THC 150 USD") относится к ней,
+        # остальные названия в отрезке - надбавки без суммы ("1200 USD + THC, BAF 100 USD")
+        label = labels.pop() if labels and not segment[labels[-1].end():].strip(LABEL_SEPARATORS) else None
+        components.extend(_unpriced(labels))
+
+        right_end = min(matches[index + 1].start() if index + 1 < len(matches) else len(text),
+                        match.end() + RIGHT_CONTEXT)
+        end = match.end()
+        if label is None:
+            label = RIGHT_LABEL_PATTERN.match(text, end, right_end)
+            end = label.end() if label else end
+        basis, container, end = _basis_and_container(text, end, right_end)
+        container = container or _left_container(segment)
+        components.append(PriceComponent(SURCHARGE if label else FREIGHT, _label(label) if label else None,
+                                         amount, currency, basis or ("контейнер" if container else None), container))
+        previous_end = end
+    # Надбавки без суммы после последней цены: "1 200 USD + THC"
+    components.extend(_unpriced(_labels(text[previous_end:])))
+    if not matches and price_field:
+        # Сумма без валюты в поле цены (валюта указана в другом поле или подразумевается)
+        for amount_text in AMOUNT_PATTERN.findall(text):
+            try:
+                components.append(PriceComponent(FREIGHT, None, parse_amount(amount_text), None, None, None))
+            except ValueError:
+                continue
+            break
+    return components
+
+def main_freight(components):
+    # Основная ставка письма: первая ставка с суммой
+    return next((component for component in components if component.kind == FREIGHT and component.amount), None)
+
+def save_price_components(cursor, email_id, price_text, origin=None, destination=None, cargo_details=None,
+                          transport_type=None, received_time=None):
+    """
+    Функция для записи разобранной цены письма в price_components и числовые столбцы emails.
+    Транзакцией управляет вызывающий код.
+
+    Параметры:
+        cursor: Курсор базы данных.
+        email_id (int): ID письма.
+        price_text (str): Поле цены письма.
+        origin, destination: Места отправления и назначения (приводятся к названиям из справочника).
+        cargo_details, transport_type: Поля письма, из которых берётся контейнер, если он не указан у цены.
+        received_time (str): Время получения письма (None - берётся из emails).
+
+    Возвращает:
+        list: Составляющие цены.
+    """
+    components = parse_prices(price_text)
+    if received_time is None:
+        row = cursor.execute("SELECT received_time FROM emails WHERE id = ?", (email_id,)).fetchone()
+        received_time = row[0] if row else None
+    origin = normalize_location(origin)[0] or None
+    destination = normalize_location(destination)[0] or None
+    containers = list(dict.fromkeys(find_containers(f"{transport_type or ''} {cargo_details or ''}")))
+    default_container = containers[0] if len(containers) == 1 else None
+
+    cursor.execute("DELETE FROM price_components WHERE email_id = ?", (email_id,))
+    cursor.executemany('''
+        INSERT INTO price_components (email_id, position, kind, label, amount, currency, basis, container,
+                                      origin, destination, received_time)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [(email_id, position, component.kind, component.label, component.amount, component.currency,
+           component.basis or ("контейнер" if component.kind == FREIGHT and default_container else None),
+           component.container or (default_container if component.kind == FREIGHT else None),
+           origin, destination, received_time)
+          for position, component in enumerate(components)])
+    freight = main_freight(components)
+    cursor.execute(
+        "UPDATE emails SET price_amount = ?, price_currency = ?, price_basis = ?, price_parsed = 1 WHERE id = ?",
+        (freight.amount if freight else None, freight.currency if freight else None,
+         freight.basis if freight else None, email_id)
+    )
+    return components
+
+def backfill_prices(conn, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Функция для разбора цен писем, сохранённых до появления price_components (price_parsed = 0),
+    и перевода текстовых значений prices.price в числа.
+
+    Возвращает:
+        dict: Количество разобранных писем, писем с основной ставкой и составляющих.
+    """
+    cursor = conn.cursor()
+    stats = {'emails': 0, 'with_price': 0, 'components': 0, 'prices_fixed': 0}
+    while True:
+        rows = cursor.execute('''
+            SELECT id, price, origin, destination, cargo_details, transport_type, received_time
+            FROM emails WHERE price_parsed = 0 LIMIT ?
+        ''', (batch_size,)).fetchall()
+        if not rows:
+            break
+        for email_id, price, origin, destination, cargo_details, transport_type, received_time in rows:
+            components = save_price_components(cursor, email_id, price, origin, destination, cargo_details,
+                                               transport_type, received_time)
+            stats['emails'] += 1
+            stats['components'] += len(components)
+            stats['with_price'] += main_freight(components) is not None
+        conn.commit()
+        logger.info(f"Разобрано цен писем: {stats['emails']}")
+
+    # Цены, записанные в prices.price строкой ("1 200 USD")
+    for price_id, price in cursor.execute("SELECT id, price FROM prices WHERE typeof(price) = 'text'").fetchall():
+        freight = main_freight(parse_prices(price))
+        if freight:
+            cursor.execute("UPDATE prices SET price = ?, currency = COALESCE(currency, ?) WHERE id = ?",
+                           (freight.amount, freight.currency, price_id))
+            stats['prices_fixed'] += 1
+    conn.commit()
+    logger.info(f"Разбор цен завершён: {stats}")
+    return stats
+
+CHEAPEST_QUOTE_QUERY = '''
+    SELECT amount, currency, basis, email_id, received_time FROM price_components
+    WHERE kind = 'ставка' AND origin = ? AND destination = ? AND container = ? AND currency = ?
+      AND received_time >= ?
+    ORDER BY amount LIMIT 1
+'''
+
+def cheapest_quote(conn, origin, destination, container, days=30, currency="USD"):
+    """
+    Функция для поиска самой низкой ставки по направлению и контейнеру за последние дни.
+
+    Возвращает:
+        tuple: (сумма, валюта, единица расчёта, ID письма, время получения) или None.
+    """
+    since = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    origin = normalize_location(origin)[0]
+    destination = normalize_location(destination)[0]
+    container = (find_containers(container) or [container])[0]
+    return conn.execute(CHEAPEST_QUOTE_QUERY, (origin, destination, container, currency, since)).fetchone()
+
+if __name__ == "__main__":
+    from database_connection import setup_database
+
+    parser = argparse.ArgumentParser(description="Разбор цен писем и поиск самой низкой ставки")
+    parser.add_argument("--backfill", action="store_true", help="Разобрать цены ранее сохранённых писем")
+    parser.add_argument("--cheapest", nargs=3, metavar=("ОТКУДА", "КУДА", "КОНТЕЙНЕР"),
+                        help="Самая низкая ставка по направлению, например: Шанхай Алматы 40HC")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--currency", default="USD")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    conn, _ = setup_database()
+    if args.backfill:
+        backfill_prices(conn)
+    if args.cheapest:
+        print(cheapest_quote(conn, *args.cheapest, days=args.days, currency=args.currency))
+    conn.close()
@@ -0,0 +1,69 @@
+import logging
+import time
+
+# Очередь повторной обработки писем, для которых запрос к API не выполнен из-за временной ошибки.
+# Такие письма не помечаются обработанными: они пропускаются до наступления next_attempt_at,
+# а после MAX_ATTEMPTS неудачных попыток остаются в очереди со статусом 'failed' для ручного разбора.
+
+MAX_ATTEMPTS = 8  # Максимальное количество попыток для одного письма
+RETRY_BASE_DELAY = 300  # Задержка перед второй попыткой, в секундах (далее удваивается)
+RETRY_MAX_DELAY = 6 * 3600  # Максимальная задержка между попытками, в секундах
+
+logger = logging.getLogger("RetryQueue")
+
+def create_retry_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS retry_queue (
+            stage TEXT NOT NULL,
+            email_id INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt_at REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            PRIMARY KEY (stage, email_id)
+        )
+    ''')
+
+def enqueue_retry(cursor, stage, email_id, error):
+    """
+    Функция для постановки письма в очередь повторной обработки.
+
+    Параметры:
+        stage (str): Этап обработки ('extract' или 'migrate').
+        email_id (int): ID письма.
+        error (Exception): Ошибка последней попытки.
+
+    Возвращает:
+        int: Количество выполненных попыток.
+    """
+    row = cursor.execute("SELECT attempts FROM retry_queue WHERE stage = ? AND email_id = ?",
+                         (stage, email_id)).fetchone()
+    attempts = (row[0] if row else 0) + 1
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    status = 'failed' if attempts >= MAX_ATTEMPTS else 'pending'
+    cursor.execute('''
+        INSERT OR REPLACE INTO retry_queue (stage, email_id, attempts, last_error, next_attempt_at, status)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (stage, email_id, attempts, str(error), time.time() + delay, status))
+    if status == 'failed':
+        logger.error(f"Письмо ID {email_id}: этап {stage} не выполнен после {attempts} попыток: {error}")
+    else:
+        logger.warning(f"Письмо ID {email_id}: этап {stage} будет повторён через {delay} с (попытка {attempts}).")
+    return attempts
+
+def clear_retry(cursor, stage, email_id):
+    # Удаляет письмо из очереди после успешной обработки
+    cursor.execute("DELETE FROM retry_queue WHERE stage = ? AND email_id = ?", (stage, email_id))
+
+def deferred_email_ids(cursor, stage):
+    # ID писем, которые сейчас обрабатывать не нужно: срок повтора не наступил или попытки исчерпаны
+    rows = cursor.execute(
+        "SELECT email_id FROM retry_queue WHERE stage = ? AND (status = 'failed' OR next_attempt_at > ?)",
+        (stage, time.time())
+    )
+    return {row[0] for row in rows}
+
+def retry_stats(cursor, stage):
+    # Количество писем в очереди по статусам
+    rows = cursor.execute("SELECT status, COUNT(*) FROM retry_queue WHERE stage = ? GROUP BY status", (stage,))
+    return dict(rows.fetchall())
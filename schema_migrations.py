@@ -0,0 +1,303 @@
+import argparse
+import logging
+from database_writer import connect
+from retry_queue import create_retry_table
+from body_store import create_body_table, move_inline_bodies
+
+# Версионированные миграции схемы базы писем. Номер применённой миграции хранится в PRAGMA user_version;
+# при подключении применяются только недостающие миграции, каждая в своей транзакции, после чего
+# обновляется статистика планировщика (ANALYZE). Основные таблицы (emails, маршруты, цены, model_calls,
+# retry_queue) создаются только здесь; таблицы вспомогательных модулей (thread_index, boilerplate_learner,
+# outlook_sync, similarity_index, llm_cache) по-прежнему создаются самими модулями.
+
+DB_PATH = "emails.db"
+
+logger = logging.getLogger("SchemaMigrations")
+
+def table_columns(cursor, table):
+    return [column[1] for column in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+
+def add_missing_columns(cursor, table, columns):
+    # Добавляет в существующую таблицу столбцы, появившиеся в новых версиях
+    existing_columns = table_columns(cursor, table)
+    for column_name, column_type in columns.items():
+        if column_name not in existing_columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column_name} {column_type}")
+            logger.info(f"Столбец {column_name} ({column_type}) добавлен в таблицу {table}.")
+
+def has_unique_index(cursor, table, column):
+    # Есть ли уникальный индекс ровно по одному столбцу (например, UNIQUE в определении таблицы)
+    for _, name, unique, *_ in cursor.execute(f"PRAGMA index_list({table})").fetchall():
+        if unique and [row[2] for row in cursor.execute(f"PRAGMA index_info({name})")] == [column]:
+            return True
+    return False
+
+def migration_1_base_schema(cursor):
+    # Основные таблицы. Базы, созданные прежними версиями (database_connection, database2, mig_data,
+    # outlook_to_sqlite), дополняются недостающими столбцами.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS emails (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            entry_id TEXT UNIQUE,
+            subject TEXT,
+            sender TEXT,
+            received_time TEXT,
+            body TEXT,
+            request_type TEXT,
+            origin TEXT,
+            destination TEXT,
+            cargo_details TEXT,
+            dates TEXT,
+            price TEXT,
+            additional_info TEXT,
+            processed INTEGER DEFAULT 0
+        )
+    ''')
+    add_missing_columns(cursor, "emails", {
+        "entry_id": "TEXT",
+        "request_type": "TEXT",
+        "processed": "INTEGER DEFAULT 0",
+        "query_type": "TEXT",
+        "transport_type": "TEXT",
+        "weight": "TEXT",
+        "volume": "TEXT",
+        "prefilter_score": "REAL",  # Уверенность предварительного фильтра
+        "prefilter_skipped": "INTEGER DEFAULT 0",  # Письмо отброшено фильтром без обращения к LLM
+        "conversation_id": "TEXT",  # Цепочка переписки (ConversationID Outlook или In-Reply-To)
+    })
+    if not has_unique_index(cursor, "emails", "entry_id"):
+        # Таблица outlook_to_sqlite создавалась без entry_id
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_emails_entry_id ON emails(entry_id)")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS routes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            loading_location TEXT NOT NULL,
+            unloading_location TEXT NOT NULL,
+            UNIQUE(loading_location, unloading_location)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transport_types (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL UNIQUE
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transport_details (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            transport_type_id INTEGER NOT NULL,
+            subtype TEXT,
+            size TEXT,
+            FOREIGN KEY (transport_type_id) REFERENCES transport_types(id),
+            UNIQUE(transport_type_id, subtype, size)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS prices (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            transport_id INTEGER NOT NULL,
+            route_id INTEGER NOT NULL,
+            price REAL NOT NULL,
+            currency TEXT,
+            email_id INTEGER,
+            FOREIGN KEY (transport_id) REFERENCES transport_details(id),
+            FOREIGN KEY (route_id) REFERENCES routes(id),
+            FOREIGN KEY (email_id) REFERENCES emails(id)
+        )
+    ''')
+    # Статистика запросов к моделям каскада
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS model_calls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email_id INTEGER NOT NULL,
+            tier INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            latency REAL,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            cost REAL,
+            from_cache INTEGER DEFAULT 0,
+            escalated INTEGER DEFAULT 0,
+            partial INTEGER DEFAULT 0,
+            saved_tokens INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    add_missing_columns(cursor, "model_calls", {"partial": "INTEGER DEFAULT 0", "saved_tokens": "INTEGER DEFAULT 0"})
+    # Очередь повторной обработки писем после временных ошибок API
+    create_retry_table(cursor)
+
+def migration_2_reconcile_columns(cursor):
+    # prices.emails_id (database2) и prices.email_id (mig_data) - один и тот же столбец
+    columns = table_columns(cursor, "prices")
+    if "emails_id" in columns and "email_id" not in columns:
+        cursor.execute("ALTER TABLE prices RENAME COLUMN emails_id TO email_id")
+        logger.info("Столбец prices.emails_id переименован в email_id.")
+    elif "emails_id" in columns:
+        cursor.execute("UPDATE prices SET email_id = emails_id WHERE email_id IS NULL")
+        logger.warning("В таблице prices есть и email_id, и emails_id: значения перенесены в email_id.")
+    add_missing_columns(cursor, "prices", {"currency": "TEXT"})
+
+    # Флаг этапа миграции (mig_data, async_extractor, batch_processor) без значений NULL,
+    # чтобы выборка необработанных писем использовала частичный индекс
+    add_missing_columns(cursor, "emails", {"migration_processed": "INTEGER NOT NULL DEFAULT 0"})
+    cursor.execute("UPDATE emails SET migration_processed = 0 WHERE migration_processed IS NULL")
+    cursor.execute("UPDATE emails SET processed = 0 WHERE processed IS NULL")
+
+def migration_3_indexes(cursor):
+    # Частичные индексы по флагам необработанных писем: содержат только ожидающие письма
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_pending ON emails(id) WHERE processed = 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_migration_pending ON emails(id) WHERE migration_processed = 0")
+    # Отметка синхронизации с Outlook начинается с MAX(received_time)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_received_time ON emails(received_time)")
+    # Покрывающие индексы для соединения цен с маршрутами (extr_data) и поиска цен письма
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_prices_route ON prices(route_id, price, currency)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_prices_email ON prices(email_id)")
+    # Поиск маршрута и деталей транспорта при записи (в базах database2 нет ограничений UNIQUE)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_routes_locations ON routes(loading_location, unloading_location)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transport_details_type "
+                   "ON transport_details(transport_type_id, subtype, size)")
+
+def migration_4_price_components(cursor):
+    # Разобранная цена письма: основная ставка в числовых столбцах emails, все составляющие
+    # (ставки, надбавки, единица расчёта, контейнер) - в price_components вместе с маршрутом и временем
+    # письма, чтобы поиск ставки по направлению не соединял таблицы и не разбирал текст
+    add_missing_columns(cursor, "emails", {
+        "price_amount": "REAL",  # Основная ставка
+        "price_currency": "TEXT",
+        "price_basis": "TEXT",  # Единица расчёта: контейнер, тонна, машина...
+        "price_parsed": "INTEGER NOT NULL DEFAULT 0",  # Цена разобрана price_parser
+    })
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS price_components (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            label TEXT,
+            amount REAL,
+            currency TEXT,
+            basis TEXT,
+            container TEXT,
+            origin TEXT,
+            destination TEXT,
+            received_time TEXT,
+            FOREIGN KEY (email_id) REFERENCES emails(id)
+        )
+    ''')
+    # Самая низкая ставка по направлению и контейнеру за период: поиск по индексу без обращения к таблице
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_price_components_lane ON price_components"
+                   "(origin, destination, container, currency, received_time, amount) WHERE kind = 'ставка'")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_price_components_email ON price_components(email_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_price ON emails(price_currency, price_amount)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_price_pending ON emails(id) WHERE price_parsed = 0")
+
+def migration_5_body_store(cursor):
+    # Тексты писем - в сжатом хранилище email_bodies (один раз для одинаковых текстов), в emails - ссылка.
+    # Столбец emails.body остаётся пустым (NULL): DROP COLUMN перестраивает таблицу и есть не во всех версиях SQLite.
+    create_body_table(cursor)
+    add_missing_columns(cursor, "emails", {"body_id": "INTEGER REFERENCES email_bodies(id)"})
+    move_inline_bodies(cursor, "emails", {"body": "body_id"})
+
+MIGRATIONS = [
+    (1, "основные таблицы", migration_1_base_schema),
+    (2, "согласование столбцов prices.email_id и emails.migration_processed", migration_2_reconcile_columns),
+    (3, "индексы для выборки необработанных писем и соединения цен с маршрутами", migration_3_indexes),
+    (4, "числовые цены и таблица составляющих цены price_components", migration_4_price_components),
+    (5, "тексты писем в сжатом хранилище email_bodies", migration_5_body_store),
+]
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn):
+    """
+    Функция для применения недостающих миграций.
+
+    Параметры:
+        conn (sqlite3.Connection): Соединение с базой данных.
+
+    Возвращает:
+        list: Номера применённых миграций.
+    """
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        if version <= schema_version(conn):
+            continue
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN")
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Ошибка миграции {version} ({description}): {e}")
+            raise
+        logger.info(f"Применена миграция {version}: {description}.")
+        applied.append(version)
+    if applied:
+        conn.execute("ANALYZE")  # Статистика для выбора индексов планировщиком
+        conn.commit()
+    return applied
+
+# Запросы, которые должны использовать индексы: название -> (запрос, индекс)
+CHECKED_QUERIES = {
+    "необработанные письма": ("SELECT id, subject, sender, body_id FROM emails WHERE processed = 0",
+                              "idx_emails_pending"),
+    "письма этапа миграции": ("SELECT id, request_type, origin, destination, cargo_details, price, additional_info, "
+                              "transport_type FROM emails WHERE migration_processed = 0",
+                              "idx_emails_migration_pending"),
+    "цены и маршруты": ("SELECT prices.price, routes.loading_location, routes.unloading_location "
+                        "FROM prices JOIN routes ON prices.route_id = routes.id",
+                        "idx_prices_route"),
+    "поиск маршрута": ("SELECT id FROM routes WHERE loading_location = 'a' AND unloading_location = 'b'",
+                       "routes"),
+    "последнее письмо": ("SELECT MAX(received_time) FROM emails", "idx_emails_received_time"),
+    "самая низкая ставка": ("SELECT amount, currency, basis, email_id, received_time FROM price_components "
+                            "WHERE kind = 'ставка' AND origin = 'Шанхай' AND destination = 'Алматы' "
+                            "AND container = '40HC' AND currency = 'USD' AND received_time >= '2024-01-01' "
+                            "ORDER BY amount LIMIT 1",
+                            "idx_price_components_lane"),
+    "цены в диапазоне": ("SELECT id FROM emails WHERE price_currency = 'USD' AND price_amount BETWEEN 1000 AND 2000",
+                         "idx_emails_price"),
+}
+
+def query_plan(conn, sql):
+    # Строки EXPLAIN QUERY PLAN
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()]
+
+def verify_query_plans(conn, queries=CHECKED_QUERIES):
+    """
+    Функция для проверки, что запросы выполняются по индексам, а не полным просмотром таблиц.
+    План зависит от статистики ANALYZE: если почти все письма ещё не обработаны, полный просмотр дешевле
+    частичного индекса, и планировщик выбирает его.
+
+    Возвращает:
+        dict: Название запроса -> (план запроса, используется ли ожидаемый индекс).
+    """
+    results = {}
+    for name, (sql, index) in queries.items():
+        plan = query_plan(conn, sql)
+        ok = any(index in line and ("INDEX" in line or "PRIMARY KEY" in line) for line in plan)
+        results[name] = (plan, ok)
+        if ok:
+            logger.info(f"План запроса '{name}': {plan}")
+        else:
+            logger.warning(f"Запрос '{name}' не использует индекс {index}: {plan}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Миграции схемы базы писем")
+    parser.add_argument("--db", default=DB_PATH, help="Файл базы данных")
+    parser.add_argument("--check", action="store_true", help="Проверить планы основных запросов")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    conn = connect(args.db)
+    migrate(conn)
+    print(f"Версия схемы: {schema_version(conn)}")
+    if args.check:
+        failed = [name for name, (_, ok) in verify_query_plans(conn).items() if not ok]
+        print("Все запросы используют индексы." if not failed else f"Без индекса: {failed}")
+    conn.close()
@@ -0,0 +1,313 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import time
+import zlib
+from collections import namedtuple
+import numpy as np
+from mail_classifier import hash_features
+from fast_extractor import AMOUNT, parse_amount, format_amount
+from body_trimmer import truncate_to_tokens
+
+# Индекс похожих писем. Перевозчики неделями присылают котировки по одному шаблону,
+# в которых меняются только цифры. Для каждого обработанного письма сохраняются
+# MinHash-подпись (поиск почти полных копий через LSH) и хэшированный вектор слов
+# (поиск похожих писем по косинусной близости на NumPy). Для почти полной копии
+# повторно используется прежний результат извлечения с заменой изменившихся чисел,
+# для похожих писем - несколько прежних писем с результатами добавляются в запрос как примеры.
+
+SIMILARITY_DB_PATH = "similarity_index.db"  # Отдельный файл рядом с emails.db
+MAX_ENTRIES = 20000  # Максимальное количество писем в индексе
+TRIM_FRACTION = 0.1  # Доля самых старых писем, удаляемых при достижении лимита (индекс перестраивается реже)
+
+SHINGLE_SIZE = 3  # Количество слов в шингле
+MINHASH_PERMUTATIONS = 64  # Длина MinHash-подписи
+LSH_BANDS = 16  # Количество полос LSH (по MINHASH_PERMUTATIONS // LSH_BANDS значений)
+MINHASH_SEED = 17
+MINHASH_PRIME = (1 << 61) - 1
+NEAR_DUPLICATE_THRESHOLD = 0.9  # Оценка сходства Жаккара для почти полной копии
+
+VECTOR_FEATURES = 2 ** 10  # Размерность хэшированного вектора письма
+SIMILARITY_THRESHOLD = 0.5  # Минимальная косинусная близость письма-примера
+FEW_SHOT_EXAMPLES = 2  # Сколько похожих писем добавлять в запрос
+EXAMPLE_MAX_TOKENS = 300  # Ограничение длины одного письма-примера
+
+# Числа (суммы, размеры, даты) и слова письма; знаки препинания не учитываются
+TOKEN_PATTERN = re.compile(rf"(?P<number>{AMOUNT})|\w+")
+
+SimilarityMatch = namedtuple("SimilarityMatch", ["info", "examples"])
+
+logger = logging.getLogger("SimilarityIndex")
+
+_rng = np.random.RandomState(MINHASH_SEED)
+_MINHASH_A = _rng.randint(1, 1 << 31, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+_MINHASH_B = _rng.randint(0, 1 << 31, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+
+def tokenize(text):
+    """
+    Функция для разбиения текста на слова и числа.
+
+    Возвращает:
+        tuple: (список токенов, в которых числа заменены на "0", список чисел в порядке появления).
+    """
+    masked, numbers = [], []
+    for match in TOKEN_PATTERN.finditer(text or ""):
+        if match.group("number"):
+            masked.append("0")
+            numbers.append(match.group("number"))
+        else:
+            masked.append(match.group(0).lower())
+    return masked, numbers
+
+def minhash_signature(masked):
+    # MinHash-подпись множества шинглов (числа не влияют на подпись)
+    if not masked:
+        return None
+    size = min(SHINGLE_SIZE, len(masked))
+    shingles = {" ".join(masked[i:i + size]) for i in range(len(masked) - size + 1)}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    permuted = (np.outer(hashes, _MINHASH_A) + _MINHASH_B) % np.uint64(MINHASH_PRIME)
+    return (permuted & np.uint64(0xFFFFFFFF)).min(axis=0).astype(np.uint32)
+
+def band_keys(signature):
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    return [signature[band * rows:(band + 1) * rows].tobytes() for band in range(LSH_BANDS)]
+
+def text_vector(masked):
+    # Плотный нормированный вектор хэшированных признаков письма
+    vector = np.zeros(VECTOR_FEATURES, dtype=np.float32)
+    indices, values = hash_features(" ".join(masked), VECTOR_FEATURES)
+    np.add.at(vector, indices, values)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def _amount(text):
+    try:
+        return parse_amount(text)
+    except ValueError:
+        return None
+
+def number_changes(old_numbers, new_numbers):
+    # Замены чисел в письме с тем же шаблоном: {старое: новое} или None, если замена неоднозначна.
+    # Число заменяется, только если изменились все его вхождения и одинаково: иначе ("20DC, вес 20 т" ->
+    # "20DC, вес 25 т", ставка и депозит 1700 USD) нельзя понять, какое вхождение в полях результата менять.
+    changes = {}
+    changed, unchanged = set(), set()
+    for old, new in zip(old_numbers, new_numbers):
+        value = _amount(old)
+        key = old if value is None else value  # "1 250" и "1250" - одно и то же число
+        if old == new:
+            unchanged.add(key)
+            continue
+        if changes.get(old, new) != new:
+            return None
+        changes[old] = new
+        changed.add(key)
+    if changed & unchanged:
+        return None
+    return changes
+
+def reuse_extraction(old_text, new_text, info):
+    """
+    Функция для переноса результата извлечения на почти полную копию письма.
+
+    Параметры:
+        old_text (str): Текст ранее обработанного письма.
+        new_text (str): Текст нового письма.
+        info (dict): Результат извлечения для old_text.
+
+    Возвращает:
+        dict: Результат для new_text или None, если письма отличаются не только числами
+        или изменившееся число не удалось найти в полях результата.
+    """
+    old_masked, old_numbers = tokenize(old_text)
+    new_masked, new_numbers = tokenize(new_text)
+    if old_masked != new_masked:
+        return None
+    changes = number_changes(old_numbers, new_numbers)
+    if changes is None:
+        return None
+    if not changes:
+        return dict(info)
+
+    # Число в поле может быть записано как в письме ("1 250") или в нормализованном виде ("1250")
+    replacements = {}
+    for old, new in changes.items():
+        replacements[old] = new
+        old_amount, new_amount = _amount(old), _amount(new)
+        if old_amount is not None and new_amount is not None:
+            replacements.setdefault(format_amount(old_amount), format_amount(new_amount))
+    pattern = re.compile(
+        r"(?<![\d.,])(" + "|".join(re.escape(old) for old in sorted(replacements, key=len, reverse=True)) + r")(?!\d)"
+    )
+    applied = set()
+
+    def replace(match):
+        applied.add(match.group(1))
+        return replacements[match.group(1)]
+
+    result = {key: pattern.sub(replace, value) if isinstance(value, str) else value for key, value in info.items()}
+
+    # Каждое изменившееся число должно быть заменено в результате: если число не найдено в полях
+    # (записано иначе или вычислено моделью), прежний результат мог бы остаться с устаревшим значением
+    for old in changes:
+        old_amount = _amount(old)
+        if old not in applied and (old_amount is None or format_amount(old_amount) not in applied):
+            return None
+    return result
+
+class SimilarityIndex:
+    """
+    Индекс ранее обработанных писем в SQLite с поиском почти полных копий и похожих писем.
+
+    Параметры:
+        db_path (str): Путь к файлу индекса.
+        max_entries (int): Максимальное количество писем в индексе.
+    """
+    def __init__(self, db_path=SIMILARITY_DB_PATH, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.stats = {'lookups': 0, 'near_duplicates': 0, 'reused': 0, 'with_examples': 0, 'added': 0}
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS similar_emails (
+                id INTEGER PRIMARY KEY,
+                text_hash TEXT UNIQUE NOT NULL,
+                text TEXT NOT NULL,
+                info TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                vector BLOB NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self.trim(max_entries)
+        self.load()
+
+    def trim(self, keep):
+        # Удаление самых старых писем, кроме keep последних; возвращает количество удалённых
+        overflow = self.conn.execute("""
+            DELETE FROM similar_emails WHERE id IN (
+                SELECT id FROM similar_emails ORDER BY created_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (keep,)).rowcount
+        self.conn.commit()
+        if overflow:
+            logger.info(f"Индекс похожих писем: удалено записей сверх лимита: {overflow}.")
+        return overflow
+
+    def load(self):
+        # Загрузка подписей и векторов в память
+        self.ids = []
+        self.signatures = []
+        self.vectors = []
+        self.buckets = [{} for _ in range(LSH_BANDS)]
+        self.matrix = None
+        for row_id, signature, vector in self.conn.execute("SELECT id, signature, vector FROM similar_emails"):
+            self._append(row_id, np.frombuffer(signature, dtype=np.uint32), np.frombuffer(vector, dtype=np.float32))
+        logger.debug(f"Индекс похожих писем загружен: {len(self.ids)} писем.")
+
+    def _append(self, row_id, signature, vector):
+        position = len(self.ids)
+        self.ids.append(row_id)
+        self.signatures.append(signature)
+        self.vectors.append(vector)
+        for band, key in enumerate(band_keys(signature)):
+            self.buckets[band].setdefault(key, []).append(position)
+        self.matrix = None
+
+    def _rows(self, positions):
+        # (текст, результат) писем индекса по позициям
+        rows = []
+        for position in positions:
+            row = self.conn.execute("SELECT text, info FROM similar_emails WHERE id = ?",
+                                    (self.ids[position],)).fetchone()
+            if row:
+                rows.append((row[0], json.loads(row[1])))
+        return rows
+
+    def near_duplicates(self, signature):
+        # Позиции кандидатов LSH с оценкой сходства Жаккара не ниже порога, от самых похожих
+        candidates = set()
+        for band, key in enumerate(band_keys(signature)):
+            candidates.update(self.buckets[band].get(key, ()))
+        scored = [(float(np.mean(self.signatures[p] == signature)), p) for p in candidates]
+        return [p for score, p in sorted(scored, reverse=True) if score >= NEAR_DUPLICATE_THRESHOLD]
+
+    def nearest(self, vector, k=FEW_SHOT_EXAMPLES):
+        # Позиции k самых близких писем по косинусной близости
+        if not self.vectors:
+            return []
+        if self.matrix is None:
+            self.matrix = np.vstack(self.vectors)
+        scores = self.matrix @ vector
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [int(p) for p in top[np.argsort(-scores[top])] if scores[p] >= SIMILARITY_THRESHOLD]
+
+    def lookup(self, text, k=FEW_SHOT_EXAMPLES):
+        """
+        Функция для поиска ранее обработанных писем, похожих на text.
+
+        Возвращает:
+            SimilarityMatch: info - результат, перенесённый с почти полной копии (или None),
+            examples - список пар (текст, результат) похожих писем для примеров в запросе.
+        """
+        self.stats['lookups'] += 1
+        masked, _ = tokenize(text)
+        signature = minhash_signature(masked)
+        if signature is None:
+            return SimilarityMatch(None, [])
+
+        duplicates = self.near_duplicates(signature)
+        if duplicates:
+            self.stats['near_duplicates'] += 1
+        for old_text, info in self._rows(duplicates):
+            reused = reuse_extraction(old_text, text, info)
+            if reused is not None:
+                self.stats['reused'] += 1
+                return SimilarityMatch(reused, [])
+
+        positions = self.nearest(text_vector(masked), k) if k else []
+        examples = [(truncate_to_tokens(old_text, EXAMPLE_MAX_TOKENS), info) for old_text, info in self._rows(positions)]
+        if examples:
+            self.stats['with_examples'] += 1
+        return SimilarityMatch(None, examples)
+
+    def add(self, text, info):
+        # Добавление обработанного письма и результата извлечения в индекс
+        masked, _ = tokenize(text)
+        signature = minhash_signature(masked)
+        if signature is None or not info:
+            return
+        vector = text_vector(masked)
+        text_hash = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        cursor = self.conn.execute("""
+            INSERT OR IGNORE INTO similar_emails (text_hash, text, info, signature, vector, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (text_hash, text, json.dumps(info, ensure_ascii=False), signature.tobytes(), vector.tobytes(), time.time()))
+        self.conn.commit()
+        if cursor.rowcount:
+            self._append(cursor.lastrowid, signature, vector)
+            self.stats['added'] += 1
+            if len(self.ids) > self.max_entries:
+                # Позиции писем в корзинах LSH меняются после удаления, поэтому индекс загружается заново
+                self.trim(int(self.max_entries * (1 - TRIM_FRACTION)))
+                self.load()
+
+    def report(self):
+        # Сводка по повторно использованным результатам и запросам с примерами
+        logger.info(f"Индекс похожих писем ({len(self.ids)} писем): {self.stats}")
+        return dict(self.stats)
+
+    def close(self):
+        self.conn.close()
+
+_default_index = None
+
+def get_default_similarity_index():
+    # Общий экземпляр индекса похожих писем
+    global _default_index
+    if _default_index is None:
+        _default_index = SimilarityIndex()
+    return _default_index
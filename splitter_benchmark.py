@@ -0,0 +1,138 @@
+import argparse
+import random
+import re
+import time
+from email_body_splitter import EmailBodySplitter, split_offsets
+
+# Микробенчмарк разделения писем на синтетическом многоязычном корпусе.
+# Сравнивает время на одно письмо для прежней реализации (шаблон собирается при каждом вызове)
+# и общего модуля email_body_splitter, а также проверяет, что история найдена там, где ожидается.
+# Запуск: python splitter_benchmark.py --messages 5000
+
+# Шаблон из прежней версии email_body_splitter.py
+LEGACY_SPLIT_PATTERN_PARTS = [
+    r"(?i)^((from|sent|date|subject|",
+    r"от|отправлено|дата|тема|",
+    r"de|envoyé|date|sujet|",
+    r"von|gesendet|datum|betreff|",
+    r"da|inviato|data|oggetto|",
+    r"de|enviado|fecha|asunto|",
+    r"由|发送时间|日期|主题|",
+    r"发件人|寄件日期|信件主题|",
+    r"van|verzonden|datum|onderwerp|",
+    r"fra|sendt|dato|emne|",
+    r"від|надіслано|дата|тема|",
+    r"من|مرسل|تاريخ|موضوع|",
+    r"fra|sendt|dato|emne|",
+    r"mới|gửi|ngày|chủ đề|",
+    r"od|poslano|datum|naslov|",
+    r"od|zaslano|datum|predmet|",
+    r"отправитель|отправлено|дата|тема|",
+    r"发件者|发送日期|日期|主题):\s+.*)|",
+    r"(\n-{2,}\n)",
+]
+
+def legacy_split_body(full_body):
+    # Прежняя реализация: шаблон собирается заново при каждом вызове
+    split_pattern = "".join(LEGACY_SPLIT_PATTERN_PARTS)
+    split_match = re.search(split_pattern, full_body, re.MULTILINE)
+    if split_match:
+        return full_body[:split_match.start()].strip(), full_body[split_match.start():].strip()
+    return full_body.strip(), None
+
+GREETINGS = ["Добрый день!", "Hello,", "Guten Tag,", "Bonjour,", "您好，", "Buenos días,", "مرحبا،"]
+BODIES = [
+    "Просим предоставить ставку на перевозку {size}HC из {a} в {b}, груз {w} т.",
+    "Please quote {size}HC from {a} to {b}, cargo weight {w} t, ready {d}.05.",
+    "Bitte um Angebot für {size}HC von {a} nach {b}, Gewicht {w} t.",
+    "Merci de nous envoyer votre meilleur tarif {a} - {b}, {size}HC, {w} t.",
+    "请报价 {a} 至 {b} {size}HC 集装箱，重量 {w} 吨。",
+    "Tarifa {a} - {b}, contenedor {size}HC: {p} USD, validez {d} días.",
+    "Ставка {a} - {b}, {size}HC: {p} USD, свободное время {d} дней.",
+]
+CITIES = ["Шанхай", "Алматы", "Москва", "Ningbo", "Riga", "Hamburg", "Qingdao", "Ташкент"]
+SIGNATURES = ["С уважением,\nИван Петров\nтел. +7 495 000-00-00", "Best regards,\nJohn Smith",
+              "Mit freundlichen Grüßen\nMax Muster", "Cordialement,\nPierre"]
+REPLY_HEADERS = [
+    "From: Ivan Petrov <ivan@example.com>\nSent: Monday, May {d}, 2024 10:15 AM\nTo: Sales\nSubject: RE: rate request",
+    "От: Иван Петров <ivan@example.ru>\nОтправлено: понедельник, {d} мая 2024 г. 10:15\nКому: Отдел продаж\nТема: RE: ставка",
+    "Von: Max Muster <max@example.de>\nGesendet: Montag, {d}. Mai 2024 10:15\nAn: Vertrieb\nBetreff: AW: Anfrage",
+    "-----Original Message-----\nFrom: John Smith <john@example.com>\nSent: {d} May 2024 10:15",
+    "On Mon, {d} May 2024 at 10:15, John Smith <john@example.com> wrote:",
+    "пн, {d} мая 2024 г. в 10:15, Иван Петров <ivan@example.ru>:",
+    "发件人: 王伟 <wang@example.cn>\n发送时间: 2024年5月{d}日 10:15\n主题: 回复: 报价",
+]
+
+def synthetic_message(rng, history_depth):
+    """
+    Функция для генерации письма с историей переписки.
+
+    Возвращает:
+        tuple: (текст письма, основное письмо, которое должен выделить разделитель).
+    """
+    def part():
+        values = {"size": rng.choice([20, 40, 45]), "a": rng.choice(CITIES), "b": rng.choice(CITIES),
+                  "w": rng.randint(5, 28), "p": rng.randint(500, 5000), "d": rng.randint(1, 28)}
+        return "\n".join([rng.choice(GREETINGS), rng.choice(BODIES).format(**values), "", rng.choice(SIGNATURES)])
+
+    main = part()
+    text = main
+    for _ in range(history_depth):
+        header = rng.choice(REPLY_HEADERS).format(d=rng.randint(1, 28))
+        quoted = part()
+        if header.startswith("On ") or "г. в" in header:
+            quoted = "\n".join("> " + line for line in quoted.split("\n"))  # Цитата Gmail через ">"
+        text += "\n\n" + header + "\n\n" + quoted
+    return text, main
+
+def build_corpus(size, seed=42, max_history=4):
+    rng = random.Random(seed)
+    return [synthetic_message(rng, rng.randint(0, max_history)) for _ in range(size)]
+
+def time_per_message(split, corpus, repeat=3):
+    # Лучшее из repeat прогонов время разделения одного письма, в микросекундах
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for text, _ in corpus:
+            split(text)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(corpus) * 1e6
+
+def run_benchmark(size=2000, seed=42, repeat=3):
+    """
+    Функция для запуска бенчмарка.
+
+    Возвращает:
+        dict: Время на одно письмо (мкс) для каждой реализации и доля правильно выделенных основных писем.
+    """
+    corpus = build_corpus(size, seed)
+    splitter = EmailBodySplitter()
+    results = {
+        "messages": len(corpus),
+        "legacy_split_body_us": time_per_message(legacy_split_body, corpus, repeat),
+        "split_body_us": time_per_message(splitter.split_body, corpus, repeat),
+        "split_offsets_us": time_per_message(split_offsets, corpus, repeat),
+    }
+    correct = legacy_correct = 0
+    for text, main in corpus:
+        offsets = split_offsets(text)
+        correct += text[offsets.main_start:offsets.main_end] == main.strip()
+        legacy_correct += legacy_split_body(text)[0] == main.strip()
+    results["accuracy"] = correct / len(corpus)
+    results["legacy_accuracy"] = legacy_correct / len(corpus)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк разделения писем на основное сообщение и историю")
+    parser.add_argument("--messages", type=int, default=2000, help="Количество писем в синтетическом корпусе")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=3, help="Количество прогонов (берётся лучший)")
+    args = parser.parse_args()
+    results = run_benchmark(args.messages, args.seed, args.repeat)
+    print(f"Писем: {results['messages']}")
+    print(f"Прежняя реализация: {results['legacy_split_body_us']:.1f} мкс/письмо, "
+          f"точность {results['legacy_accuracy']:.1%}")
+    print(f"split_body:         {results['split_body_us']:.1f} мкс/письмо, точность {results['accuracy']:.1%}")
+    print(f"split_offsets:      {results['split_offsets_us']:.1f} мкс/письмо")
@@ -0,0 +1,53 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from schema_migrations import MIGRATIONS, CHECKED_QUERIES, migrate, schema_version, verify_query_plans
+
+# Проверка миграций схемы: база создаётся в памяти, а основные запросы (CHECKED_QUERIES)
+# должны выполняться по своим индексам, а не полным просмотром таблиц.
+
+def assert_plans_use_indexes(conn):
+    results = verify_query_plans(conn)
+    assert set(results) == set(CHECKED_QUERIES)
+    for name, (plan, ok) in results.items():
+        assert ok, f"Запрос '{name}' не использует индекс {CHECKED_QUERIES[name][1]}: {plan}"
+
+def seed_emails(conn, count=2000, pending_every=50):
+    # Обычное распределение рабочей базы: почти все письма обработаны, у части есть цены
+    cursor = conn.cursor()
+    for i in range(count):
+        cursor.execute(
+            "INSERT INTO emails (entry_id, subject, sender, received_time, processed, migration_processed, "
+            "price_amount, price_currency) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (f"e{i}", "Ставка", "agent@example.com", f"2024-01-{i % 28 + 1:02d} 10:00:00",
+             int(i % pending_every != 0), int(i % pending_every != 1),
+             1000 + i % 1000 if i % 3 == 0 else None, "USD" if i % 3 == 0 else None)
+        )
+        cursor.execute(
+            "INSERT INTO price_components (email_id, position, kind, label, amount, currency, basis, origin, "
+            "destination, container, received_time) "
+            "VALUES (?, 0, 'ставка', '', ?, 'USD', '', 'Шанхай', 'Алматы', ?, ?)",
+            (cursor.lastrowid, 1000 + i % 500, "40HC" if i % 2 else "20DC", f"2024-01-{i % 28 + 1:02d} 10:00:00")
+        )
+    conn.commit()
+    conn.execute("ANALYZE")
+
+def test_migrate_applies_all_migrations_once():
+    conn = sqlite3.connect(":memory:")
+    assert migrate(conn) == [version for version, _, _ in MIGRATIONS]
+    assert schema_version(conn) == MIGRATIONS[-1][0]
+    assert migrate(conn) == []
+
+def test_query_plans_use_indexes_on_new_database():
+    conn = sqlite3.connect(":memory:")
+    migrate(conn)
+    assert_plans_use_indexes(conn)
+
+def test_query_plans_use_indexes_with_statistics():
+    conn = sqlite3.connect(":memory:")
+    migrate(conn)
+    seed_emails(conn)
+    assert_plans_use_indexes(conn)
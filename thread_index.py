@@ -0,0 +1,225 @@
+import hashlib
+import logging
+import re
+import time
+from body_trimmer import clean_message, split_history, count_tokens
+
+# Индекс цепочек переписки. Каждый ответ в цепочке несёт всю предыдущую историю,
+# поэтому для каждой цепочки (Outlook ConversationID или In-Reply-To/References) запоминаются
+# хэши уже проанализированных сообщений. В модель уходит только новая часть письма и
+# ранее извлечённый контекст цепочки (маршрут, груз, транспорт), а ответы с ценой
+# связываются с исходным запросом в таблице thread_links.
+
+# Поля результата, которые переносятся между письмами одной цепочки
+CONTEXT_FIELDS = {
+    "origin": "место отправления",
+    "destination": "место назначения",
+    "cargo_details": "детали груза",
+    "transport_type": "тип транспортировки",
+}
+
+MESSAGE_ID_PATTERN = re.compile(r"<[^>]+>")
+
+logger = logging.getLogger("ThreadIndex")
+
+def segment_hash(text):
+    # Хэш сообщения цепочки после очистки и нормализации (пробелы, регистр, пунктуация)
+    normalized = re.sub(r"\W+", " ", clean_message(text or "").lower()).strip()
+    if not normalized:
+        return None
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+def thread_key(conversation_id, headers=None):
+    """
+    Функция для определения ключа цепочки переписки.
+
+    Параметры:
+        conversation_id (str): ConversationID письма Outlook или None.
+        headers (dict): Заголовки письма (ключи в нижнем регистре).
+
+    Возвращает:
+        str: Ключ цепочки или None, если письмо не относится к цепочке.
+    """
+    if conversation_id:
+        return conversation_id
+    headers = headers or {}
+    # Первый Message-ID в References - корневое письмо цепочки
+    for name in ("references", "in-reply-to"):
+        ids = MESSAGE_ID_PATTERN.findall(headers.get(name) or "")
+        if ids:
+            return ids[0]
+    return None
+
+class ThreadIndex:
+    """
+    Индекс проанализированных сообщений цепочек переписки в базе писем.
+
+    Параметры:
+        conn (sqlite3.Connection): Соединение с базой данных emails.db.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.stats = {'emails': 0, 'threaded_emails': 0, 'history_segments': 0,
+                      'skipped_segments': 0, 'skipped_tokens': 0, 'links': 0}
+        self.create_tables()
+
+    def create_tables(self):
+        cursor = self.conn.cursor()
+        # Проанализированные сообщения цепочки
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS thread_segments (
+                thread_key TEXT NOT NULL,
+                segment_hash TEXT NOT NULL,
+                email_id INTEGER,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (thread_key, segment_hash)
+            )
+        ''')
+        # Контекст цепочки, извлечённый из предыдущих писем
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS thread_context (
+                thread_key TEXT PRIMARY KEY,
+                origin TEXT,
+                destination TEXT,
+                cargo_details TEXT,
+                transport_type TEXT,
+                request_email_id INTEGER,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        # Связь запроса на перевозку с ответами-котировками
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS thread_links (
+                request_email_id INTEGER NOT NULL,
+                quote_email_id INTEGER NOT NULL,
+                thread_key TEXT NOT NULL,
+                PRIMARY KEY (request_email_id, quote_email_id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_thread_links_quote ON thread_links(quote_email_id)")
+        self.conn.commit()
+
+    def known_segments(self, key):
+        # Хэши сообщений цепочки, которые уже были отправлены в модель
+        rows = self.conn.execute("SELECT segment_hash FROM thread_segments WHERE thread_key = ?", (key,))
+        return {row[0] for row in rows}
+
+    def context(self, key):
+        # Ранее извлечённый контекст цепочки: {ключ результата: значение}
+        row = self.conn.execute(
+            "SELECT origin, destination, cargo_details, transport_type FROM thread_context WHERE thread_key = ?",
+            (key,)
+        ).fetchone()
+        if row is None:
+            return {}
+        return {name: value for name, value in zip(CONTEXT_FIELDS.values(), row) if value}
+
+    def context_text(self, key):
+        # Контекст цепочки для добавления к тексту письма
+        context = self.context(key)
+        if not context:
+            return ""
+        lines = [f"{name.capitalize()}: {value}" for name, value in context.items()]
+        return "Контекст переписки (извлечено из предыдущих писем):\n" + "\n".join(lines)
+
+    def split_segments(self, splitter, full_body):
+        """
+        Функция для разбиения письма на новую часть и сообщения истории.
+
+        Возвращает:
+            tuple: (основное письмо, строка истории или None, список пар (заголовки, текст) истории).
+        """
+        main_body, history_body = splitter.split_body(full_body)
+        history = split_history(splitter, history_body) if history_body else []
+        return main_body, history_body, history
+
+    def unseen_history(self, key, history):
+        # Оставляет только сообщения истории, которые ещё не отправлялись в модель
+        known = self.known_segments(key) if key else set()
+        unseen = []
+        for head, body in history:
+            self.stats['history_segments'] += 1
+            if segment_hash(body) in known:
+                self.stats['skipped_segments'] += 1
+                self.stats['skipped_tokens'] += count_tokens(body)
+                continue
+            unseen.append((head, body))
+        return unseen
+
+    def merge_context(self, key, transportation_info):
+        # Заполняет пустые поля результата контекстом цепочки
+        if not key or not transportation_info:
+            return transportation_info
+        merged = dict(transportation_info)
+        for name, value in self.context(key).items():
+            if not (merged.get(name) or "").strip():
+                merged[name] = value
+        return merged
+
+    def record(self, key, email_id, segments, transportation_info):
+        """
+        Функция для сохранения результата анализа письма цепочки.
+
+        Параметры:
+            key (str): Ключ цепочки.
+            email_id (int): ID письма в таблице emails или None.
+            segments: Тексты проанализированных сообщений (новая часть и история).
+            transportation_info (dict): Результат извлечения или None.
+        """
+        self.stats['emails'] += 1
+        if not key:
+            return
+        self.stats['threaded_emails'] += 1
+        now = time.time()
+        cursor = self.conn.cursor()
+        hashes = {segment_hash(text) for text in segments} - {None}
+        cursor.executemany(
+            "INSERT OR IGNORE INTO thread_segments (thread_key, segment_hash, email_id, created_at) VALUES (?, ?, ?, ?)",
+            [(key, value, email_id, now) for value in hashes]
+        )
+
+        if transportation_info:
+            row = cursor.execute("SELECT request_email_id FROM thread_context WHERE thread_key = ?", (key,)).fetchone()
+            request_email_id = row[0] if row else None
+            price = (transportation_info.get('цена') or '').strip()
+            letter_type = (transportation_info.get('тип письма') or '').strip().lower()
+
+            if email_id is not None and price and request_email_id is not None and request_email_id != email_id:
+                # Ответ с ценой на ранее сохранённый запрос
+                cursor.execute(
+                    "INSERT OR IGNORE INTO thread_links (request_email_id, quote_email_id, thread_key) VALUES (?, ?, ?)",
+                    (request_email_id, email_id, key)
+                )
+                self.stats['links'] += cursor.rowcount
+            if email_id is not None and not price and 'запрос' in letter_type:
+                request_email_id = email_id
+
+            values = {column: (transportation_info.get(name) or '').strip() or None
+                      for column, name in CONTEXT_FIELDS.items()}
+            # Новые непустые значения заменяют контекст, пустые не затирают его
+            cursor.execute('''
+                INSERT INTO thread_context (thread_key, origin, destination, cargo_details, transport_type,
+                                            request_email_id, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(thread_key) DO UPDATE SET
+                    origin = COALESCE(excluded.origin, origin),
+                    destination = COALESCE(excluded.destination, destination),
+                    cargo_details = COALESCE(excluded.cargo_details, cargo_details),
+                    transport_type = COALESCE(excluded.transport_type, transport_type),
+                    request_email_id = COALESCE(excluded.request_email_id, request_email_id),
+                    updated_at = excluded.updated_at
+            ''', (key, values['origin'], values['destination'], values['cargo_details'], values['transport_type'],
+                  request_email_id, now))
+        self.conn.commit()
+
+    def quotes_for_request(self, request_email_id):
+        # Ответы-котировки на запрос: список (id письма, цена)
+        return self.conn.execute('''
+            SELECT e.id, e.price FROM thread_links l JOIN emails e ON e.id = l.quote_email_id
+            WHERE l.request_email_id = ? ORDER BY e.received_time
+        ''', (request_email_id,)).fetchall()
+
+    def report(self):
+        # Сводка по сообщениям истории, которые не были повторно отправлены в модель
+        logger.info(f"Индекс цепочек переписки: {self.stats}")
+        return dict(self.stats)